@@ -6,17 +6,35 @@ Versão 2.0 - Com validação, logs estruturados e monitoramento
 
 import http.server
 import socketserver
+import itertools
 import json
 import os
 import sys
 import urllib.parse
 import re
+import base64
+import bisect
+import contextvars
+import io
+import zlib
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
 import time
+import queue
+import threading
+import http.cookiejar
+import sqlite3
+import tempfile
+import hashlib
+import hmac
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging
+import logging.handlers
+import atexit
+import random
 
 # Carregar variáveis do .env
 load_dotenv()
@@ -25,6 +43,102 @@ load_dotenv()
 API_PORT = 8082
 STATIC_PORT = 8080
 
+# Servidor concorrente: 'threaded' (pool fixo de workers) ou 'single' (uma requisição por vez)
+API_SERVER_MODE = os.getenv('API_SERVER_MODE', 'threaded')
+API_WORKERS = int(os.getenv('API_WORKERS', 16))
+API_ACCEPT_QUEUE = int(os.getenv('API_ACCEPT_QUEUE', 64))
+
+# Conexões keep-alive mantidas por host upstream (Safe2Pay, Safeweb, Hope)
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', API_WORKERS))
+
+# Long-poll de status PIX: tempo máximo que uma requisição fica aguardando o webhook
+PIX_WAIT_MAX_SECONDS = int(os.getenv('PIX_WAIT_MAX_SECONDS', 25))
+
+# Pré-checagem Safeweb (biometria + RFB em paralelo)
+SAFEWEB_PRECHECK_WORKERS = int(os.getenv('SAFEWEB_PRECHECK_WORKERS', 8))
+SAFEWEB_PRECHECK_TIMEOUT = int(os.getenv('SAFEWEB_PRECHECK_TIMEOUT', 35))
+
+# Rate limiting por IP: {política: (max_requests, window_seconds)}
+# 'ip' vale para todas as rotas; as demais somam-se a ela nas rotas de ROUTE_RATE_LIMITS.
+# Sobrescrever via RATE_LIMIT_POLICIES='{"pix-create": [10, 60]}'
+RATE_LIMIT_POLICIES = {
+    'ip': (200, 60),
+    'pix-create': (30, 60),
+    'safeweb': (60, 60),
+}
+RATE_LIMIT_POLICIES.update({
+    name: tuple(policy) for name, policy in json.loads(os.getenv('RATE_LIMIT_POLICIES', '{}')).items()
+})
+ROUTE_RATE_LIMITS = [
+    ('/api/pix/create', 'pix-create'),
+    ('/api/checkout', 'pix-create'),
+    ('/api/safeweb/', 'safeweb'),
+]
+
+# Micro-cache das consultas de transação ao Safe2Pay (quando o webhook ainda não chegou)
+TRANSACTION_CACHE_TTL = float(os.getenv('TRANSACTION_CACHE_TTL', 3))
+TRANSACTION_CACHE_STALE = float(os.getenv('TRANSACTION_CACHE_STALE', 10))
+
+# Cache das consultas Safeweb (biometria e RFB) por hash salgado do CPF
+SAFEWEB_CACHE_POSITIVE_TTL = int(os.getenv('SAFEWEB_CACHE_POSITIVE_TTL', 1800))
+SAFEWEB_CACHE_NEGATIVE_TTL = int(os.getenv('SAFEWEB_CACHE_NEGATIVE_TTL', 300))
+SAFEWEB_CACHE_MAX_ENTRIES = int(os.getenv('SAFEWEB_CACHE_MAX_ENTRIES', 10000))
+SAFEWEB_CACHE_SALT = os.getenv('SAFEWEB_CACHE_SALT')
+
+# Cache do proxy de imagens (QR Codes): limites em bytes
+IMAGE_CACHE_MEMORY_BYTES = int(os.getenv('IMAGE_CACHE_MEMORY_BYTES', 8 * 1024 * 1024))
+IMAGE_CACHE_DISK_BYTES = int(os.getenv('IMAGE_CACHE_DISK_BYTES', 64 * 1024 * 1024))
+IMAGE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('IMAGE_CACHE_MAX_ENTRY_BYTES', 1024 * 1024))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ecommerce-image-cache'))
+IMAGE_PROXY_CHUNK_SIZE = 16 * 1024
+IMAGE_PROXY_ALLOWED_DOMAINS = ('safe2pay.com', 'safe2pay.com.br')
+
+# Armazenamento chave-valor compartilhado (memory | sqlite | dynamodb)
+PAYMENT_STATUS_STORE = os.getenv('PAYMENT_STATUS_STORE', 'memory')
+PAYMENT_STATUS_TTL = int(os.getenv('PAYMENT_STATUS_TTL', 172800))
+KV_STORE_SQLITE_PATH = os.getenv('KV_STORE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'ecommerce-kv.sqlite3'))
+
+# Fila durável dos webhooks Safe2Pay (resposta imediata, processamento em lote)
+WEBHOOK_QUEUE_PATH = os.getenv('WEBHOOK_QUEUE_PATH', os.path.join(tempfile.gettempdir(), 'ecommerce-webhooks.sqlite3'))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 10))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+
+# Solicitação Hope disparada pelo webhook de aprovação (link de upload gravado por protocolo)
+POST_APPROVAL_STORE = os.getenv('POST_APPROVAL_STORE', 'memory')
+POST_APPROVAL_WAIT_SECONDS = int(os.getenv('POST_APPROVAL_WAIT_SECONDS', 35))
+
+# Outbox dos efeitos Safeweb pós-aprovação (liberação, Hope) com retentativa em segundo plano
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', os.path.join(tempfile.gettempdir(), 'ecommerce-outbox.sqlite3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 2))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+
+# Logs: JSON de uma linha (ou text), fila + thread de escrita, payloads verbosos amostrados por rota
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+LOG_PAYLOAD_SAMPLE_ROUTES_SPEC = os.getenv('LOG_PAYLOAD_SAMPLE_ROUTES', '/webhook/safe2pay=0.1')
+
+# Tracing: X-Request-ID/traceparent por requisição, spans OTLP/JSON (file | stdout | off)
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'off')
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(tempfile.gettempdir(), 'ecommerce-traces.jsonl'))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'ecommerce-api')
+# Só hosts parceiros que aceitam os headers recebem X-Request-ID/traceparent (vazio = nenhum)
+TRACE_PROPAGATION_HOSTS = {h.strip() for h in os.getenv('TRACE_PROPAGATION_HOSTS', '').split(',') if h.strip()}
+
+# Índice protocolo → cobrança PIX pendente (reload no step 5 reaproveita a cobrança)
+PIX_CHARGE_STORE = os.getenv('PIX_CHARGE_STORE', 'memory')
+
+# Idempotency-Key nos POSTs que criam protocolo, cobrança ou solicitação
+IDEMPOTENCY_STORE = os.getenv('IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 600))
+IDEMPOTENCY_WAIT_SECONDS = int(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 35))
+IDEMPOTENT_ROUTES = (
+    '/api/pix/create',
+    '/api/safeweb/gerar-protocolo',
+    '/api/hope/create-solicitation',
+    '/api/checkout',
+)
+
 # CORS - Origens permitidas (SEGURANÇA)
 ALLOWED_ORIGINS = [
     'http://localhost:8080',  # Desenvolvimento
@@ -34,12 +148,283 @@ ALLOWED_ORIGINS = [
     'http://127.0.0.1:56859',  # VSCode Live Server (porta dinâmica)
 ]
 
-# Configurar logging estruturado
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# Trace da requisição atual (copiado para as tarefas do BoundedExecutor)
+_request_trace = contextvars.ContextVar('request_trace', default=None)
+
+
+# ==========================================
+# 🔒 MASCARAMENTO DE DADOS (PII) - copiado do lambda_handler.py
+# ==========================================
+
+_NON_DIGITS = re.compile(r'\D+')
+_DIGIT_RUNS = re.compile(r'\d+')
+_EMAIL_PARTS = re.compile(r'([^@]*)@([^@]*)')
+
+
+def mask_cpf(cpf):
+    """
+    Mascara CPF para logs: 123.456.789-01 -> 123.***.***-01
+    """
+    if not cpf:
+        return cpf
+    cpf_clean = _NON_DIGITS.sub('', str(cpf))
+    if len(cpf_clean) < 11:
+        return "***.***.***-**"
+    return f"{cpf_clean[:3]}.***.***-{cpf_clean[-2:]}"
+
+def mask_email(email):
+    """
+    Mascara email para logs: usuario@dominio.com -> u******@dominio.com
+    """
+    if not email:
+        return email
+    match = _EMAIL_PARTS.match(str(email))
+    if match is None:
+        return email
+    local, domain = match.groups()
+    if len(local) <= 1:
+        return f"*@{domain}"
+    return f"{local[0]}{'*' * (len(local) - 1)}@{domain}"
+
+def mask_phone(phone):
+    """
+    Mascara telefone para logs: (11) 98765-4321 -> (11) 9****-**21
+    """
+    if not phone:
+        return phone
+    phone_clean = _NON_DIGITS.sub('', str(phone))
+    if len(phone_clean) < 10:
+        return "(**) ****-****"
+    return f"({phone_clean[:2]}) {phone_clean[2]}****-**{phone_clean[-2:]}"
+
+def mask_name(name):
+    """
+    Mascara nome para logs: João da Silva -> João ***
+    """
+    if not name:
+        return name
+    parts = str(name).split()
+    if not parts:
+        return name
+    if len(parts) == 1:
+        return parts[0]
+    return f"{parts[0]} ***"
+
+def mask_address(address):
+    """
+    Mascara endereço para logs: Rua das Flores, 123 -> Rua das Flores, ***
+    """
+    if not address:
+        return address
+    return _DIGIT_RUNS.sub('***', str(address))
+
+
+# Campos que devem ser mascarados (nome exato da chave -> máscara)
+SENSITIVE_FIELDS = {
+    'cpf': mask_cpf,
+    'CPF': mask_cpf,
+    'cnpj': mask_cpf,
+    'CNPJ': mask_cpf,
+    'Identity': mask_cpf,
+    'email': mask_email,
+    'Email': mask_email,
+    'telefone': mask_phone,
+    'Phone': mask_phone,
+    'PhoneNumber': mask_phone,
+    'nome': mask_name,
+    'Name': mask_name,
+    'nomeCompleto': mask_name,
+    'nome_completo': mask_name,
+    'endereco': mask_address,
+    'Address': mask_address,
+    'Street': mask_address,
+    'logradouro': mask_address
+}
+
+
+class PIIRedactor:
+    """
+    Mascaramento de PII com plano compilado uma única vez
+
+    O plano (chave -> máscara) vira um dict e um frozenset; em cada dict do
+    payload a interseção com as chaves do plano é feita em C, e só valores
+    dict/list são visitados. Nada é copiado enquanto não houver o que
+    mascarar: subárvores sem PII são devolvidas como estão (compartilhadas
+    com a entrada), e um dict só é copiado (raso) quando algo abaixo dele
+    muda. O resultado é somente leitura - quem precisar alterá-lo deve
+    copiar antes.
+    """
+
+    def __init__(self, fields):
+        self.plan = dict(fields)
+        self.keys = frozenset(self.plan)
+
+    def redact(self, data):
+        if isinstance(data, dict):
+            return self._redact_dict(data)
+        if isinstance(data, list):
+            return self._redact_list(data)
+        return data
+
+    def _redact_dict(self, node):
+        out = None
+        hits = self.keys.intersection(node) if node else ()
+        for key in hits:
+            value = node[key]
+            masked = self.plan[key](value)
+            if isinstance(masked, (dict, list)):
+                masked = self.redact(masked)
+            if masked is not value:
+                if out is None:
+                    out = dict(node)
+                out[key] = masked
+        for key, value in node.items():
+            if key in hits or not isinstance(value, (dict, list)):
+                continue
+            redacted = self.redact(value)
+            if redacted is not value:
+                if out is None:
+                    out = dict(node)
+                out[key] = redacted
+        return node if out is None else out
+
+    def _redact_list(self, node):
+        out = None
+        for index, item in enumerate(node):
+            if not isinstance(item, (dict, list)):
+                continue
+            redacted = self.redact(item)
+            if redacted is not item:
+                if out is None:
+                    out = list(node)
+                out[index] = redacted
+        return node if out is None else out
+
+
+pii_redactor = PIIRedactor(SENSITIVE_FIELDS)
+
+
+def mask_sensitive_data(data):
+    """
+    Mascara todos os dados sensíveis em um payload (para logs)
+
+    Subárvores sem PII são compartilhadas com a entrada - não alterar o retorno.
+    """
+    return pii_redactor.redact(data)
+
+# ==========================================
+# 📝 LOGGING ESTRUTURADO (FILA + JSON)
+# ==========================================
+
+def parse_sample_routes(value):
+    """'/webhook/safe2pay=0.1,/api/pix/create=0.05' -> {rota: taxa}"""
+    routes = {}
+    for item in value.split(','):
+        route, _, rate = item.strip().partition('=')
+        if route and rate:
+            routes[route.strip()] = float(rate)
+    return routes
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Uma linha JSON por registro: horário, nível, mensagem, IDs da requisição e payload mascarado"""
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'trace_id': getattr(record, 'trace_id', None)
+        }
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            entry['payload'] = payload
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """Formato legível (desenvolvimento local), com o payload mascarado numa linha só"""
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        line = super().format(record)
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            line += ' ' + json.dumps(payload, ensure_ascii=False, default=str)
+        return line
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que só anota o contexto da requisição (request_id, trace_id)
+
+    Diferente do QueueHandler padrão, não formata a mensagem na thread de
+    quem chamou: formatação, JSON e I/O ficam na thread do QueueListener.
+    Com a fila cheia o registro é descartado e contado, sem o traceback
+    síncrono do handleError na thread da requisição.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        trace = _request_trace.get()
+        record.request_id = trace.request_id if trace is not None else '-'
+        record.trace_id = trace.trace_id if trace is not None else None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def payload_sampled(route):
+    """Sorteio da amostragem de payloads pela taxa da rota (LOG_PAYLOAD_SAMPLE_ROUTES)"""
+    rate = LOG_PAYLOAD_SAMPLE_ROUTES.get(route, LOG_PAYLOAD_SAMPLE_RATE) if route else LOG_PAYLOAD_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def log_payload(message, payload, level=logging.INFO):
+    """
+    Registra um payload verboso (corpo de webhook, resposta upstream) mascarado e amostrado
+
+    Nível desligado ou registro fora da amostra retornam antes de qualquer
+    cópia, máscara ou serialização.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    trace = _request_trace.get()
+    if not payload_sampled(trace.route if trace is not None else None):
+        return
+    logger.log(level, message, extra={'payload': mask_sensitive_data(payload)})
+
+
+LOG_PAYLOAD_SAMPLE_ROUTES = parse_sample_routes(LOG_PAYLOAD_SAMPLE_ROUTES_SPEC)
+
+# Registros vão para a fila na thread da requisição; o listener formata e escreve
+log_queue = queue.Queue(maxsize=10000)
+_log_output = logging.StreamHandler()
+if LOG_FORMAT == 'json':
+    _log_output.setFormatter(JsonLogFormatter())
+else:
+    _log_output.setFormatter(TextLogFormatter(
+        '%(asctime)s [%(levelname)s] [%(request_id)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+log_listener = logging.handlers.QueueListener(log_queue, _log_output)
+log_handler = ContextQueueHandler(log_queue)
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler], force=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Catálogo de produtos (source of truth para preços)
@@ -69,45 +454,98 @@ PRODUCT_CATALOG = {
 
 
 class RateLimiter:
-    """Rate Limiter simples baseado em IP"""
+    """
+    Rate limiter por janela deslizante aproximada (sliding window counter)
+
+    Cada chave guarda apenas o contador da janela atual e o da anterior
+    (memória constante por chave, independente do limite). A contagem
+    estimada é `anterior * fração_restante_da_janela + atual`. Chaves sem
+    uso desde a penúltima janela são removidas periodicamente.
+    """
 
-    def __init__(self, max_requests=200, window_seconds=60):
+    def __init__(self, policies, sweep_interval=60):
         """
         Args:
-            max_requests: Número máximo de requisições permitidas
-            window_seconds: Janela de tempo em segundos
+            policies: {nome: (max_requests, window_seconds)}
+            sweep_interval: Intervalo em segundos entre remoções de chaves ociosas
         """
-        self.max_requests = max_requests
-        self.window_seconds = window_seconds
-        self.requests = defaultdict(list)  # {ip: [timestamp1, timestamp2, ...]}
-
-    def is_allowed(self, ip):
-        """Verifica se o IP pode fazer requisição"""
-        now = time.time()
-
-        # Limpar requisições antigas (fora da janela)
-        self.requests[ip] = [
-            timestamp for timestamp in self.requests[ip]
-            if now - timestamp < self.window_seconds
-        ]
-
-        # Verificar se excedeu o limite
-        if len(self.requests[ip]) >= self.max_requests:
-            logger.warning(f"🚫 Rate limit excedido para IP: {ip}")
-            return False
-
-        # Registrar nova requisição
-        self.requests[ip].append(now)
-        return True
+        self.policies = dict(policies)
+        self.sweep_interval = sweep_interval
+        # {política: {chave: [índice_da_janela, contagem_atual, contagem_anterior]}}
+        self._counters = {name: {} for name in self.policies}
+        self._next_sweep = time.time() + sweep_interval
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def add_policy(self, name, max_requests, window_seconds):
+        with self._lock:
+            self.policies[name] = (max_requests, window_seconds)
+            self._counters.setdefault(name, {})
+
+    def hit(self, policy, key, now=None):
+        """
+        Registra uma requisição da chave na política
 
-    def get_retry_after(self, ip):
-        """Retorna quantos segundos até poder tentar novamente"""
-        if not self.requests[ip]:
-            return 0
+        Returns:
+            (bool, int, int): (permitido, requisições_restantes, retry_after_segundos)
+        """
+        max_requests, window = self.policies[policy]
+        if max_requests <= 0:
+            # Política bloqueada (limite zero): sempre nega, sem contar
+            return (False, 0, max(1, int(window)))
+        now = time.time() if now is None else now
+        window_index = int(now // window)
+        elapsed = now - window_index * window
+
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            counters = self._counters[policy]
+            counter = counters.get(key)
+            if counter is None:
+                counter = counters[key] = [window_index, 0, 0]
+            elif counter[0] != window_index:
+                # Nova janela: a atual vira anterior (ou zera se pulou mais de uma)
+                counter[2] = counter[1] if counter[0] == window_index - 1 else 0
+                counter[1] = 0
+                counter[0] = window_index
+
+            estimated = counter[2] * (1 - elapsed / window) + counter[1]
+            if estimated + 1 > max_requests:
+                return (False, 0, self._retry_after(counter, max_requests, window, elapsed))
+
+            counter[1] += 1
+            return (True, max(0, int(max_requests - estimated - 1)), 0)
 
-        oldest_request = min(self.requests[ip])
-        retry_after = self.window_seconds - (time.time() - oldest_request)
-        return max(0, int(retry_after))
+    @staticmethod
+    def _retry_after(counter, max_requests, window, elapsed):
+        """Segundos até a contagem estimada abrir espaço para mais uma requisição"""
+        current, previous = counter[1], counter[2]
+        if current + 1 > max_requests:
+            # Só na próxima janela, quando a atual passa a ser a anterior
+            wait = (window - elapsed) + window * (1 - (max_requests - 1) / current)
+        else:
+            wait = window * (1 - (max_requests - 1 - current) / previous) - elapsed
+        return max(1, int(wait + 0.999))
+
+    def _sweep(self, now):
+        """Remove chaves sem acesso desde a penúltima janela (contagem estimada já é zero)"""
+        for name, counters in self._counters.items():
+            oldest_active = int(now // self.policies[name][1]) - 1
+            active = {key: counter for key, counter in counters.items() if counter[0] >= oldest_active}
+            self._evicted += len(counters) - len(active)
+            # Dicionário novo: o antigo não devolve memória ao remover chaves
+            self._counters[name] = active
+        self._next_sweep = now + self.sweep_interval
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': sum(len(counters) for counters in self._counters.values()),
+                'evicted': self._evicted,
+                'policies': {name: {'limit': limit, 'window': window} for name, (limit, window) in self.policies.items()}
+            }
 
 
 class Validator:
@@ -253,6 +691,1832 @@ class Validator:
         return True, None
 
 
+class MemoryKVStore:
+    """Backend chave-valor em memória do processo: LRU limitado com expiração"""
+
+    def __init__(self, max_entries=10000, sweep_every=1000):
+        self.max_entries = max_entries
+        self.sweep_every = sweep_every
+        self._items = OrderedDict()  # {key: (value, expires_at, version)}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live_item(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self._items[key]
+            return None
+        return item
+
+    def _store(self, key, value, ttl, version=0):
+        self._items[key] = (value, time.time() + ttl if ttl else None, version)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            now = time.time()
+            for expired in [k for k, item in self._items.items() if item[1] is not None and item[1] <= now]:
+                del self._items[expired]
+
+    def get(self, key):
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is not None and item[2] >= version:
+                return False
+            self._store(key, value, ttl, version)
+            return True
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live_item(key, time.time()) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class SQLiteKVStore:
+    """Backend chave-valor em SQLite - substituto local do DynamoDB"""
+
+    def __init__(self, path, purge_every=500):
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'pk TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, version REAL NOT NULL DEFAULT 0)'
+        )
+
+    def _is_live(self, expires_at, now):
+        return expires_at is None or expires_at > now
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM kv WHERE pk = ?', (key,)).fetchone()
+        if not row or not self._is_live(row[1], time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _maybe_purge(self):
+        """Remove itens expirados periodicamente (chamado com o lock adquirido)"""
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._conn.execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, 0)',
+                (key, json.dumps(value), expires_at)
+            )
+            self._maybe_purge()
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        """Grava apenas se a versão armazenada for menor (ou o item tiver expirado)"""
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(pk) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, '
+                'version = excluded.version '
+                'WHERE kv.version < excluded.version OR (kv.expires_at IS NOT NULL AND kv.expires_at <= ?)',
+                (key, json.dumps(value), expires_at, version, now)
+            )
+            self._maybe_purge()
+            return cursor.rowcount > 0
+
+    def add(self, key, value, ttl=None):
+        """Grava apenas se a chave não existir (ou tiver expirado) - usado como lock/lease"""
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, 0) '
+                'ON CONFLICT(pk) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, version = 0 '
+                'WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?',
+                (key, json.dumps(value), expires_at, now)
+            )
+            return cursor.rowcount > 0
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM kv WHERE pk = ?', (key,))
+
+
+class DynamoDBKVStore:
+    """
+    Backend chave-valor em DynamoDB
+
+    Tabela com chave de partição `pk` (S) e TTL habilitado em `expires_at`.
+    Requer boto3 (não é dependência do servidor local).
+    """
+
+    def __init__(self, table_name):
+        import boto3
+        self.table_name = table_name
+        self._client = boto3.client('dynamodb')
+
+    def _conditional_put(self, item, condition, values):
+        try:
+            self._client.put_item(
+                TableName=self.table_name,
+                Item=item,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+            return True
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def _item(self, key, value, ttl, version=0):
+        item = {
+            'pk': {'S': key},
+            'value': {'S': json.dumps(value)},
+            'version': {'N': str(version)}
+        }
+        if ttl:
+            item['expires_at'] = {'N': str(int(time.time() + ttl))}
+        return item
+
+    def get(self, key):
+        response = self._client.get_item(TableName=self.table_name, Key={'pk': {'S': key}}, ConsistentRead=True)
+        item = response.get('Item')
+        if not item:
+            return None
+        # O TTL do DynamoDB remove itens com atraso: validar a expiração aqui
+        if 'expires_at' in item and float(item['expires_at']['N']) <= time.time():
+            return None
+        return json.loads(item['value']['S'])
+
+    def put(self, key, value, ttl=None):
+        self._client.put_item(TableName=self.table_name, Item=self._item(key, value, ttl))
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        return self._conditional_put(
+            self._item(key, value, ttl, version),
+            'attribute_not_exists(pk) OR version < :version OR expires_at <= :now',
+            {':version': {'N': str(version)}, ':now': {'N': str(int(time.time()))}}
+        )
+
+    def add(self, key, value, ttl=None):
+        return self._conditional_put(
+            self._item(key, value, ttl),
+            'attribute_not_exists(pk) OR expires_at <= :now',
+            {':now': {'N': str(int(time.time()))}}
+        )
+
+    def delete(self, key):
+        self._client.delete_item(TableName=self.table_name, Key={'pk': {'S': key}})
+
+
+_kv_stores = {}
+_kv_stores_lock = threading.Lock()
+
+
+def create_kv_store(backend):
+    """
+    Retorna o backend chave-valor configurado (uma instância por tipo, compartilhada no processo)
+
+    Args:
+        backend: 'memory' (LRU no processo), 'sqlite' (arquivo em KV_STORE_SQLITE_PATH,
+            compartilhado entre processos) ou 'dynamodb' (tabela em KV_STORE_TABLE)
+    """
+    with _kv_stores_lock:
+        if backend not in _kv_stores:
+            if backend == 'memory':
+                _kv_stores[backend] = MemoryKVStore(int(os.getenv('KV_STORE_MEMORY_MAX_ENTRIES', 10000)))
+            elif backend == 'sqlite':
+                _kv_stores[backend] = SQLiteKVStore(KV_STORE_SQLITE_PATH)
+            elif backend == 'dynamodb':
+                _kv_stores[backend] = DynamoDBKVStore(os.environ['KV_STORE_TABLE'])
+            else:
+                raise ValueError(f"Backend de armazenamento desconhecido: {backend}")
+        return _kv_stores[backend]
+
+
+class PaymentStatusStore:
+    """
+    Status de pagamento gravados pelo webhook, com expiração
+
+    Webhooks chegam fora de ordem ou repetidos (retentativas do Safe2Pay e
+    da fila): cada status grava com uma versão (fase do status, depois o
+    instante de recebimento) e só substitui o gravado se for mais novo - um
+    "pendente" atrasado nunca apaga um "aprovado".
+    """
+
+    PREFIX = 'payment-status:'
+    PENDING_STATUSES = frozenset({'1', '2'})  # Pendente, Em processamento
+
+    def __init__(self, kv_store, ttl=PAYMENT_STATUS_TTL):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            ttl: Segundos que um status permanece armazenado (padrão: 2 dias)
+        """
+        self.kv = kv_store
+        self.ttl = ttl
+
+    @classmethod
+    def version(cls, status_id, received_at=None):
+        """Pendentes antes de qualquer status final; na mesma fase, o recebido por último (ms)"""
+        phase = 0 if str(status_id) in cls.PENDING_STATUSES else 1
+        return phase * 10 ** 13 + int((received_at or time.time()) * 1000)
+
+    def record(self, transaction_id, status_id, status_code=None, status_name=None,
+               amount=None, payment_date=None, reference=None, received_at=None):
+        """
+        Grava o status se for mais novo que o gravado
+
+        Returns:
+            dict gravado, ou None se um status mais novo já estava gravado
+        """
+        data = {
+            'PaymentStatus': status_id,
+            'TransactionStatus': {'Id': status_id, 'Code': status_code, 'Name': status_name},
+            'Amount': amount,
+            'PaymentDate': payment_date,
+            'Reference': reference,
+            'status': status_id,
+            'updatedAt': time.time()
+        }
+        version = self.version(status_id, received_at)
+        if not self.kv.put_if_newer(self.PREFIX + str(transaction_id), data, version, ttl=self.ttl):
+            logger.info(f"⏭️ Status {status_id} da transação {transaction_id} ignorado: já há um status mais novo")
+            return None
+        return data
+
+    def get(self, transaction_id):
+        return self.kv.get(self.PREFIX + str(transaction_id))
+
+
+# Status recebidos via webhook (lidos por /api/pix/status e /api/pix/wait)
+payment_status_store = PaymentStatusStore(create_kv_store(PAYMENT_STATUS_STORE))
+
+
+class IdempotencyStore:
+    """
+    Respostas de POSTs com header `Idempotency-Key`, gravadas no backend chave-valor
+
+    - A primeira requisição com a chave reserva a entrada (`pending`) e executa
+    - Duplicatas simultâneas aguardam a original e recebem a mesma resposta
+    - Duplicatas depois disso recebem a resposta gravada durante `ttl` segundos
+    - A mesma chave com outro corpo é rejeitada (fingerprint diferente)
+    - Respostas 4xx ficam só `error_ttl` segundos (o usuário pode corrigir e
+      repetir) e 5xx liberam a chave na hora
+    """
+
+    PREFIX = 'idempotency:'
+
+    def __init__(self, kv_store, ttl, error_ttl=10, lock_ttl=120, wait_timeout=35, poll_interval=0.1):
+        """
+        Args:
+            kv_store: Backend chave-valor (memory, sqlite ou dynamodb)
+            ttl: Segundos que uma resposta de sucesso é reaproveitada
+            error_ttl: Segundos que uma resposta 4xx é reaproveitada
+            lock_ttl: Validade da reserva `pending` (processo que morreu no meio)
+            wait_timeout: Máximo que uma duplicata aguarda a original
+            poll_interval: Intervalo de releitura quando a original está em outro processo
+        """
+        self.kv = kv_store
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._inflight = {}     # chave -> threading.Event da requisição original neste processo
+        self._lock = threading.Lock()
+        self._stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'mismatches': 0, 'timeouts': 0}
+
+    def _storage_key(self, scope, key):
+        return self.PREFIX + hashlib.sha256(f'{scope}\x1f{key}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(raw_body):
+        if isinstance(raw_body, str):
+            raw_body = raw_body.encode('utf-8')
+        return hashlib.sha256(raw_body or b'').hexdigest()
+
+    def begin(self, scope, key, fingerprint):
+        """
+        Reserva a chave ou aguarda a requisição original
+
+        Returns:
+            (resultado, registro) onde resultado é 'execute' (esta requisição é a
+            original), 'replay' (registro tem a resposta), 'mismatch' (outro corpo)
+            ou 'in_progress' (a original não terminou dentro de wait_timeout)
+        """
+        storage_key = self._storage_key(scope, key)
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+
+        while True:
+            if self.kv.add(storage_key, {'state': 'pending', 'fingerprint': fingerprint}, ttl=self.lock_ttl):
+                with self._lock:
+                    self._inflight[storage_key] = threading.Event()
+                    self._stats['executed'] += 1
+                return 'execute', None
+
+            record = self.kv.get(storage_key)
+            if record is None:
+                # Liberada ou expirada entre o add e o get: tentar reservar de novo
+                continue
+
+            if record.get('fingerprint') != fingerprint:
+                with self._lock:
+                    self._stats['mismatches'] += 1
+                return 'mismatch', record
+
+            if record.get('state') == 'done':
+                with self._lock:
+                    self._stats['replayed'] += 1
+                    if waited:
+                        self._stats['waited'] += 1
+                return 'replay', record
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                return 'in_progress', record
+
+            waited = True
+            event = self._inflight.get(storage_key)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+    def complete(self, scope, key, fingerprint, status_code, body, headers=None):
+        """Grava a resposta da requisição original e acorda as duplicatas"""
+        storage_key = self._storage_key(scope, key)
+        try:
+            if status_code >= 500:
+                self.kv.delete(storage_key)
+            else:
+                self.kv.put(storage_key, {
+                    'state': 'done',
+                    'fingerprint': fingerprint,
+                    'status_code': status_code,
+                    'body': body,
+                    'headers': headers or {}
+                }, ttl=self.ttl if status_code < 400 else self.error_ttl)
+        finally:
+            with self._lock:
+                event = self._inflight.pop(storage_key, None)
+            if event is not None:
+                event.set()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'inflight': len(self._inflight), 'ttl': self.ttl}
+
+
+# Respostas de POSTs repetidos (duplo clique, retry do frontend)
+idempotency_store = IdempotencyStore(
+    create_kv_store(IDEMPOTENCY_STORE),
+    ttl=IDEMPOTENCY_TTL,
+    wait_timeout=IDEMPOTENCY_WAIT_SECONDS
+)
+
+
+class PixChargeIndex:
+    """
+    Índice protocolo → cobrança PIX ainda válida
+
+    Um reload no step 5 (ou um novo clique em "Gerar PIX") para o mesmo
+    protocolo devolve a cobrança pendente em vez de criar outra na Safe2Pay.
+    Uma nova cobrança só é criada depois que a atual expira ou quando o
+    webhook informa que ela foi cancelada, recusada, estornada ou expirou.
+    """
+
+    PREFIX = 'pix-charge:'
+
+    # Status Safe2Pay que encerram a cobrança: 6=Devolvido, 7=Baixado,
+    # 8=Recusado, 12=Em cancelamento, 16=Expirado
+    DEAD_STATUSES = {'6', '7', '8', '12', '16'}
+
+    def __init__(self, kv_store, status_store, reuse_margin=60):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            status_store: PaymentStatusStore com os status recebidos via webhook
+            reuse_margin: Segundos mínimos de validade restante para reaproveitar
+        """
+        self.kv = kv_store
+        self.status_store = status_store
+        self.reuse_margin = reuse_margin
+
+    def get_live(self, protocolo, product_code):
+        """Retorna os dados da cobrança pendente do protocolo ou None"""
+        key = self.PREFIX + str(protocolo)
+        charge = self.kv.get(key)
+        if not charge or charge.get('product') != product_code:
+            return None
+
+        if charge['expires_at'] - time.time() < self.reuse_margin:
+            return None
+
+        status = self.status_store.get(charge['dados']['transactionId'])
+        if status and str(status.get('status')) in self.DEAD_STATUSES:
+            self.kv.delete(key)
+            return None
+
+        return {
+            **charge['dados'],
+            'qrCodeDataUri': pix_qr_data_uri(charge['dados'].get('qrCode', '')),
+            'reused': True
+        }
+
+    def record(self, protocolo, product_code, dados, ttl):
+        """Indexa a cobrança recém-criada (sem o QR renderizado, refeito na leitura)"""
+        self.kv.put(self.PREFIX + str(protocolo), {
+            'product': product_code,
+            'expires_at': time.time() + ttl,
+            'dados': {k: v for k, v in dados.items() if k != 'qrCodeDataUri'}
+        }, ttl=ttl)
+
+
+# Cobranças PIX pendentes por protocolo
+pix_charge_index = PixChargeIndex(create_kv_store(PIX_CHARGE_STORE), payment_status_store)
+
+
+# Buckets (segundos) dos histogramas de latência: de cache local até o timeout upstream (30s)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Segmentos com cara de ID (números longos, hashes, UUIDs) viram {id} nos labels
+_METRIC_ID_SEGMENT = re.compile(r'^(\d{4,}|[0-9a-fA-F-]{16,}|(?=.*\d)[A-Za-z0-9_.-]{8,})$')
+
+
+# Rotas com parâmetro no caminho: o label leva o modelo da rota, nunca o valor enviado
+METRIC_ROUTE_TEMPLATES = (
+    ('/api/pix/status/', '/api/pix/status/{id}'),
+    ('/api/pix/wait/', '/api/pix/wait/{id}'),
+)
+
+# Rotas fixas conhecidas; qualquer outro caminho (seja qual for o status) vira 'unmatched'
+METRIC_ROUTES = frozenset((
+    '/api/health', '/api/metrics', '/api/ops/outbox', '/api/proxy-image', '/api/pix/create',
+    '/api/checkout', '/api/safeweb/verificar-biometria', '/api/safeweb/consultar-cpf',
+    '/api/safeweb/gerar-protocolo', '/api/safeweb/pre-check', '/api/hope/create-solicitation',
+    '/webhook/safe2pay'
+))
+
+
+def metric_route_label(path):
+    """Label de rota da API: só rotas conhecidas, o resto agrupado em 'unmatched'"""
+    path = urllib.parse.urlsplit(path or '').path
+    if path in METRIC_ROUTES:
+        return path
+    return next((template for prefix, template in METRIC_ROUTE_TEMPLATES if path.startswith(prefix)), 'unmatched')
+
+
+def metric_path_label(path):
+    """Caminho sem query e com IDs trocados por {id} (cardinalidade limitada nos labels)"""
+    path = urllib.parse.urlsplit(path).path or '/'
+    return '/'.join('{id}' if _METRIC_ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+class LatencyHistograms:
+    """
+    Histogramas de latência por métrica + labels, no formato texto do Prometheus
+
+    Cada série guarda só as contagens por bucket, a soma e o total: o custo
+    por observação é um bisect e três somas, sem guardar amostras.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._series = {}  # {(nome, labels): {'buckets': [...], 'sum': s, 'count': n}}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['buckets'][index] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{k}="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render_prometheus(self):
+        with self._lock:
+            snapshot = sorted(
+                (name, labels, list(series['buckets']), series['sum'], series['count'])
+                for (name, labels), series in self._series.items()
+            )
+
+        lines = []
+        current = None
+        for name, labels, buckets, total, count in snapshot:
+            if name != current:
+                current = name
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', repr(float(bound)))])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {round(total, 6)}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+class ServerTiming:
+    """
+    Spans de uma requisição (token, upstreams, serialização) para o header Server-Timing
+
+    Mostra no DevTools do navegador onde foi o tempo de uma resposta lenta;
+    o que sobra do 'total' fora dos spans é código nosso.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, desc=None):
+        with self._lock:
+            self._spans.append((name, round(seconds * 1000, 1), desc))
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def header(self):
+        """Valor do header: um item por span + o total da requisição"""
+        with self._lock:
+            spans = list(self._spans)
+        items = []
+        for name, ms, desc in spans:
+            item = f"{name};dur={ms}"
+            if desc:
+                # Header HTTP: só ASCII, sem aspas ou barras dentro do desc
+                desc = desc.encode('ascii', 'ignore').decode('ascii').replace('\\', '').replace('"', '')
+                item += f';desc="{desc}"'
+            items.append(item)
+        items.append(f"total;dur={self.total_ms()}")
+        return ', '.join(items)
+
+    def as_dict(self):
+        """Mesmos spans para o corpo da resposta (header X-Debug-Timing)"""
+        with self._lock:
+            spans = list(self._spans)
+        return {
+            'total_ms': self.total_ms(),
+            'spans': [{'name': name, 'ms': ms, 'desc': desc} for name, ms, desc in spans]
+        }
+
+
+# Spans da requisição atual (copiados para as tarefas do BoundedExecutor)
+_request_timing = contextvars.ContextVar('request_timing', default=None)
+
+
+def record_timing(name, seconds, desc=None):
+    """Registra um span na requisição atual (sem requisição, ex.: workers, não faz nada)"""
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add(name, seconds, desc)
+
+
+# W3C traceparent (versão 00) e X-Request-ID aceitos do cliente
+_TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+# Códigos OTLP (SpanKind / StatusCode)
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_CONSUMER = 5
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+
+
+def _otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
+
+
+class RequestTrace:
+    """
+    Trace de uma requisição: IDs de correlação e spans no formato OTLP/JSON
+
+    O trace_id vem do `traceparent` recebido (ou é gerado); o request_id é o
+    X-Request-ID recebido, ou o próprio trace_id. Os spans ficam em memória
+    até o fim da requisição e saem numa única linha pelo TraceExporter.
+    """
+
+    def __init__(self, request_id=None, traceparent=None, kind=SPAN_KIND_SERVER):
+        match = _TRACEPARENT_PATTERN.match(traceparent or '')
+        self.trace_id = match.group(1) if match else os.urandom(16).hex()
+        self.parent_span_id = match.group(2) if match else None
+        self.request_id = request_id if request_id and _REQUEST_ID_PATTERN.match(request_id) else self.trace_id
+        self.span_id = os.urandom(8).hex()
+        self.kind = kind
+        self.route = None  # rota da API (amostragem de logs por rota)
+        self.start_ns = time.time_ns()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_span_id():
+        return os.urandom(8).hex()
+
+    def traceparent(self, span_id):
+        """Header traceparent para uma chamada filha deste trace"""
+        return f"00-{self.trace_id}-{span_id}-01"
+
+    def add_span(self, name, start_ns, end_ns, attributes, error=False, span_id=None, kind=SPAN_KIND_CLIENT):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': span_id or self.new_span_id(),
+            'parentSpanId': self.span_id,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(end_ns),
+            'attributes': _otlp_attributes(attributes),
+            'status': {'code': SPAN_STATUS_ERROR if error else SPAN_STATUS_OK}
+        }
+        with self._lock:
+            self._spans.append(span)
+
+    def finish(self, name, attributes, error=False):
+        """Fecha o span raiz e retorna o documento OTLP/JSON (resourceSpans) da requisição"""
+        root = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(time.time_ns()),
+            'attributes': _otlp_attributes({'http.request_id': self.request_id, **attributes}),
+            'status': {'code': SPAN_STATUS_ERROR if error else SPAN_STATUS_OK}
+        }
+        if self.parent_span_id:
+            root['parentSpanId'] = self.parent_span_id
+        with self._lock:
+            spans = [root] + self._spans
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({'service.name': TRACE_SERVICE_NAME})},
+                'scopeSpans': [{'scope': {'name': 'ecommerce.tracing'}, 'spans': spans}]
+            }]
+        }
+
+
+def trace_propagation_allowed(host):
+    """Hosts upstream que recebem X-Request-ID/traceparent (TRACE_PROPAGATION_HOSTS, '*' = todos)"""
+    return '*' in TRACE_PROPAGATION_HOSTS or host in TRACE_PROPAGATION_HOSTS
+
+
+def trace_upstream_call(method, url, kwargs):
+    """
+    Prepara o span de uma chamada upstream da requisição atual
+
+    Returns:
+        (trace, span_id) - e os headers de correlação já incluídos em kwargs -
+        ou (None, None) fora de uma requisição
+    """
+    trace = _request_trace.get()
+    if trace is None:
+        return None, None
+
+    span_id = trace.new_span_id()
+    if trace_propagation_allowed(urllib.parse.urlsplit(url).netloc):
+        kwargs['headers'] = {
+            **(kwargs.get('headers') or {}),
+            'X-Request-ID': trace.request_id,
+            'traceparent': trace.traceparent(span_id)
+        }
+    return trace, span_id
+
+
+class TraceExporter:
+    """
+    Grava os traces (uma linha OTLP/JSON por requisição) fora da thread da requisição
+
+    A requisição só enfileira o documento; serialização e escrita rodam numa
+    thread própria. Com a fila cheia o trace é descartado (e contado) em vez
+    de segurar a resposta.
+    """
+
+    def __init__(self, target, max_queue=1000):
+        """
+        Args:
+            target: 'stdout', 'off' ou caminho do arquivo (JSON Lines)
+            max_queue: Traces aguardando escrita antes de começar a descartar
+        """
+        self.target = target
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.target != 'off'
+
+    def export(self, document):
+        if not self.enabled:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stream = sys.stdout if self.target == 'stdout' else open(self.target, 'a', encoding='utf-8')
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                stream.write(''.join(json.dumps(doc, separators=(',', ':')) + '\n' for doc in batch))
+                stream.flush()
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.error(f"❌ Erro ao gravar traces: {str(e)}")
+
+    def stats(self):
+        return {
+            'target': self.target,
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize()
+        }
+
+
+trace_exporter = TraceExporter(TRACE_FILE if TRACE_EXPORT == 'file' else TRACE_EXPORT)
+
+
+# Métricas de latência das rotas e das chamadas upstream (exportadas em /api/metrics)
+latency_metrics = LatencyHistograms()
+latency_metrics.describe(
+    'ecommerce_http_request_duration_seconds', 'Tempo de resposta das rotas da API por método, rota e status'
+)
+latency_metrics.describe(
+    'ecommerce_upstream_request_duration_seconds',
+    'Tempo das chamadas upstream por host, endpoint, método e status (timeout/error sem resposta)'
+)
+
+
+class UpstreamHTTP:
+    """
+    Sessões HTTP keep-alive compartilhadas por host upstream.
+
+    Cada host (payment.safe2pay.com.br, api.safe2pay.com.br,
+    pss.safewebpss.com.br, ...) tem sua própria Session com pool de conexões,
+    evitando um novo handshake TCP/TLS a cada chamada.
+    """
+
+    def __init__(self, pool_maxsize=UPSTREAM_POOL_MAXSIZE):
+        """
+        Args:
+            pool_maxsize: Máximo de conexões mantidas abertas por host
+        """
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}  # {origin: Session}
+        self._lock = threading.Lock()
+
+    def _session_for(self, url):
+        parts = urllib.parse.urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+
+        session = self._sessions.get(origin)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(origin)
+                if session is None:
+                    session = requests.Session()
+                    # Chamadas server-side não devem carregar cookies entre clientes
+                    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._sessions[origin] = session
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        trace, span_id = trace_upstream_call(method, url, kwargs)
+        start_ns = time.time_ns()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self._session_for(url).request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            parts = urllib.parse.urlsplit(url)
+            endpoint = metric_path_label(parts.path)
+            latency_metrics.observe(
+                'ecommerce_upstream_request_duration_seconds', elapsed,
+                host=parts.netloc, endpoint=endpoint, method=method, status=status
+            )
+            record_timing('upstream', elapsed, f"{parts.netloc}{endpoint} {status}")
+            if trace is not None:
+                trace.add_span(f"{method} {parts.netloc}{endpoint}", start_ns, time.time_ns(), {
+                    'http.request.method': method,
+                    'server.address': parts.netloc,
+                    'url.path': endpoint,
+                    'http.response.status_code': int(status) if status.isdigit() else None,
+                    'error.type': None if status.isdigit() else status
+                }, error=not status.isdigit() or status.startswith('5'), span_id=span_id)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Retorna, por host, quantas requisições reutilizaram conexão e quantas abriram uma nova"""
+        result = {}
+
+        for origin, session in list(self._sessions.items()):
+            pools = session.get_adapter(origin).poolmanager.pools
+            total_requests = 0
+            new_connections = 0
+
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    new_connections += pool.num_connections
+
+            result[urllib.parse.urlsplit(origin).netloc] = {
+                'requests': total_requests,
+                'new_connections': new_connections,
+                'reused_connections': max(0, total_requests - new_connections),
+                'pool_maxsize': self.pool_maxsize
+            }
+
+        return result
+
+
+# Instância global das sessões upstream (compartilhada por todas as requisições)
+upstream_http = UpstreamHTTP()
+
+
+def is_allowed_image_url(url):
+    """URL https cujo host é um domínio Safe2Pay (ou subdomínio dele)"""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        hostname = parts.hostname
+    except ValueError:
+        return False
+    if parts.scheme != 'https' or not hostname or parts.username or parts.password:
+        return False
+    return any(hostname == domain or hostname.endswith('.' + domain) for domain in IMAGE_PROXY_ALLOWED_DOMAINS)
+
+
+def image_content_type(value):
+    """Content-Type normalizado se for image/* (exceto SVG, que executa script), senão None"""
+    media_type = (value or '').split(';', 1)[0].strip().lower()
+    if not media_type.startswith('image/') or media_type == 'image/svg+xml':
+        return None
+    return media_type
+
+
+class _InflightLoad:
+    """Chamada ao upstream em andamento: resultado (ou exceção) entregue a quem aguarda"""
+
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_COALESCED = object()  # marcador: aguardar a chamada de outra requisição
+
+
+class MicroCache:
+    """
+    Cache de curta duração com stale-while-revalidate e coalescência de requisições
+
+    - Dentro de `ttl` a resposta é servida do cache (hit)
+    - Entre `ttl` e `ttl + stale_ttl` a resposta antiga é servida enquanto uma
+      única revalidação roda (stale)
+    - Requisições simultâneas pela mesma chave sem cache aguardam uma única
+      chamada ao upstream (coalesced)
+    """
+
+    def __init__(self, ttl, stale_ttl, max_entries=5000, background=True):
+        """
+        Args:
+            ttl: Segundos em que a resposta é considerada fresca
+            stale_ttl: Segundos extras em que a resposta antiga ainda pode ser servida
+            max_entries: Máximo de chaves em cache (LRU)
+            background: Revalida em thread separada. Sem ela, quem encontra a
+                entrada vencida revalida e as requisições simultâneas recebem a antiga
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.background = background
+        self._entries = OrderedDict()   # chave -> (valor, armazenado_em)
+        self._inflight = {}             # chave -> _InflightLoad da chamada em andamento
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0, 'revalidations': 0, 'errors': 0}
+
+    def get_or_load(self, key, loader, cacheable=lambda value: True):
+        """
+        Retorna o valor da chave, chamando `loader()` no máximo uma vez por vez
+
+        Requisições coalescidas recebem o resultado da chamada em andamento,
+        inclusive quando ele não é cacheável (erro do upstream) ou é uma
+        exceção: uma queda do upstream não vira uma chamada por requisição.
+        Na revalidação sem background, um resultado não cacheável devolve a
+        resposta antiga.
+
+        Args:
+            key: Chave do cache
+            loader: Função sem argumentos que consulta o upstream
+            cacheable: Define se o resultado do loader pode ser armazenado
+                (erros não são cacheados)
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            age = now - entry[1] if entry else None
+
+            if entry and age < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[0]
+
+            flight = self._inflight.get(key)
+            if entry and age < self.ttl + self.stale_ttl:
+                # Resposta antiga: servir e garantir uma única revalidação
+                self._stats['stale_hits'] += 1
+                if flight is not None:
+                    return entry[0]
+                flight = self._inflight[key] = _InflightLoad()
+                self._stats['revalidations'] += 1
+                if self.background:
+                    threading.Thread(target=self._revalidate, args=(key, flight, loader, cacheable), daemon=True).start()
+                    return entry[0]
+                stale_value = entry[0]
+            elif flight is None:
+                flight = self._inflight[key] = _InflightLoad()
+                self._stats['misses'] += 1
+                stale_value = None
+            else:
+                self._stats['coalesced'] += 1
+                stale_value = _COALESCED
+
+        if stale_value is _COALESCED:
+            # Aguardar a chamada em andamento e devolver o mesmo resultado
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = self._load(key, flight, loader, cacheable)
+        except Exception:
+            if stale_value is None:
+                raise
+            return stale_value
+        if stale_value is not None and not cacheable(value):
+            return stale_value
+        return value
+
+    def _revalidate(self, key, flight, loader, cacheable):
+        """Revalidação em background: o erro já foi contado em _load, aqui só é registrado"""
+        try:
+            self._load(key, flight, loader, cacheable)
+        except Exception as e:
+            logger.warning(f"⚠️ MicroCache: revalidação em background falhou: {str(e)}")
+
+    def _load(self, key, flight, loader, cacheable):
+        try:
+            value = loader()
+            flight.value = value
+            if cacheable(value):
+                with self._lock:
+                    self._entries[key] = (value, time.time())
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            else:
+                with self._lock:
+                    self._stats['errors'] += 1
+            return value
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+            flight.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl
+            }
+
+
+# Consultas /transaction/get por ID (várias abas ou retries compartilham uma chamada)
+transaction_status_cache = MicroCache(TRANSACTION_CACHE_TTL, TRANSACTION_CACHE_STALE)
+
+
+class SafewebLookupCache:
+    """
+    Cache TTL das consultas Safeweb (biometria e RFB) com chave em hash salgado
+
+    - Nenhum CPF em claro fica em memória: a chave é um HMAC-SHA256 das
+      entradas e o campo `cpf` é removido do resultado armazenado
+    - Resultados positivos e negativos têm TTLs separados
+    - Erros transitórios (HTTP, exceções, código 999) não são cacheados
+    """
+
+    def __init__(self, positive_ttl, negative_ttl, max_entries=10000, salt=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._salt = salt.encode('utf-8') if salt else os.urandom(16)
+        self._entries = OrderedDict()   # hash -> (resultado, expira_em)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'evictions': 0}
+
+    def _key(self, parts):
+        return hmac.new(self._salt, '\x1f'.join(parts).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def get_or_load(self, parts, loader, classify):
+        """
+        Retorna o resultado em cache ou chama `loader()` e armazena conforme `classify`
+
+        Args:
+            parts: Entradas da consulta (tipo, CPF, ...) que formam a chave
+            loader: Função sem argumentos que consulta a Safeweb
+            classify: Recebe o resultado e retorna 'positive', 'negative' ou
+                None (não cachear)
+        """
+        key = self._key(parts)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return dict(entry[0])
+            if entry:
+                del self._entries[key]
+            self._stats['misses'] += 1
+
+        resultado = loader()
+        kind = classify(resultado)
+        with self._lock:
+            if kind is None:
+                self._stats['skipped'] += 1
+                return resultado
+            ttl = self.positive_ttl if kind == 'positive' else self.negative_ttl
+            stored = {k: v for k, v in resultado.items() if k != 'cpf'}
+            self._entries[key] = (stored, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return resultado
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+                'positive_ttl': self.positive_ttl,
+                'negative_ttl': self.negative_ttl
+            }
+
+
+# Códigos da consulta prévia RFB que são respostas definitivas (1-5: CPF inválido,
+# inexistente, cancelado, data divergente, nulo). 700 e 999 não são cacheados.
+RFB_NEGATIVE_CODES = (1, 2, 3, 4, 5)
+
+
+def classify_biometria_result(resultado):
+    if not resultado.get('sucesso'):
+        return None
+    return 'positive' if resultado.get('temBiometria') else 'negative'
+
+
+def classify_consulta_result(resultado):
+    if 'erro' in resultado:
+        return None
+    if resultado.get('codigo') == 0:
+        return 'positive'
+    if resultado.get('codigo') in RFB_NEGATIVE_CODES:
+        return 'negative'
+    return None
+
+
+# Biometria/RFB por CPF (usuário voltando entre os steps ou repetindo após erro)
+safeweb_lookup_cache = SafewebLookupCache(
+    SAFEWEB_CACHE_POSITIVE_TTL,
+    SAFEWEB_CACHE_NEGATIVE_TTL,
+    max_entries=SAFEWEB_CACHE_MAX_ENTRIES,
+    salt=SAFEWEB_CACHE_SALT
+)
+
+
+class ImageProxyCache:
+    """
+    Cache LRU das imagens do proxy (QR Codes) em memória e em disco, limitado por bytes
+
+    - Memória: acesso mais rápido, limite menor
+    - Disco: sobrevive a reinícios; itens lidos do disco voltam para a memória.
+      Cada imagem é um único arquivo `.img` (linha JSON com content_type/etag
+      seguida do corpo), então metadados e corpo nunca divergem
+    - Apenas uma requisição busca cada URL por vez (as demais aguardam o cache)
+    """
+
+    def __init__(self, max_memory_bytes=IMAGE_CACHE_MEMORY_BYTES, max_disk_bytes=IMAGE_CACHE_DISK_BYTES,
+                 cache_dir=IMAGE_CACHE_DIR, max_entry_bytes=IMAGE_CACHE_MAX_ENTRY_BYTES):
+        """
+        Args:
+            max_memory_bytes: Bytes máximos das imagens em memória
+            max_disk_bytes: Bytes máximos das imagens em disco (0 desativa o disco)
+            cache_dir: Diretório do cache em disco
+            max_entry_bytes: Imagens maiores não são cacheadas
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.cache_dir = cache_dir if max_disk_bytes > 0 else None
+        self._memory = OrderedDict()   # {chave: {'body', 'content_type', 'etag'}}
+        self._memory_bytes = 0
+        self._disk = OrderedDict()     # {chave: tamanho em bytes}
+        self._disk_bytes = 0
+        self._inflight = {}            # {chave: threading.Event}
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0, 'not_modified': 0}
+
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._load_disk_index()
+            except OSError as e:
+                logger.warning(f"⚠️ Cache de imagens em disco desativado: {str(e)}")
+                self.cache_dir = None
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def _load_disk_index(self):
+        """Reconstrói o índice LRU do disco (mais antigos primeiro, pela data de modificação)"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(('.json', '.tmp')):
+                # Metadados do formato antigo ou escrita interrompida
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+            elif name.endswith('.img'):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get(self, url):
+        """Retorna {'body', 'content_type', 'etag'} ou None"""
+        key = self._key(url)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return entry
+            on_disk = key in self._disk
+
+        if not on_disk:
+            return None
+
+        try:
+            with open(self._path(key, '.img'), 'rb') as f:
+                header = f.readline()
+                body = f.read()
+            meta = json.loads(header)
+            entry = {'body': body, 'content_type': meta['content_type'], 'etag': meta['etag']}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._store_memory(key, entry)
+            self._stats['disk_hits'] += 1
+        return entry
+
+    def claim(self, url):
+        """
+        Reserva a busca da URL
+
+        Returns:
+            None se quem chamou deve buscar no upstream (e chamar `release`
+            ao terminar), ou um Event para aguardar a busca em andamento
+        """
+        key = self._key(url)
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = threading.Event()
+                self._stats['misses'] += 1
+                return None
+            self._stats['coalesced'] += 1
+            return event
+
+    def release(self, url):
+        with self._lock:
+            event = self._inflight.pop(self._key(url), None)
+        if event is not None:
+            event.set()
+
+    def put(self, url, body, content_type, etag=None):
+        """Armazena a imagem em memória e em disco; retorna a entrada (com ETag)"""
+        key = self._key(url)
+        entry = {
+            'body': body,
+            'content_type': content_type,
+            'etag': etag or '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        }
+        if len(body) > self.max_entry_bytes:
+            return entry
+
+        with self._lock:
+            self._store_memory(key, entry)
+
+        if self.cache_dir:
+            header = json.dumps({'content_type': content_type, 'etag': entry['etag']}).encode('utf-8') + b'\n'
+            tmp_path = None
+            try:
+                # Escrita atômica em arquivo temporário próprio: leitores nunca
+                # veem arquivo pela metade nem metadados de outra versão
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(header)
+                    f.write(body)
+                os.replace(tmp_path, self._path(key, '.img'))
+            except OSError as e:
+                logger.warning(f"⚠️ Falha ao gravar imagem no cache em disco: {str(e)}")
+                if tmp_path:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                return entry
+
+            size = len(header) + len(body)
+            with self._lock:
+                self._disk_bytes += size - self._disk.pop(key, 0)
+                self._disk[key] = size
+                self._evict_disk()
+
+        return entry
+
+    def _store_memory(self, key, entry):
+        """Chamado com o lock adquirido"""
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous['body'])
+        self._memory[key] = entry
+        self._memory_bytes += len(entry['body'])
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted['body'])
+
+    def _evict_disk(self):
+        """Chamado com o lock adquirido (ou na inicialização)"""
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(key, '.img'))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes
+            }
+
+
+# Cache das imagens servidas por /api/proxy-image
+image_proxy_cache = ImageProxyCache()
+
+
+class PixQRCode:
+    """
+    Codificador de QR Code (modo byte, correção de erros nível M) em Python puro
+
+    Gera o QR Code do PIX copia-e-cola no próprio servidor, sem depender da
+    imagem hospedada pela Safe2Pay. Saída em SVG ou PNG (data URI inline).
+    """
+
+    # Nível M, por versão (índice 0 não usado): codewords de correção por bloco e número de blocos
+    EC_CODEWORDS_PER_BLOCK = [
+        None, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+        26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28
+    ]
+    EC_BLOCKS = [
+        None, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+        17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49
+    ]
+    # Bits do nível M no campo de formato
+    EC_FORMAT_BITS = 0
+    QUIET_ZONE = 4
+
+    _GF_EXP = None
+    _GF_LOG = None
+    _DIVISORS = {}
+
+    def __init__(self, payload):
+        """
+        Args:
+            payload: Texto a codificar (PIX copia-e-cola / EMV)
+        """
+        data = payload.encode('utf-8')
+        self.version = self._choose_version(len(data))
+        self.size = self.version * 4 + 17
+        self.modules = [[False] * self.size for _ in range(self.size)]
+        self._function = [[False] * self.size for _ in range(self.size)]
+
+        self._draw_function_patterns()
+        self._draw_codewords(self._add_error_correction(self._data_codewords(data)))
+        self.mask = self._apply_best_mask()
+
+    # ---------- Capacidade ----------
+
+    @staticmethod
+    def _raw_data_modules(version):
+        result = (16 * version + 128) * version + 64
+        if version >= 2:
+            num_align = version // 7 + 2
+            result -= (25 * num_align - 10) * num_align - 55
+            if version >= 7:
+                result -= 36
+        return result
+
+    @classmethod
+    def _data_capacity(cls, version):
+        """Codewords de dados disponíveis na versão (nível M)"""
+        return cls._raw_data_modules(version) // 8 - cls.EC_CODEWORDS_PER_BLOCK[version] * cls.EC_BLOCKS[version]
+
+    @classmethod
+    def _choose_version(cls, data_length):
+        for version in range(1, 41):
+            count_bits = 8 if version <= 9 else 16
+            if 4 + count_bits + data_length * 8 <= cls._data_capacity(version) * 8:
+                return version
+        raise ValueError(f"Payload grande demais para QR Code: {data_length} bytes")
+
+    # ---------- Dados e correção de erros ----------
+
+    def _data_codewords(self, data):
+        count_bits = 8 if self.version <= 9 else 16
+        capacity_bits = self._data_capacity(self.version) * 8
+
+        # Modo byte (0100) + contagem + dados, como inteiro de bits
+        bits = (0b0100 << count_bits) | len(data)
+        bits = (bits << (len(data) * 8)) | int.from_bytes(data, 'big')
+        length = 4 + count_bits + len(data) * 8
+
+        # Terminador (até 4 zeros) e alinhamento em byte
+        terminator = min(4, capacity_bits - length)
+        bits <<= terminator
+        length += terminator
+        padding = -length % 8
+        bits <<= padding
+        length += padding
+
+        codewords = list(bits.to_bytes(length // 8, 'big'))
+        pad_bytes = (0xEC, 0x11)
+        for i in range(capacity_bits // 8 - len(codewords)):
+            codewords.append(pad_bytes[i % 2])
+        return codewords
+
+    @classmethod
+    def _init_galois_field(cls):
+        exp = [0] * 512
+        log = [0] * 256
+        value = 1
+        for i in range(255):
+            exp[i] = value
+            log[value] = i
+            value <<= 1
+            if value & 0x100:
+                value ^= 0x11D
+        for i in range(255, 512):
+            exp[i] = exp[i - 255]
+        cls._GF_EXP, cls._GF_LOG = exp, log
+
+    @classmethod
+    def _divisor(cls, degree):
+        """Polinômio gerador Reed-Solomon (coeficientes sem o termo de maior grau)"""
+        divisor = cls._DIVISORS.get(degree)
+        if divisor is None:
+            exp, log = cls._GF_EXP, cls._GF_LOG
+            divisor = [0] * (degree - 1) + [1]
+            root = 1
+            for _ in range(degree):
+                for j in range(degree):
+                    divisor[j] = exp[log[divisor[j]] + log[root]] if divisor[j] else 0
+                    if j + 1 < degree:
+                        divisor[j] ^= divisor[j + 1]
+                root = exp[log[root] + 1]
+            cls._DIVISORS[degree] = divisor
+        return divisor
+
+    @classmethod
+    def _remainder(cls, data, divisor):
+        exp, log = cls._GF_EXP, cls._GF_LOG
+        divisor_logs = [log[coef] if coef else None for coef in divisor]
+        result = [0] * len(divisor)
+        for byte in data:
+            factor = byte ^ result.pop(0)
+            result.append(0)
+            if factor:
+                factor_log = log[factor]
+                for i, coef_log in enumerate(divisor_logs):
+                    if coef_log is not None:
+                        result[i] ^= exp[coef_log + factor_log]
+        return result
+
+    def _add_error_correction(self, data):
+        if self._GF_EXP is None:
+            self._init_galois_field()
+
+        num_blocks = self.EC_BLOCKS[self.version]
+        ec_length = self.EC_CODEWORDS_PER_BLOCK[self.version]
+        raw_codewords = self._raw_data_modules(self.version) // 8
+        num_short_blocks = num_blocks - raw_codewords % num_blocks
+        short_block_length = raw_codewords // num_blocks
+        divisor = self._divisor(ec_length)
+
+        # Blocos curtos primeiro; os longos têm um codeword de dados a mais
+        blocks = []
+        offset = 0
+        for i in range(num_blocks):
+            data_length = short_block_length - ec_length + (0 if i < num_short_blocks else 1)
+            block_data = data[offset:offset + data_length]
+            offset += data_length
+            blocks.append((block_data, self._remainder(block_data, divisor)))
+
+        # Intercalar dados e correção entre os blocos
+        result = []
+        for i in range(short_block_length - ec_length + 1):
+            for block_data, _ in blocks:
+                if i < len(block_data):
+                    result.append(block_data[i])
+        for i in range(ec_length):
+            for _, block_ec in blocks:
+                result.append(block_ec[i])
+        return result
+
+    # ---------- Padrões fixos ----------
+
+    def _set_function(self, x, y, dark):
+        self.modules[y][x] = dark
+        self._function[y][x] = True
+
+    def _draw_function_patterns(self):
+        size = self.size
+
+        # Timing
+        for i in range(size):
+            self._set_function(6, i, i % 2 == 0)
+            self._set_function(i, 6, i % 2 == 0)
+
+        # Localizadores (com separadores)
+        for cx, cy in ((3, 3), (size - 4, 3), (3, size - 4)):
+            for dy in range(-4, 5):
+                for dx in range(-4, 5):
+                    x, y = cx + dx, cy + dy
+                    if 0 <= x < size and 0 <= y < size:
+                        distance = max(abs(dx), abs(dy))
+                        self._set_function(x, y, distance not in (2, 4))
+
+        # Alinhamento
+        positions = self._alignment_positions()
+        last = len(positions) - 1
+        for i, cx in enumerate(positions):
+            for j, cy in enumerate(positions):
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue
+                for dy in range(-2, 3):
+                    for dx in range(-2, 3):
+                        self._set_function(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+
+        # Formato (reservado; gravado ao aplicar a máscara) e versão
+        self._draw_format_bits(0)
+        if self.version >= 7:
+            remainder = self.version
+            for _ in range(12):
+                remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+            bits = (self.version << 12) | remainder
+            for i in range(18):
+                dark = (bits >> i) & 1 == 1
+                a, b = size - 11 + i % 3, i // 3
+                self._set_function(a, b, dark)
+                self._set_function(b, a, dark)
+
+    def _alignment_positions(self):
+        if self.version == 1:
+            return []
+        num_align = self.version // 7 + 2
+        step = 26 if self.version == 32 else (self.version * 4 + num_align * 2 + 1) // (num_align * 2 - 2) * 2
+        return [6] + [self.size - 7 - i * step for i in range(num_align - 1)][::-1]
+
+    def _draw_format_bits(self, mask):
+        data = (self.EC_FORMAT_BITS << 3) | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = ((data << 10) | remainder) ^ 0x5412
+        size = self.size
+
+        def bit(i):
+            return (bits >> i) & 1 == 1
+
+        for i in range(6):
+            self._set_function(8, i, bit(i))
+        self._set_function(8, 7, bit(6))
+        self._set_function(8, 8, bit(7))
+        self._set_function(7, 8, bit(8))
+        for i in range(9, 15):
+            self._set_function(14 - i, 8, bit(i))
+        for i in range(8):
+            self._set_function(size - 1 - i, 8, bit(i))
+        for i in range(8, 15):
+            self._set_function(8, size - 15 + i, bit(i))
+        self._set_function(8, size - 8, True)
+
+    # ---------- Dados na matriz ----------
+
+    def _draw_codewords(self, codewords):
+        size = self.size
+        total_bits = len(codewords) * 8
+        i = 0
+        right = size - 1
+        while right >= 1:
+            if right == 6:
+                right = 5
+            upward = (right + 1) & 2 == 0
+            for vert in range(size):
+                y = size - 1 - vert if upward else vert
+                for x in (right, right - 1):
+                    if not self._function[y][x] and i < total_bits:
+                        self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 == 1
+                        i += 1
+            right -= 2
+
+    MASKS = (
+        lambda x, y: (x + y) % 2 == 0,
+        lambda x, y: y % 2 == 0,
+        lambda x, y: x % 3 == 0,
+        lambda x, y: (x + y) % 3 == 0,
+        lambda x, y: (x // 3 + y // 2) % 2 == 0,
+        lambda x, y: x * y % 2 + x * y % 3 == 0,
+        lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+        lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+    )
+
+    _MASK_FLIPS = {}
+
+    def _mask_flips(self):
+        """Por máscara, linhas (inteiros) com os módulos de dados a inverter - cache por versão"""
+        flips = self._MASK_FLIPS.get(self.version)
+        if flips is None:
+            flips = [
+                [
+                    int(''.join(
+                        '1' if not function and predicate(x, y) else '0'
+                        for x, function in enumerate(function_row)
+                    ), 2)
+                    for y, function_row in enumerate(self._function)
+                ]
+                for predicate in self.MASKS
+            ]
+            self._MASK_FLIPS[self.version] = flips
+        return flips
+
+    @staticmethod
+    def _row_int(row):
+        return int(''.join('1' if module else '0' for module in row), 2)
+
+    _RUNS = re.compile(r'0{5,}|1{5,}')
+    _FINDER_LIKE = re.compile(r'(?=(10111010000|00001011101))')
+
+    @classmethod
+    def _penalty(cls, rows, size):
+        """Penalidade da máscara (linhas como inteiros, bit mais alto = coluna 0)"""
+        lines = [format(row, f'0{size}b') for row in rows]
+        columns = [''.join(column) for column in zip(*lines)]
+        penalty = 0
+
+        for line in lines + columns:
+            # Sequências de 5+ módulos da mesma cor
+            for run in cls._RUNS.findall(line):
+                penalty += len(run) - 2
+            # Padrões parecidos com localizadores (borda conta como claro)
+            penalty += 40 * len(cls._FINDER_LIKE.findall('0000' + line + '0000'))
+
+        # Blocos 2x2 da mesma cor
+        inner = (1 << (size - 1)) - 1
+        for upper, lower in zip(rows, rows[1:]):
+            same_vertical = ~(upper ^ lower)
+            same_horizontal = ~(upper ^ (upper >> 1))
+            penalty += 3 * bin(same_vertical & (same_vertical >> 1) & same_horizontal & inner).count('1')
+
+        # Proporção de módulos escuros
+        dark = sum(bin(row).count('1') for row in rows)
+        total = size * size
+        penalty += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+        return penalty
+
+    def _apply_best_mask(self):
+        size = self.size
+        flips = self._mask_flips()
+        base = [self._row_int(row) for row in self.modules]
+        # Linhas que contêm bits de formato (mudam com a máscara)
+        format_rows = list(range(9)) + list(range(size - 8, size))
+
+        best_mask, best_rows, best_penalty = None, None, None
+        for mask in range(8):
+            self._draw_format_bits(mask)
+            for y in format_rows:
+                base[y] = self._row_int(self.modules[y])
+            rows = [row ^ flip for row, flip in zip(base, flips[mask])]
+            penalty = self._penalty(rows, size)
+            if best_penalty is None or penalty < best_penalty:
+                best_mask, best_rows, best_penalty = mask, rows, penalty
+
+        self.modules = [[(row >> (size - 1 - x)) & 1 == 1 for x in range(size)] for row in best_rows]
+        return best_mask
+
+    # ---------- Renderização ----------
+
+    def svg(self, module_size=1):
+        """SVG com um único path (módulos escuros agrupados por linha)"""
+        border = self.QUIET_ZONE
+        dimension = self.size + 2 * border
+        path = []
+        for y, row in enumerate(self.modules):
+            x = 0
+            while x < self.size:
+                if row[x]:
+                    start = x
+                    while x < self.size and row[x]:
+                        x += 1
+                    path.append(f'M{start + border} {y + border}h{x - start}v1h-{x - start}z')
+                else:
+                    x += 1
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {dimension} {dimension}" '
+            f'width="{dimension * module_size}" height="{dimension * module_size}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="#fff"/><path d="{"".join(path)}" fill="#000"/></svg>'
+        )
+
+    def png(self, module_size=4):
+        """PNG em tons de cinza de 1 bit"""
+        border = self.QUIET_ZONE
+        dimension = (self.size + 2 * border) * module_size
+        blank_row = b'\x00' + b'\xff' * ((dimension + 7) // 8)
+
+        raw = bytearray(blank_row * (border * module_size))
+        for row in self.modules:
+            # 1 = claro; cada módulo vira `module_size` pixels
+            line = '1' * border + ''.join('0' if module else '1' for module in row) + '1' * border
+            pixels = ''.join(value * module_size for value in line)
+            pixels += '1' * (-len(pixels) % 8)
+            raw += (b'\x00' + int(pixels, 2).to_bytes(len(pixels) // 8, 'big')) * module_size
+        raw += blank_row * (border * module_size)
+
+        def chunk(kind, data):
+            return (len(data).to_bytes(4, 'big') + kind + data +
+                    zlib.crc32(kind + data).to_bytes(4, 'big'))
+
+        header = dimension.to_bytes(4, 'big') * 2 + bytes([1, 0, 0, 0, 0])
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+                chunk(b'IDAT', zlib.compress(bytes(raw), 6)) + chunk(b'IEND', b''))
+
+    def data_uri(self, image_format='png'):
+        """Imagem inline para <img src> (PNG é bem menor que o SVG equivalente)"""
+        if image_format == 'svg':
+            return 'data:image/svg+xml;base64,' + base64.b64encode(self.svg().encode('utf-8')).decode('ascii')
+        return 'data:image/png;base64,' + base64.b64encode(self.png()).decode('ascii')
+
+
+def pix_qr_data_uri(payload):
+    """QR Code do PIX copia-e-cola como data URI PNG (None se não for possível gerar)"""
+    if not payload:
+        return None
+    try:
+        return PixQRCode(payload).data_uri()
+    except Exception as e:
+        logger.warning(f"⚠️ Falha ao gerar QR Code local: {str(e)}")
+        return None
+
+
 class Safe2PayAPI:
     def __init__(self):
         self.token = os.getenv('SAFE2PAY_TOKEN')
@@ -302,10 +2566,20 @@ class Safe2PayAPI:
             cep_raw = str(dados_checkout.get('cep', ''))
             cep = cep_raw.replace('-', '').replace(' ', '').strip()
 
-            logger.info(f"📋 Reutilizando dados validados:")
-            logger.info(f"   CPF: {cpf_raw} → {cpf}")
-            logger.info(f"   Nome: {dados_checkout.get('nome_completo', 'N/A')}")
-            logger.info(f"   Protocolo: {protocolo}")
+            # Cobrança pendente do mesmo protocolo: reaproveitar em vez de criar outra
+            try:
+                cobranca = pix_charge_index.get_live(protocolo, product['code'])
+            except Exception as e:
+                logger.warning(f"⚠️ Índice de cobranças indisponível, criando nova cobrança: {str(e)}")
+                cobranca = None
+            if cobranca:
+                logger.info(f"♻️ PIX pendente reaproveitado para o protocolo {protocolo}: {cobranca['transactionId']}")
+                return {'sucesso': True, 'dados': cobranca}
+
+            logger.debug(
+                "📋 Reutilizando dados validados: CPF %s, nome %s, protocolo %s",
+                mask_cpf(cpf), mask_name(dados_checkout.get('nome_completo')), protocolo
+            )
 
             # PIX DINÂMICO: Mesmo formato do lambda_handler.py
             payment_data = {
@@ -349,7 +2623,7 @@ class Safe2PayAPI:
             full_url = f"{self.api_url}/Payment"
 
             # Criar PIX Dinâmico
-            response = requests.post(
+            response = upstream_http.post(
                 full_url,
                 json=payment_data,
                 headers=headers,
@@ -371,34 +2645,32 @@ class Safe2PayAPI:
                     }
 
                 response_detail = result.get('ResponseDetail', {})
-                payment_object = response_detail.get('PaymentObject', {})
-
-                # LOG DETALHADO: Ver EXATAMENTE o que a Safe2Pay retornou
-                logger.info("=" * 60)
-                logger.info("📋 RESPOSTA COMPLETA DA SAFE2PAY:")
-                logger.info(f"   HasError: {result.get('HasError')}")
-                logger.info(f"   ResponseDetail keys: {list(response_detail.keys())}")
-                logger.info(f"   PaymentObject keys: {list(payment_object.keys())}")
-                logger.info(f"   PaymentObject.Key: {payment_object.get('Key', 'VAZIO')}")
-                logger.info(f"   PaymentObject.QrCode: {payment_object.get('QrCode', 'VAZIO')[:50]}...")
-                logger.info("=" * 60)
-
-                logger.info(f"✅ PIX Dinâmico criado com sucesso!")
-                logger.info(f"   Transaction ID: {response_detail.get('IdTransaction')}")
-                logger.info(f"   Cliente: {dados_checkout.get('nome_completo')}")
+
+                # Resposta completa só por amostragem (mascarada, formatada fora da requisição)
+                log_payload("📋 Resposta Safe2Pay /Payment", result)
+                logger.info(f"✅ PIX Dinâmico criado com sucesso! Transaction ID: {response_detail.get('IdTransaction')}")
+
+                dados = {
+                    'transactionId': str(response_detail.get('IdTransaction')),
+                    'qrCode': response_detail.get('Key', ''),  # ← CORRIGIDO: está em ResponseDetail
+                    'qrCodeImage': response_detail.get('QrCode', ''),  # ← CORRIGIDO
+                    # QR Code gerado aqui: o navegador não precisa buscar a imagem da Safe2Pay
+                    'qrCodeDataUri': pix_qr_data_uri(response_detail.get('Key', '')),
+                    'pixCopiaECola': response_detail.get('Key', ''),  # ← CORRIGIDO
+                    'valor': product['price'],
+                    'status': 'pending',
+                    'reference': str(protocolo),
+                    'expiresAt': (datetime.now() + timedelta(minutes=self.pix_expiration)).isoformat()
+                }
+
+                try:
+                    pix_charge_index.record(protocolo, product['code'], dados, ttl=self.pix_expiration * 60)
+                except Exception as e:
+                    logger.warning(f"⚠️ Não foi possível indexar a cobrança {dados['transactionId']}: {str(e)}")
 
                 return {
                     'sucesso': True,
-                    'dados': {
-                        'transactionId': str(response_detail.get('IdTransaction')),
-                        'qrCode': response_detail.get('Key', ''),  # ← CORRIGIDO: está em ResponseDetail
-                        'qrCodeImage': response_detail.get('QrCode', ''),  # ← CORRIGIDO
-                        'pixCopiaECola': response_detail.get('Key', ''),  # ← CORRIGIDO
-                        'valor': product['price'],
-                        'status': 'pending',
-                        'reference': str(protocolo),
-                        'expiresAt': (datetime.now() + timedelta(minutes=30)).isoformat()
-                    }
+                    'dados': dados
                 }
             else:
                 error_msg = f'HTTP {response.status_code}'
@@ -448,6 +2720,38 @@ class Safe2PayAPI:
                 'erro': 'Transaction ID inválido'
             }
 
+        # Primeiro, verificar status gravados pelos webhooks (evita chamada ao Safe2Pay)
+        try:
+            cached_data = payment_status_store.get(transaction_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Store de status indisponível, consultando Safe2Pay: {str(e)}")
+            cached_data = None
+
+        if cached_data:
+            status_name = (cached_data.get('TransactionStatus') or {}).get('Name')
+            resultado = {
+                'sucesso': True,
+                'status': status_name.lower() if status_name else cached_data.get('status'),
+                'statusCode': cached_data.get('status'),
+                'statusMessage': status_name,
+                'dados': cached_data
+            }
+            # Link de upload gerado pelo webhook de aprovação (dispensa a chamada Hope no frontend)
+            if str(cached_data.get('status')) == '3' and cached_data.get('Reference'):
+                upload_url = post_approval.upload_url(cached_data['Reference'])
+                if upload_url:
+                    resultado['uploadUrl'] = upload_url
+            return resultado
+
+        # Webhook ainda não chegou: consultar Safe2Pay (micro-cache + coalescência)
+        return transaction_status_cache.get_or_load(
+            str(transaction_id),
+            lambda: self._fetch_transaction_status(transaction_id),
+            cacheable=lambda resultado: resultado.get('sucesso')
+        )
+
+    def _fetch_transaction_status(self, transaction_id):
+        """Consulta /transaction/get no Safe2Pay"""
         try:
             headers = {
                 'X-API-KEY': self.token
@@ -457,7 +2761,7 @@ class Safe2PayAPI:
 
             # Endpoint correto para consultar status usa api.safe2pay.com.br (não payment.safe2pay.com.br)
             api_query_url = "https://api.safe2pay.com.br/v2"
-            response = requests.get(
+            response = upstream_http.get(
                 f"{api_query_url}/transaction/get",
                 params={'id': transaction_id},
                 headers=headers,
@@ -499,7 +2803,7 @@ class Safe2PayAPI:
         """Testa conexão com Safe2Pay"""
         try:
             headers = {'X-API-KEY': self.token}
-            response = requests.get(
+            response = upstream_http.get(
                 f"{self.api_url}/MerchantInfo",
                 headers=headers,
                 timeout=10
@@ -509,6 +2813,184 @@ class Safe2PayAPI:
             return False
 
 
+class SafewebTokenManager:
+    """
+    Token JWT da Safeweb com renovação única (single-flight) e antecipada.
+
+    - Apenas uma renovação roda por vez; as demais threads aguardam o resultado
+    - A partir de `expiraEm - margin - renew_ahead` o token é renovado em
+      background, então requisições em regime normal não esperam autenticação
+    - Para tokens curtos, `renew_ahead` é limitado a uma fração da validade e
+      a próxima renovação nunca ocorre antes de `min_renewal_delay`
+    """
+
+    def __init__(self, fetch_token, margin=120, renew_ahead=300, schedule_renewal=True, stale_after=35,
+                 renew_ahead_fraction=0.25, min_renewal_delay=30):
+        """
+        Args:
+            fetch_token: Função que autentica e retorna (token, expira_em_epoch)
+            margin: Segundos antes de expiraEm em que o token deixa de ser usado
+            renew_ahead: Segundos antes do fim da validade em que a renovação em background começa
+            schedule_renewal: Agenda um timer para renovar sem depender de tráfego
+            stale_after: Segundos após os quais uma renovação em andamento é considerada travada
+            renew_ahead_fraction: Fração máxima da validade do token usada como renew_ahead
+            min_renewal_delay: Intervalo mínimo (segundos) entre uma autenticação e a renovação seguinte
+        """
+        self._fetch_token = fetch_token
+        self.margin = margin
+        self.renew_ahead = renew_ahead
+        self.schedule_renewal = schedule_renewal
+        self.stale_after = stale_after
+        self.renew_ahead_fraction = renew_ahead_fraction
+        self.min_renewal_delay = min_renewal_delay
+
+        self.token = None
+        self.expiry = None
+        self.renew_at = None
+
+        self._cond = threading.Condition()
+        self._refreshing = False
+        self._refresh_started = 0
+        self._generation = 0
+        self._last_error = None
+        self._timer = None
+
+        # Métricas
+        self.auth_count = 0
+        self.auth_avoided = 0
+        self.auth_waits = 0
+        self.background_refreshes = 0
+
+    def _valid_token(self, now):
+        token, expiry = self.token, self.expiry
+        if token and expiry and now < expiry - self.margin:
+            return token
+        return None
+
+    def get_token(self):
+        """Retorna um token válido, autenticando apenas se não houver nenhum utilizável"""
+        now = time.time()
+        token = self._valid_token(now)
+        if token:
+            self.auth_avoided += 1
+            if now >= self.renew_at:
+                self.refresh_in_background()
+            return token
+
+        return self._timed_refresh()
+
+    def refresh(self):
+        """Força uma nova autenticação (compartilhada com chamadas concorrentes)"""
+        with self._cond:
+            self.token = None
+        return self._timed_refresh()
+
+    def _timed_refresh(self):
+        started = time.perf_counter()
+        try:
+            return self._refresh_blocking()
+        finally:
+            record_timing('token', time.perf_counter() - started, 'Safeweb token')
+
+    def _refresh_blocking(self):
+        with self._cond:
+            token = self._valid_token(time.time())
+            if token:
+                self.auth_avoided += 1
+                return token
+
+            if self._refreshing and time.time() - self._refresh_started < self.stale_after:
+                # Outra thread já está autenticando: aguardar o resultado dela
+                self.auth_waits += 1
+                generation = self._generation
+                while self._refreshing and self._generation == generation:
+                    remaining = self.stale_after - (time.time() - self._refresh_started)
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+
+                token = self._valid_token(time.time())
+                if token:
+                    return token
+                if self._generation != generation and self._last_error:
+                    raise self._last_error
+
+            self._refreshing = True
+            self._refresh_started = time.time()
+
+        return self._run_refresh()
+
+    def refresh_in_background(self):
+        """Dispara a renovação em uma thread, se nenhuma estiver em andamento"""
+        with self._cond:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._refresh_started = time.time()
+
+        self.background_refreshes += 1
+        threading.Thread(target=self._background_refresh, name='safeweb-token-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self._run_refresh()
+        except Exception as e:
+            logger.warning(f'⚠️ Safeweb: Renovação antecipada do token falhou: {str(e)}')
+
+    def _renewal_time(self, expiry):
+        """Instante da próxima renovação antecipada para um token que expira em `expiry`"""
+        now = time.time()
+        renew_ahead = min(self.renew_ahead, max(0, expiry - now) * self.renew_ahead_fraction)
+        # Nunca renovar em sequência: um token de vida curta renovaria em loop
+        return max(expiry - self.margin - renew_ahead, now + self.min_renewal_delay)
+
+    def _run_refresh(self):
+        token, expiry, error = None, None, None
+        try:
+            token, expiry = self._fetch_token()
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            if error is None:
+                self.token = token
+                self.expiry = expiry
+                self.renew_at = self._renewal_time(expiry)
+                self.auth_count += 1
+                self._last_error = None
+            else:
+                self._last_error = error
+            self._refreshing = False
+            self._generation += 1
+            self._cond.notify_all()
+
+        if error is not None:
+            raise error
+
+        self._schedule_next_renewal()
+        return token
+
+    def _schedule_next_renewal(self):
+        if not self.schedule_renewal or not self.renew_at:
+            return
+
+        delay = max(0, self.renew_at - time.time())
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stats(self):
+        return {
+            'authentications': self.auth_count,
+            'authentications_avoided': self.auth_avoided,
+            'waited_on_refresh': self.auth_waits,
+            'background_refreshes': self.background_refreshes,
+            'expires_in': int(self.expiry - time.time()) if self.expiry else None
+        }
+
+
 class SafewebAPI:
     """Cliente para integração com API Safeweb"""
 
@@ -521,9 +3003,8 @@ class SafewebAPI:
         self.codigo_parceiro = os.getenv('SAFEWEB_CODIGO_PARCEIRO')
         self.produto_ecpf_a1 = os.getenv('SAFEWEB_PRODUTO_ECPF_A1')
 
-        # Cache de token JWT
-        self.token = None
-        self.token_expiry = None
+        # Token JWT compartilhado entre threads (renovação única e antecipada)
+        self.token_manager = SafewebTokenManager(self._fetch_token)
 
         if self.username and self.password:
             logger.info(f"🔑 Safeweb configurado: {self.username[:20]}...")
@@ -536,15 +3017,23 @@ class SafewebAPI:
             return cpf
         return f"{cpf[:3]}.***.*{cpf[-2:]}"
 
-    def authenticate(self):
-        """Autentica na API Safeweb e obtém token JWT"""
+    @property
+    def token(self):
+        return self.token_manager.token
+
+    @property
+    def token_expiry(self):
+        return self.token_manager.expiry
+
+    def _fetch_token(self):
+        """Autentica na API Safeweb e retorna (token JWT, expiraEm)"""
         try:
             import base64
             logger.info('🔐 Safeweb: Autenticando...')
 
             credenciais = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
 
-            response = requests.post(
+            response = upstream_http.post(
                 self.auth_url,
                 headers={
                     'Authorization': f'Basic {credenciais}',
@@ -557,33 +3046,33 @@ class SafewebAPI:
                 raise Exception(f"Erro de autenticação: {response.status_code}")
 
             data = response.json()
-            self.token = data.get('tokenAcesso')
-            self.token_expiry = data.get('expiraEm')
 
             logger.info('✅ Safeweb: Autenticação bem-sucedida')
-            return self.token
+            return data.get('tokenAcesso'), data.get('expiraEm')
 
         except Exception as e:
             logger.error(f'❌ Safeweb: Erro na autenticação: {str(e)}')
             raise
 
+    def authenticate(self):
+        """Autentica na API Safeweb e obtém token JWT"""
+        return self.token_manager.refresh()
+
     def ensure_valid_token(self):
         """Garante que temos um token válido"""
-        import time
-
-        # Se não tem token, autentica
-        if not self.token or not self.token_expiry:
-            return self.authenticate()
-
-        # Verifica se token ainda é válido (com margem de 2 minutos)
-        agora = int(time.time())
-        if agora >= self.token_expiry - 120:
-            return self.authenticate()
-
-        return self.token
+        return self.token_manager.get_token()
 
     def verificar_biometria(self, cpf):
-        """Verifica se CPF possui biometria cadastrada"""
+        """Verifica se CPF possui biometria cadastrada (resultado em cache por CPF)"""
+        cpf_limpo = re.sub(r'\D', '', cpf or '')
+        return safeweb_lookup_cache.get_or_load(
+            ('biometria', cpf_limpo),
+            lambda: self._fetch_biometria(cpf),
+            classify_biometria_result
+        )
+
+    def _fetch_biometria(self, cpf):
+        """Consulta a biometria na Safeweb (sem cache)"""
         try:
             cpf_limpo = re.sub(r'\D', '', cpf)
 
@@ -597,7 +3086,7 @@ class SafewebAPI:
 
             token = self.ensure_valid_token()
 
-            response = requests.get(
+            response = upstream_http.get(
                 f"{self.base_url}/Service/Microservice/Shared/Partner/api/ValidateBiometry/{cpf_limpo}",
                 headers={
                     'Authorization': token,
@@ -628,7 +3117,19 @@ class SafewebAPI:
             }
 
     def consultar_cpf(self, cpf, data_nascimento):
-        """Consulta CPF na Receita Federal"""
+        """Consulta CPF na Receita Federal (resultado em cache por CPF + nascimento)"""
+        cpf_limpo = re.sub(r'\D', '', cpf or '')
+        resultado = safeweb_lookup_cache.get_or_load(
+            ('consulta', cpf_limpo, str(data_nascimento or '')),
+            lambda: self._fetch_consulta_cpf(cpf, data_nascimento),
+            classify_consulta_result
+        )
+        if 'codigo' in resultado:
+            resultado['cpf'] = cpf_limpo
+        return resultado
+
+    def _fetch_consulta_cpf(self, cpf, data_nascimento):
+        """Consulta o CPF na RFB via Safeweb (sem cache)"""
         try:
             cpf_limpo = re.sub(r'\D', '', cpf)
 
@@ -642,7 +3143,7 @@ class SafewebAPI:
                 "DtNascimento": data_nascimento
             }
 
-            response = requests.post(
+            response = upstream_http.post(
                 f"{self.base_url}/Service/Microservice/Shared/ConsultaPrevia/api/RealizarConsultaPrevia",
                 json=payload,
                 headers={
@@ -739,7 +3240,7 @@ class SafewebAPI:
 
             logger.info(f'📤 Safeweb: Enviando protocolo para CPF: {self._mask_cpf(payload["CPF"])}')
 
-            response = requests.post(
+            response = upstream_http.post(
                 f"{self.base_url}/Service/Microservice/Shared/Partner/api/Add/3",
                 json=payload,
                 headers={
@@ -749,50 +3250,920 @@ class SafewebAPI:
                 timeout=30
             )
 
-            if response.status_code != 200:
-                error_text = response.text[:200]
-                logger.error(f'❌ Safeweb: Erro HTTP {response.status_code}: {error_text}')
-                raise Exception(f'Erro ao gerar protocolo: {response.status_code}')
+            if response.status_code != 200:
+                error_text = response.text[:200]
+                logger.error(f'❌ Safeweb: Erro HTTP {response.status_code}: {error_text}')
+                raise Exception(f'Erro ao gerar protocolo: {response.status_code}')
+
+            protocolo = response.json()
+
+            logger.info(f'✅ Safeweb: Protocolo gerado com sucesso: {protocolo}')
+
+            return {
+                'sucesso': True,
+                'protocolo': protocolo,
+                'mensagem': 'Protocolo gerado com sucesso'
+            }
+
+        except Exception as e:
+            logger.error(f'❌ Safeweb: Erro ao gerar protocolo: {str(e)}')
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+    def liberar_pagamento(self, protocol):
+        """Libera pagamento na Safeweb - UpdateLiberacao"""
+        try:
+            token = self.ensure_valid_token()
+            if not token:
+                return {
+                    'sucesso': False,
+                    'erro': 'Erro ao autenticar com Safeweb'
+                }
+
+            url = f"{self.base_url}/Service/Microservice/Shared/Partner/api/UpdateLiberacao"
+
+            headers = {
+                'Authorization': f'bearer {token}',
+                'Content-Type': 'application/json'
+            }
+
+            payload = {
+                'Protocolo': protocol,
+                'CNPJ': self.cnpj_ar
+            }
+
+            logger.info(f"💳 Liberando pagamento na Safeweb para protocolo: {protocol}")
+            response = upstream_http.post(url, headers=headers, json=payload, timeout=30)
+
+            if response.status_code == 200:
+                result = response.json()
+                if result == True or result == "true":
+                    logger.info(f"✅ Pagamento liberado com sucesso na Safeweb")
+                    return {'sucesso': True}
+                logger.error(f"❌ Safeweb retornou false para liberação de pagamento")
+                return {'sucesso': False, 'erro': 'Safeweb não aceitou a liberação'}
+
+            error_msg = f"HTTP {response.status_code}: {response.text}"
+            logger.error(f"❌ Erro ao liberar pagamento: {error_msg}")
+            return {
+                'sucesso': False,
+                'erro': error_msg
+            }
+
+        except Exception as e:
+            logger.error(f"❌ Erro em liberar_pagamento: {str(e)}")
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+    def criar_solicitacao_hope(self, protocol):
+        """Cria solicitação Hope para upload de documentos"""
+        try:
+            logger.info(f"📋 Criando solicitação Hope para protocolo: {protocol}")
+
+            token = self.ensure_valid_token()
+            if not token:
+                return {
+                    'sucesso': False,
+                    'erro': 'Erro ao autenticar com Safeweb'
+                }
+
+            hope_url = os.getenv('SAFEWEB_HOPE_API_URL')
+            attendance_place_id = int(os.getenv('SAFEWEB_ATTENDANCE_PLACE_ID', '348'))
+
+            headers = {
+                'Authorization': f'bearer {token}',
+                'Content-Type': 'application/json'
+            }
+
+            payload = {
+                'protocol': protocol,
+                'attendancePlaceId': attendance_place_id,
+                'aciRemovalCandidate': False
+            }
+
+            logger.info(f"🔄 Chamando Hope API: {hope_url}")
+            response = upstream_http.post(hope_url, headers=headers, json=payload, timeout=30)
+
+            if response.status_code == 200:
+                result = response.json()
+                logger.info(f"✅ Solicitação Hope criada com sucesso")
+                logger.info(f"📎 URL de upload: {result.get('url')}")
+
+                return {
+                    'sucesso': True,
+                    'uploadUrl': result.get('url'),
+                    'emailEnviado': result.get('emailSend', False)
+                }
+
+            logger.error(f"❌ Erro na API Hope: Status {response.status_code}")
+            logger.error(f"   Resposta: {response.text}")
+            return {
+                'sucesso': False,
+                'erro': f'Erro na API Hope: {response.text}'
+            }
+
+        except Exception as e:
+            logger.error(f"❌ Erro em criar_solicitacao_hope: {str(e)}", exc_info=True)
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+
+class PaymentStatusNotifier:
+    """
+    Espera (long-poll) por mudanças de status de pagamento - substitui o
+    polling de 1 segundo do Step 5. Os status ficam no PaymentStatusStore;
+    aqui só se acorda quem está aguardando.
+    """
+
+    def __init__(self, store, max_waiters=max(1, API_WORKERS // 2), recheck_interval=1.0):
+        """
+        Args:
+            store: PaymentStatusStore com os status gravados pelo webhook
+            max_waiters: Máximo de requisições aguardando ao mesmo tempo
+                (cada uma ocupa um worker do servidor)
+            recheck_interval: Releitura periódica do store (webhook recebido
+                por outro processo que compartilha o backend)
+        """
+        self.store = store
+        self.recheck_interval = recheck_interval
+        self._cond = threading.Condition()
+        self._waiters = threading.BoundedSemaphore(max_waiters)
+
+    def publish(self, transaction_id, status_id, status_code=None, status_name=None, **extra):
+        """Grava um novo status e acorda as requisições aguardando"""
+        data = self.store.record(transaction_id, status_id, status_code, status_name, **extra)
+        with self._cond:
+            self._cond.notify_all()
+        return data
+
+    def wait_for_change(self, transaction_id, since, timeout):
+        """
+        Aguarda até o status da transação ser diferente de `since`
+
+        Returns:
+            dict gravado pelo webhook, ou None se o tempo esgotar (ou se já
+            houver requisições demais aguardando)
+        """
+        if not self._waiters.acquire(blocking=False):
+            return None
+
+        try:
+            deadline = time.time() + timeout
+            while True:
+                data = self.store.get(transaction_id)
+                if data and str(data.get('status')) != str(since):
+                    return data
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                with self._cond:
+                    self._cond.wait(min(remaining, self.recheck_interval))
+        finally:
+            self._waiters.release()
+
+
+# Status recebidos via webhook (alimenta o long-poll /api/pix/wait/<id>)
+payment_notifier = PaymentStatusNotifier(payment_status_store)
+
+
+class SQLiteWebhookQueue:
+    """
+    Fila durável de webhooks em SQLite - substituto local do SQS
+
+    Cada evento recebido é gravado antes da resposta ao Safe2Pay. O worker
+    retira lotes com uma "lease" (o evento volta à fila se o processo morrer
+    no meio), confirma os processados e reagenda os que falharam com backoff
+    exponencial. Depois de `max_attempts` o evento fica marcado como morto.
+    """
+
+    def __init__(self, path, max_attempts=WEBHOOK_MAX_ATTEMPTS, lease_seconds=60):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS webhook_events ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, '
+            'created_at REAL NOT NULL, last_error TEXT, dead INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS webhook_events_ready ON webhook_events (dead, available_at)'
+        )
+
+    def enqueue(self, payload):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO webhook_events (payload, available_at, created_at) VALUES (?, ?, ?)',
+                (json.dumps(payload), now, now)
+            )
+            return cursor.lastrowid
+
+    def receive(self, max_messages):
+        """Retira até `max_messages` eventos prontos, reservando-os por `lease_seconds`"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    'SELECT id, payload, attempts, created_at FROM webhook_events '
+                    'WHERE dead = 0 AND available_at <= ? ORDER BY id LIMIT ?',
+                    (now, max_messages)
+                ).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        'UPDATE webhook_events SET attempts = attempts + 1, available_at = ? WHERE id = ?',
+                        [(now + self.lease_seconds, row[0]) for row in rows]
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [
+            {'id': row[0], 'payload': json.loads(row[1]), 'attempts': row[2] + 1, 'received_at': row[3]}
+            for row in rows
+        ]
+
+    def ack(self, event_ids):
+        if not event_ids:
+            return
+        with self._lock:
+            self._conn.executemany('DELETE FROM webhook_events WHERE id = ?', [(event_id,) for event_id in event_ids])
+
+    def retry(self, event, error):
+        """Reagenda o evento com backoff (2, 4, 8... até 300s) ou o marca como morto"""
+        dead = event['attempts'] >= self.max_attempts
+        delay = min(2 ** event['attempts'], 300)
+        with self._lock:
+            self._conn.execute(
+                'UPDATE webhook_events SET available_at = ?, last_error = ?, dead = ? WHERE id = ?',
+                (time.time() + delay, str(error)[:500], 1 if dead else 0, event['id'])
+            )
+        return dead
+
+    def stats(self):
+        with self._lock:
+            pending, dead = self._conn.execute(
+                'SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0) FROM webhook_events'
+            ).fetchone()
+        return {'queued': pending, 'dead_letters': dead}
+
+
+class QueueWorker:
+    """Threads que processam uma fila durável (webhooks, outbox) em lotes, com retentativas"""
+
+    def __init__(self, name, queue, process, batch_size=WEBHOOK_BATCH_SIZE, threads=1, poll_interval=1.0):
+        """
+        Args:
+            name: Nome da fila (logs e nome das threads)
+            queue: Fila com receive/ack/retry/stats (SQLiteWebhookQueue, SQLiteOutbox)
+            process: Função (payload, recebido_em) que processa um evento (exceção = retentar)
+            batch_size: Eventos retirados por vez
+            threads: Threads consumindo a fila (a lease evita processamento duplicado)
+            poll_interval: Releitura da fila sem aviso (eventos gravados por outro processo ou reagendados)
+        """
+        self.name = name
+        self.queue = queue
+        self.process = process
+        self.batch_size = batch_size
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'processed': 0, 'retried': 0, 'dead': 0, 'batches': 0}
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                for index in range(self.threads):
+                    self._thread = threading.Thread(target=self._run, name=f'{self.name}-worker-{index}', daemon=True)
+                    self._thread.start()
+
+    def notify(self):
+        """Acorda o worker (evento novo gravado por este processo)"""
+        self._wake.set()
+
+    def run_once(self):
+        """Processa um lote; retorna o número de eventos retirados da fila"""
+        batch = self.queue.receive(self.batch_size)
+        if not batch:
+            return 0
+
+        done = []
+        retried = dead = 0
+        for event in batch:
+            try:
+                self.process(event['payload'], event['received_at'])
+                done.append(event['id'])
+            except Exception as e:
+                if self.queue.retry(event, e):
+                    dead += 1
+                    logger.error(f"💀 {self.name} {event['id']} descartado após {event['attempts']} tentativas: {str(e)}")
+                else:
+                    retried += 1
+                    logger.warning(f"🔁 {self.name} {event['id']} falhou (tentativa {event['attempts']}): {str(e)}")
+
+        self.queue.ack(done)
+        with self._stats_lock:
+            self._stats['processed'] += len(done)
+            self._stats['retried'] += retried
+            self._stats['dead'] += dead
+            self._stats['batches'] += 1
+        return len(batch)
+
+    def _run(self):
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                logger.error(f"❌ Erro no worker {self.name}: {str(e)}", exc_info=True)
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            return {**self._stats, **self.queue.stats(), 'running': self._thread is not None}
+
+
+class SQLiteOutbox:
+    """
+    Outbox durável dos efeitos colaterais (liberação Safeweb, solicitação Hope, ...)
+
+    Cada efeito é gravado uma vez por (tipo, chave) com estado próprio:
+    pending → done, ou dead depois de `max_attempts` falhas. Os workers
+    retiram efeitos com lease e reagendam as falhas com backoff exponencial;
+    nada depende da requisição que originou o efeito.
+    """
+
+    def __init__(self, path, max_attempts=OUTBOX_MAX_ATTEMPTS, lease_seconds=120, done_ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.done_ttl = done_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, dedupe_key TEXT NOT NULL, '
+            'payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT \'pending\', '
+            'attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, last_error TEXT, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL, UNIQUE (kind, dedupe_key))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_ready ON outbox (state, available_at)')
+
+    def add(self, kind, key, payload, revive_done=False):
+        """
+        Grava o efeito (uma vez por tipo + chave)
+
+        Um efeito morto com a mesma chave volta para a fila com as tentativas
+        zeradas (novo webhook ou ação do usuário); pendentes ficam como estão,
+        e concluídos também, a menos que `revive_done` (o resultado gravado
+        do efeito se perdeu, p.ex. backend em memória após um restart).
+
+        Returns:
+            True se o efeito foi gravado ou reativado
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO outbox (kind, dedupe_key, payload, available_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, str(key), json.dumps(payload), now, now, now)
+            )
+            if cursor.rowcount:
+                return True
+            cursor = self._conn.execute(
+                'UPDATE outbox SET state = \'pending\', attempts = 0, available_at = ?, updated_at = ? '
+                'WHERE kind = ? AND dedupe_key = ? AND (state = \'dead\' OR (? AND state = \'done\'))',
+                (now, now, kind, str(key), int(revive_done))
+            )
+            return cursor.rowcount > 0
+
+    def receive(self, max_messages):
+        """Retira até `max_messages` efeitos prontos, reservando-os por `lease_seconds`"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    'SELECT id, kind, dedupe_key, payload, attempts, created_at FROM outbox '
+                    'WHERE state = \'pending\' AND available_at <= ? ORDER BY id LIMIT ?',
+                    (now, max_messages)
+                ).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        'UPDATE outbox SET attempts = attempts + 1, available_at = ?, updated_at = ? WHERE id = ?',
+                        [(now + self.lease_seconds, now, row[0]) for row in rows]
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [
+            {
+                'id': row[0],
+                'payload': {'kind': row[1], 'key': row[2], **json.loads(row[3])},
+                'attempts': row[4] + 1,
+                'received_at': row[5]
+            }
+            for row in rows
+        ]
+
+    def ack(self, event_ids):
+        """Marca os efeitos como concluídos (e apaga concluídos antigos)"""
+        if not event_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE outbox SET state = \'done\', last_error = NULL, updated_at = ? WHERE id = ?',
+                [(now, event_id) for event_id in event_ids]
+            )
+            self._conn.execute(
+                'DELETE FROM outbox WHERE state = \'done\' AND updated_at < ?', (now - self.done_ttl,)
+            )
+
+    def retry(self, event, error):
+        """Reagenda o efeito com backoff (2, 4, 8... até 600s) ou o marca como morto"""
+        dead = event['attempts'] >= self.max_attempts
+        delay = min(2 ** event['attempts'], 600)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'UPDATE outbox SET state = ?, available_at = ?, last_error = ?, updated_at = ? WHERE id = ?',
+                ('dead' if dead else 'pending', now + delay, str(error)[:500], now, event['id'])
+            )
+        return dead
+
+    def stats(self):
+        """Contagem por tipo e estado + idade do pendente mais antigo (sem payloads)"""
+        with self._lock:
+            rows = self._conn.execute('SELECT kind, state, COUNT(*) FROM outbox GROUP BY kind, state').fetchall()
+            oldest = self._conn.execute(
+                'SELECT MIN(created_at) FROM outbox WHERE state = \'pending\''
+            ).fetchone()[0]
+        by_kind = {}
+        for kind, state, count in rows:
+            by_kind.setdefault(kind, {'pending': 0, 'done': 0, 'dead': 0})[state] = count
+        return {
+            'queued': sum(counts['pending'] for counts in by_kind.values()),
+            'dead_letters': sum(counts['dead'] for counts in by_kind.values()),
+            'by_kind': by_kind,
+            'oldest_pending_seconds': round(time.time() - oldest, 1) if oldest else None
+        }
+
+
+def extract_safe2pay_notification(data):
+    """Retorna o payload da notificação (formato direto ou NotificationWrapper)"""
+    if not isinstance(data, dict):
+        return {}
+    if 'NotificationWrapper' in data:
+        return (data['NotificationWrapper'] or {}).get('NotificationPayload') or {}
+    return data
+
+
+def process_safe2pay_notification(data, received_at=None):
+    """
+    Processa um webhook Safe2Pay retirado da fila
+
+    Exceções fazem o evento voltar para a fila (retentativa com backoff).
+    """
+    notification = extract_safe2pay_notification(data)
+
+    # Estrutura do webhook Safe2Pay:
+    # {
+    #   "IdTransaction": 12345678,
+    #   "TransactionStatus": {
+    #     "Id": 3,
+    #     "Code": "3",
+    #     "Name": "Autorizado"
+    #   },
+    #   ...
+    # }
+    transaction_id = notification.get('IdTransaction')
+    transaction_status = notification.get('TransactionStatus') or {}
+    status_id = transaction_status.get('Id')
+    status_name = transaction_status.get('Name')
+
+    logger.info(f"🔔 Webhook Safe2Pay: transação {transaction_id} - {status_name} (ID: {status_id})")
+
+    # Gravar no store de status e acordar long-polls aguardando esta transação
+    payment_notifier.publish(
+        transaction_id, status_id, transaction_status.get('Code'), status_name,
+        amount=notification.get('Amount'),
+        payment_date=notification.get('PaymentDate'),
+        reference=notification.get('Reference'),
+        received_at=received_at
+    )
+
+    # Status 3 = Aprovado/Autorizado
+    if status_id == 3 or status_id == '3':
+        logger.info("✅ Pagamento APROVADO via webhook!")
+
+        # Reference do PIX = protocolo Safeweb: liberação e link de upload vão para a outbox
+        reference = notification.get('Reference')
+        if reference:
+            enqueue_post_approval(reference, transaction_id, received_at)
+        else:
+            logger.warning(f"⚠️ Webhook aprovado sem Reference: solicitação Hope fica para o frontend")
+
+    elif status_id == 9 or status_id == '9':
+        logger.warning("⏰ Pagamento EXPIRADO via webhook")
+
+    elif status_id == 4 or status_id == '4':
+        logger.warning("❌ Pagamento CANCELADO via webhook")
+
+    else:
+        logger.info(f"ℹ️ Status intermediário: {status_name}")
+
+
+class PostApprovalAutomation:
+    """
+    Solicitação Hope disparada pelo webhook assim que o pagamento é aprovado
+
+    Roda uma vez por protocolo (reserva no backend chave-valor) a partir do
+    efeito 'hope' da outbox; o endpoint /api/hope/create-solicitation só
+    aguarda ou reaproveita o resultado. O link de upload fica gravado e vai
+    junto na consulta de status, mesmo que a aba tenha sido fechada.
+    """
+
+    PREFIX = 'post-approval:'
+
+    def __init__(self, kv_store, create_solicitation, ttl=7 * 24 * 3600, lease_seconds=120):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            create_solicitation: Função (protocolo) -> resultado da solicitação Hope
+            ttl: Segundos que o link de upload fica gravado
+            lease_seconds: Validade da reserva enquanto a solicitação roda
+        """
+        self.kv = kv_store
+        self.create_solicitation = create_solicitation
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self._latencies = deque(maxlen=500)  # webhook -> Hope concluída (ms)
+        self._lock = threading.Lock()
+        self._stats = {'completed': 0, 'failed': 0, 'reused': 0}
+
+    def execute(self, protocol, transaction_id=None, received_at=None):
+        """
+        Cria a solicitação Hope uma única vez por protocolo
+
+        Returns:
+            Resultado da solicitação (gravado ou recém-criado), ou None se
+            outra execução para o mesmo protocolo ainda está em andamento
+        """
+        key = self.PREFIX + str(protocol)
+        record = self.kv.get(key)
+        if record and record.get('state') == 'done':
+            with self._lock:
+                self._stats['reused'] += 1
+            return record['resultado']
+
+        if not self.kv.add(key, {'state': 'running', 'transactionId': transaction_id}, ttl=self.lease_seconds):
+            return None
+
+        try:
+            resultado = self.create_solicitation(protocol)
+        except Exception as e:
+            resultado = {'sucesso': False, 'erro': str(e)}
+
+        if not resultado.get('sucesso'):
+            # Liberar a reserva: a outbox tenta de novo com backoff
+            self.kv.delete(key)
+            with self._lock:
+                self._stats['failed'] += 1
+            return resultado
+
+        self.kv.put(key, {'state': 'done', 'transactionId': transaction_id, 'resultado': resultado}, ttl=self.ttl)
+        with self._lock:
+            self._stats['completed'] += 1
+            if received_at:
+                elapsed_ms = round((time.time() - received_at) * 1000, 1)
+                self._latencies.append(elapsed_ms)
+        if received_at:
+            logger.info(f"⏱️ Webhook → Hope concluída em {elapsed_ms} ms (protocolo {protocol})")
+        return resultado
+
+    def wait_for(self, protocol, wait_timeout, poll_interval=0.25):
+        """Aguarda a outbox concluir a solicitação (endpoint do frontend); None se não concluiu a tempo"""
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            resultado = self.result(protocol)
+            if resultado is not None:
+                return resultado
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def result(self, protocol):
+        """Resultado gravado da solicitação Hope (ou None)"""
+        record = self.kv.get(self.PREFIX + str(protocol))
+        if record and record.get('state') == 'done':
+            return record['resultado']
+        return None
+
+    def upload_url(self, protocol):
+        """Link de upload já gerado para o protocolo (ou None)"""
+        resultado = self.result(protocol)
+        return resultado.get('uploadUrl') if resultado else None
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                **self._stats,
+                'webhook_to_hope_ms': {
+                    'count': len(latencies),
+                    'p50': latencies[len(latencies) // 2] if latencies else None,
+                    'p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+                    'max': latencies[-1] if latencies else None
+                }
+            }
+
+
+# Solicitação Hope após a aprovação (executada pelo efeito 'hope' da outbox)
+post_approval = PostApprovalAutomation(
+    create_kv_store(POST_APPROVAL_STORE),
+    lambda protocol: get_safeweb_client().criar_solicitacao_hope(protocol)
+)
+
+
+def run_outbox_effect(payload, received_at=None):
+    """Executa um efeito da outbox (exceção = retentar com backoff)"""
+    kind = payload['kind']
+    protocol = payload['protocol']
+
+    if kind == 'liberacao':
+        resultado = get_safeweb_client().liberar_pagamento(protocol)
+        if not resultado.get('sucesso'):
+            raise Exception(resultado.get('erro') or 'Liberação não concluída')
+
+    elif kind == 'hope':
+        resultado = post_approval.execute(protocol, payload.get('transactionId'), payload.get('receivedAt'))
+        if resultado is None:
+            raise Exception('Solicitação Hope em andamento em outra execução')
+        if not resultado.get('sucesso'):
+            raise Exception(resultado.get('erro') or 'Solicitação Hope não concluída')
+
+    else:
+        logger.error(f"❌ Efeito desconhecido na outbox: {kind}")
+
+
+def enqueue_post_approval(protocol, transaction_id=None, received_at=None):
+    """Grava na outbox os efeitos Safeweb de um pagamento aprovado (liberação + Hope)"""
+    payload = {'protocol': protocol, 'transactionId': transaction_id, 'receivedAt': received_at}
+    # O link de upload fica em POST_APPROVAL_STORE, não na outbox: se ele se perdeu
+    # (backend em memória após restart), o efeito 'hope' concluído volta para a fila
+    hope_lost = post_approval.result(protocol) is None
+    for kind in ('liberacao', 'hope'):
+        if outbox.add(kind, protocol, payload, revive_done=(kind == 'hope' and hope_lost)):
+            logger.info(f"📤 Outbox: efeito '{kind}' gravado para protocolo {protocol}")
+    outbox_worker.ensure_started()
+    outbox_worker.notify()
+
+
+# Webhooks gravados antes da resposta e processados fora da requisição
+webhook_queue = SQLiteWebhookQueue(WEBHOOK_QUEUE_PATH)
+webhook_worker = QueueWorker('webhook', webhook_queue, process_safe2pay_notification)
+
+# Efeitos Safeweb (threads próprias: chamadas lentas não seguram a fila de webhooks)
+outbox = SQLiteOutbox(OUTBOX_PATH)
+outbox_worker = QueueWorker('outbox', outbox, run_outbox_effect, threads=OUTBOX_WORKERS)
+
+
+# Instância global do Rate Limiter (políticas em RATE_LIMIT_POLICIES)
+rate_limiter = RateLimiter(RATE_LIMIT_POLICIES)
+
+# Clientes compartilhados entre requisições (token Safeweb e sessões sobrevivem)
+_api_clients_lock = threading.Lock()
+_safe2pay_client = None
+_safeweb_client = None
+
+
+def get_safe2pay_client():
+    """Retorna a instância compartilhada de Safe2PayAPI (criada no primeiro uso)"""
+    global _safe2pay_client
+    if _safe2pay_client is None:
+        with _api_clients_lock:
+            if _safe2pay_client is None:
+                _safe2pay_client = Safe2PayAPI()
+    return _safe2pay_client
+
+
+def get_safeweb_client():
+    """Retorna a instância compartilhada de SafewebAPI (criada no primeiro uso)"""
+    global _safeweb_client
+    if _safeweb_client is None:
+        with _api_clients_lock:
+            if _safeweb_client is None:
+                _safeweb_client = SafewebAPI()
+    return _safeweb_client
+
+
+class BoundedExecutor:
+    """
+    Pool de threads compartilhado com limite de tarefas em andamento
+
+    Quando o limite é atingido a tarefa roda na própria thread de quem
+    chamou (sem fila ilimitada crescendo sob carga).
+    """
+
+    def __init__(self, max_workers, max_pending=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='safeweb')
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers)
+        self.inline_runs = 0
 
-            protocolo = response.json()
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.inline_runs += 1
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
 
-            logger.info(f'✅ Safeweb: Protocolo gerado com sucesso: {protocolo}')
+        # Levar o contexto (spans da requisição) para a thread do pool
+        future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_safeweb_executor = None
+
+
+def get_safeweb_executor():
+    """Retorna o pool compartilhado das chamadas Safeweb paralelas (criado no primeiro uso)"""
+    global _safeweb_executor
+    if _safeweb_executor is None:
+        with _api_clients_lock:
+            if _safeweb_executor is None:
+                _safeweb_executor = BoundedExecutor(SAFEWEB_PRECHECK_WORKERS)
+    return _safeweb_executor
 
-            return {
-                'sucesso': True,
-                'protocolo': protocolo,
-                'mensagem': 'Protocolo gerado com sucesso'
-            }
 
+def run_pre_check(safeweb, cpf, data_nascimento):
+    """
+    Verifica biometria e consulta o CPF na RFB ao mesmo tempo
+
+    Returns:
+        dict com os dois resultados (`biometria`, `consulta`), `parcial` se só
+        um deles funcionou e o tempo de cada etapa
+    """
+    started = time.perf_counter()
+    executor = get_safeweb_executor()
+
+    def timed(fn, *args):
+        stage_started = time.perf_counter()
+        try:
+            return fn(*args), round((time.perf_counter() - stage_started) * 1000, 1)
         except Exception as e:
-            logger.error(f'❌ Safeweb: Erro ao gerar protocolo: {str(e)}')
+            return {'sucesso': False, 'erro': str(e)}, round((time.perf_counter() - stage_started) * 1000, 1)
+
+    futures = {
+        'biometria': executor.submit(timed, safeweb.verificar_biometria, cpf),
+        'consulta': executor.submit(timed, safeweb.consultar_cpf, cpf, data_nascimento)
+    }
+
+    resultado = {'timings': {}}
+    for etapa, future in futures.items():
+        try:
+            resultado[etapa], resultado['timings'][f'{etapa}_ms'] = future.result(timeout=SAFEWEB_PRECHECK_TIMEOUT)
+        except FutureTimeoutError:
+            resultado[etapa] = {'sucesso': False, 'erro': 'Tempo esgotado na consulta Safeweb'}
+    resultado['timings']['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    sucessos = [resultado[etapa].get('sucesso', False) for etapa in futures]
+    resultado['sucesso'] = all(sucessos)
+    resultado['parcial'] = any(sucessos) and not all(sucessos)
+    return resultado
+
+
+# Campos do titular exigidos para gerar o protocolo (mesmos de /api/safeweb/gerar-protocolo)
+CHECKOUT_REQUIRED_FIELDS = ['cpf', 'nome', 'nascimento', 'email', 'telefone',
+                            'cep', 'endereco', 'numero', 'bairro', 'cidade', 'estado']
+
+
+def run_checkout(safeweb, safe2pay, dados):
+    """
+    Checkout em uma requisição: gera o protocolo Safeweb e cria o PIX Safe2Pay
+
+    Args:
+        safeweb: SafewebAPI compartilhada (token e conexões já aquecidos)
+        safe2pay: Safe2PayAPI compartilhada
+        dados: Dados do titular (campos de gerar-protocolo), `product_id`, `valor`,
+            `pagador` opcional ({nome_completo, cpf, email, telefone}) e
+            `protocolo` opcional (reaproveita um protocolo já gerado, pulando a 1ª etapa)
+
+    Returns:
+        (dict, int): (resultado com protocolo, dados do PIX e tempos por etapa, status HTTP)
+    """
+    started = time.perf_counter()
+    timings = {}
+    protocolo = dados.get('protocolo')
+
+    if not protocolo:
+        for campo in CHECKOUT_REQUIRED_FIELDS:
+            if not dados.get(campo):
+                return {'sucesso': False, 'erro': f'Campo obrigatório ausente: {campo}', 'etapa': 'validacao'}, 400
+
+        stage_started = time.perf_counter()
+        resultado_protocolo = safeweb.gerar_protocolo(dados)
+        timings['protocolo_ms'] = round((time.perf_counter() - stage_started) * 1000, 1)
+
+        if not resultado_protocolo.get('sucesso'):
+            timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
             return {
                 'sucesso': False,
-                'erro': str(e)
-            }
-
+                'erro': resultado_protocolo.get('erro', 'Erro ao gerar protocolo'),
+                'etapa': 'protocolo',
+                'timings': timings
+            }, 400
+        protocolo = resultado_protocolo['protocolo']
+
+    # Pagador pode ser outra pessoa (modal de pagador); endereço é sempre o do titular
+    pagador = dados.get('pagador') or {}
+    dados_pix = {
+        'protocolo': protocolo,
+        'product_id': dados.get('product_id', 'ecpf-a1'),
+        'valor': dados.get('valor'),
+        'nome_completo': pagador.get('nome_completo') or dados.get('nome'),
+        'cpf': pagador.get('cpf') or dados.get('cpf'),
+        'email': pagador.get('email') or dados.get('email'),
+        'telefone': pagador.get('telefone') or dados.get('telefone'),
+        'cep': dados.get('cep', ''),
+        'endereco': dados.get('endereco', ''),
+        'numero': dados.get('numero', ''),
+        'complemento': dados.get('complemento', ''),
+        'bairro': dados.get('bairro', ''),
+        'cidade': dados.get('cidade', ''),
+        'uf': dados.get('estado', '')
+    }
 
-# Instância global do Rate Limiter (200 req/min)
-rate_limiter = RateLimiter(max_requests=200, window_seconds=60)
+    stage_started = time.perf_counter()
+    resultado_pix = safe2pay.create_pix_payment(dados_pix)
+    timings['pix_ms'] = round((time.perf_counter() - stage_started) * 1000, 1)
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    if not resultado_pix.get('sucesso'):
+        # Protocolo já gerado volta na resposta: o cliente pode repetir só a etapa do PIX
+        return {
+            'sucesso': False,
+            'erro': resultado_pix.get('erro', 'Erro ao gerar PIX'),
+            'etapa': 'pix',
+            'protocolo': protocolo,
+            'timings': timings
+        }, 400
+
+    return {
+        'sucesso': True,
+        'protocolo': protocolo,
+        'dados': resultado_pix['dados'],
+        'timings': timings
+    }, 200
 
 
 class APIRequestHandler(http.server.BaseHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
-        self.safe2pay = Safe2PayAPI()
-        self.safeweb = SafewebAPI()
+        self.safe2pay = get_safe2pay_client()
+        self.safeweb = get_safeweb_client()
         super().__init__(*args, **kwargs)
 
     def check_rate_limit(self):
-        """Verifica rate limit antes de processar requisição"""
+        """Verifica rate limit (global por IP e da rota) antes de processar requisição"""
         client_ip = self.client_address[0]
+        path = urllib.parse.urlparse(self.path).path
 
-        if not rate_limiter.is_allowed(client_ip):
-            retry_after = rate_limiter.get_retry_after(client_ip)
+        policies = ['ip'] + [policy for prefix, policy in ROUTE_RATE_LIMITS if path.startswith(prefix)][:1]
+        for policy in policies:
+            allowed, remaining, retry_after = rate_limiter.hit(policy, client_ip)
+            if allowed:
+                continue
+
+            max_requests, window_seconds = rate_limiter.policies[policy]
+            logger.warning(f"🚫 Rate limit '{policy}' excedido para IP: {client_ip}")
             self.send_response(429)  # Too Many Requests
             self.send_header('Content-Type', 'application/json')
             self.send_header('Retry-After', str(retry_after))
-            self.send_header('X-RateLimit-Limit', str(rate_limiter.max_requests))
-            self.send_header('X-RateLimit-Window', str(rate_limiter.window_seconds))
+            self.send_header('X-RateLimit-Limit', str(max_requests))
+            self.send_header('X-RateLimit-Window', str(window_seconds))
             self.end_headers()
             self.wfile.write(json.dumps({
                 'sucesso': False,
@@ -807,14 +4178,62 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
         """Override para logging estruturado"""
         logger.info(f"{self.address_string()} - {format % args}")
 
+    def send_response(self, code, message=None):
+        self._status_code = code
+        super().send_response(code, message)
+        trace = getattr(self, '_trace', None)
+        if trace is not None:
+            self.send_header('X-Request-ID', trace.request_id)
+
+    def begin_request(self):
+        """Inicia a medição da requisição (Server-Timing, trace e histograma da rota)"""
+        self._status_code = None
+        self._timing = ServerTiming()
+        self._timing_token = _request_timing.set(self._timing)
+        self._trace = RequestTrace(self.headers.get('X-Request-ID'), self.headers.get('traceparent'))
+        self._trace.route = metric_route_label(self.path)
+        self._trace_token = _request_trace.set(self._trace)
+
+    def finish_request(self):
+        """Registra a latência da requisição no histograma da rota e exporta o trace"""
+        status = self._status_code or 500
+        route = metric_route_label(self.path)
+        latency_metrics.observe(
+            'ecommerce_http_request_duration_seconds', time.perf_counter() - self._timing.started,
+            method=self.command, route=route, status=status
+        )
+        trace_exporter.export(self._trace.finish(f"{self.command} {route}", {
+            'http.request.method': self.command,
+            'http.route': route,
+            'http.response.status_code': status
+        }, error=status >= 500))
+        _request_trace.reset(self._trace_token)
+        _request_timing.reset(self._timing_token)
+        self._trace = None
+
     def do_OPTIONS(self):
-        self.send_cors_headers()
+        self.begin_request()
+        try:
+            self.send_cors_headers()
+        finally:
+            self.finish_request()
 
     def do_POST(self):
-        # Verificar rate limit antes de processar
-        if not self.check_rate_limit():
-            return
+        self.begin_request()
+        try:
+            # Verificar rate limit antes de processar
+            if not self.check_rate_limit():
+                return
 
+            idempotency_key = self.headers.get('Idempotency-Key')
+            if idempotency_key and self.path in IDEMPOTENT_ROUTES:
+                self.handle_idempotent_post(idempotency_key)
+            else:
+                self.route_post()
+        finally:
+            self.finish_request()
+
+    def route_post(self):
         if self.path == '/api/pix/create':
             self.handle_create_pix()
         elif self.path.startswith('/api/pix/status/'):
@@ -826,6 +4245,10 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
             self.handle_safeweb_consultar_cpf()
         elif self.path == '/api/safeweb/gerar-protocolo':
             self.handle_safeweb_gerar_protocolo()
+        elif self.path == '/api/checkout':
+            self.handle_checkout()
+        elif self.path == '/api/safeweb/pre-check':
+            self.handle_safeweb_pre_check()
         elif self.path == '/api/hope/create-solicitation':
             self.handle_hope_create_solicitation()
         elif self.path == '/webhook/safe2pay':
@@ -837,12 +4260,25 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
             })
 
     def do_GET(self):
+        self.begin_request()
+        try:
+            self.route_get()
+        finally:
+            self.finish_request()
+
+    def route_get(self):
         # Verificar rate limit antes de processar
         if not self.check_rate_limit():
             return
 
         if self.path == '/api/health':
             self.handle_health_check()
+        elif self.path == '/api/metrics':
+            self.handle_metrics()
+        elif self.path == '/api/ops/outbox':
+            self.handle_outbox_status()
+        elif self.path.startswith('/api/pix/wait/'):
+            self.handle_wait_status()
         elif self.path.startswith('/api/proxy-image'):
             self.handle_proxy_image()
         elif self.path.startswith('/api/pix/status/'):
@@ -854,6 +4290,62 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'erro': 'Endpoint não encontrado'
             })
 
+    def handle_idempotent_post(self, idempotency_key):
+        """Executa o POST uma única vez por Idempotency-Key e repete a resposta gravada"""
+        if len(idempotency_key) > 255:
+            self.send_json_response(400, {
+                'sucesso': False,
+                'erro': 'Idempotency-Key inválida'
+            })
+            return
+
+        content_length = int(self.headers.get('Content-Length', 0))
+        raw_body = self.rfile.read(content_length) if content_length else b''
+        fingerprint = IdempotencyStore.fingerprint(raw_body)
+
+        try:
+            outcome, record = idempotency_store.begin(self.path, idempotency_key, fingerprint)
+        except Exception as e:
+            # Sem o registro não há como garantir execução única: o cliente repete com a mesma chave
+            logger.error(f"❌ Store de idempotência indisponível em {self.path}: {str(e)}")
+            self.send_json_response(503, {
+                'sucesso': False,
+                'erro': 'Serviço temporariamente indisponível. Tente novamente.'
+            }, headers={'Retry-After': '2'})
+            return
+
+        if outcome == 'replay':
+            logger.info(f"🔁 Idempotency-Key repetida em {self.path}: resposta reaproveitada")
+            self.send_json_response(record['status_code'], record['body'], headers={'Idempotent-Replayed': 'true'})
+            return
+        if outcome == 'mismatch':
+            self.send_json_response(422, {
+                'sucesso': False,
+                'erro': 'Idempotency-Key já usada com outros dados'
+            })
+            return
+        if outcome == 'in_progress':
+            self.send_json_response(409, {
+                'sucesso': False,
+                'erro': 'Requisição original ainda em processamento. Tente novamente em instantes.'
+            }, headers={'Retry-After': '2'})
+            return
+
+        # Handlers leem o corpo de self.rfile: devolver o que já foi lido
+        original_rfile = self.rfile
+        self.rfile = io.BytesIO(raw_body)
+        self._last_response = (500, {'sucesso': False, 'erro': 'Erro interno no servidor'})
+        try:
+            self.route_post()
+        finally:
+            self.rfile = original_rfile
+            status_code, data = self._last_response
+            try:
+                idempotency_store.complete(self.path, idempotency_key, fingerprint, status_code, data)
+            except Exception as e:
+                # A resposta já foi enviada; a reserva expira sozinha
+                logger.error(f"❌ Falha ao gravar resposta idempotente em {self.path}: {str(e)}")
+
     def handle_create_pix(self):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
@@ -902,6 +4394,47 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'erro': 'Erro ao verificar status'
             })
 
+    def handle_wait_status(self):
+        """
+        Long-poll de status PIX: segura a requisição até o webhook registrar
+        um status diferente de `since` ou o tempo esgotar
+
+        GET /api/pix/wait/<id>?since=<statusCode>&timeout=<segundos>
+        """
+        try:
+            parsed = urllib.parse.urlsplit(self.path)
+            transaction_id = parsed.path.rstrip('/').split('/')[-1]
+            params = urllib.parse.parse_qs(parsed.query)
+
+            if not transaction_id.isdigit():
+                self.send_json_response(400, {
+                    'sucesso': False,
+                    'erro': 'Transaction ID inválido'
+                })
+                return
+
+            since = params.get('since', [''])[0]
+            try:
+                timeout = float(params.get('timeout', [PIX_WAIT_MAX_SECONDS])[0])
+            except ValueError:
+                timeout = PIX_WAIT_MAX_SECONDS
+            timeout = max(0, min(timeout, PIX_WAIT_MAX_SECONDS))
+
+            # Com ou sem webhook no período, check_payment_status responde: a partir do
+            # store (webhook) ou com uma consulta ao Safe2Pay (cobre webhooks perdidos)
+            payment_notifier.wait_for_change(transaction_id, since, timeout)
+            resultado = self.safe2pay.check_payment_status(transaction_id)
+
+            status_code = 200 if resultado.get('sucesso') else 400
+            self.send_json_response(status_code, resultado)
+
+        except Exception as e:
+            logger.error(f"❌ Erro em handle_wait_status: {str(e)}", exc_info=True)
+            self.send_json_response(500, {
+                'sucesso': False,
+                'erro': 'Erro ao verificar status'
+            })
+
     def handle_health_check(self):
         """Endpoint de health check para monitoramento"""
 
@@ -917,12 +4450,40 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'safe2pay_configured': safe2pay_ok,
                 'token_present': bool(self.safe2pay.token),
                 'api_url': self.safe2pay.api_url
-            }
+            },
+            'upstream': upstream_http.stats(),
+            'transaction_cache': transaction_status_cache.stats(),
+            'rate_limiter': rate_limiter.stats(),
+            'image_cache': image_proxy_cache.stats(),
+            'idempotency': idempotency_store.stats(),
+            'webhook_queue': webhook_worker.stats(),
+            'outbox': outbox_worker.stats(),
+            'tracing': trace_exporter.stats(),
+            'logging': {'queued': log_queue.qsize(), 'dropped': log_handler.dropped, 'level': LOG_LEVEL, 'format': LOG_FORMAT},
+            'post_approval': post_approval.stats(),
+            'safeweb_cache': safeweb_lookup_cache.stats(),
+            'safeweb_token': self.safeweb.token_manager.stats()
         }
 
         status_code = 200 if safe2pay_ok else 503
         self.send_json_response(status_code, health_data)
 
+    def handle_metrics(self):
+        """Histogramas de latência (rotas e upstreams) no formato texto do Prometheus"""
+        body = latency_metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_outbox_status(self):
+        """Profundidade da outbox por tipo/estado e idade do pendente mais antigo (sem dados de clientes)"""
+        self.send_json_response(200, {
+            'sucesso': True,
+            'outbox': outbox_worker.stats()
+        })
+
     def handle_proxy_image(self):
         """Proxy para download de imagens QR Code (resolve CORS)"""
         try:
@@ -936,31 +4497,43 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
 
             image_url = urllib.parse.unquote(self.path[query_start + 5:])
 
-            # Validar que é URL da Safe2Pay
-            if 'safe2pay.com' not in image_url:
+            # Validar que é URL https da Safe2Pay
+            if not is_allowed_image_url(image_url):
                 self.send_json_response(403, {
                     'sucesso': False,
                     'erro': 'URL não autorizada'
                 })
                 return
 
-            logger.info(f"🖼️ Proxy de imagem: {image_url}")
-
-            response = requests.get(image_url, timeout=10)
+            # Cache (memória/disco); buscas simultâneas da mesma URL aguardam uma só
+            entry = image_proxy_cache.get(image_url)
+            while entry is None:
+                waiter = image_proxy_cache.claim(image_url)
+                if waiter is None:
+                    logger.info(f"🖼️ Proxy de imagem: {image_url}")
+                    self.stream_proxy_image(image_url)
+                    return
+                waiter.wait(timeout=15)
+                entry = image_proxy_cache.get(image_url)
 
-            if response.status_code == 200:
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/png')
+            if self.etag_matches(entry['etag']):
+                image_proxy_cache.count('not_modified')
+                self.send_response(304)
+                self.send_header('ETag', entry['etag'])
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.send_header('Cache-Control', 'public, max-age=3600')
                 self.end_headers()
-                self.wfile.write(response.content)
-                logger.info(f"✅ Imagem proxy enviada: {len(response.content)} bytes")
-            else:
-                self.send_json_response(500, {
-                    'sucesso': False,
-                    'erro': f'Erro ao baixar imagem: {response.status_code}'
-                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', image_content_type(entry['content_type']) or 'image/png')
+            self.send_header('X-Content-Type-Options', 'nosniff')
+            self.send_header('Content-Length', str(len(entry['body'])))
+            self.send_header('ETag', entry['etag'])
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'public, max-age=3600')
+            self.end_headers()
+            self.wfile.write(entry['body'])
 
         except Exception as e:
             logger.error(f"❌ Erro no proxy de imagem: {str(e)}")
@@ -969,6 +4542,112 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'erro': 'Erro no proxy de imagem'
             })
 
+    def etag_matches(self, etag):
+        """Verifica o cabeçalho If-None-Match contra o ETag da imagem"""
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        candidates = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+    def stream_proxy_image(self, image_url):
+        """
+        Busca a imagem no upstream repassando os bytes ao cliente em blocos
+
+        O corpo também é acumulado (até o limite por imagem) para o cache. Se o
+        cliente desconectar, a leitura continua para que o cache seja preenchido.
+        Sem ETag do upstream, imagens dentro do limite são lidas inteiras antes
+        dos headers para o primeiro cliente já receber o ETag calculado. Um erro
+        depois dos headers só fecha a conexão (a resposta já começou).
+        """
+        headers_sent = False
+        try:
+            # Sem redirects: o destino final também precisa passar pela allowlist
+            response = upstream_http.get(image_url, timeout=10, stream=True, allow_redirects=False)
+            with response:
+                if response.status_code != 200:
+                    self.send_json_response(500, {
+                        'sucesso': False,
+                        'erro': f'Erro ao baixar imagem: {response.status_code}'
+                    })
+                    return
+
+                content_type = image_content_type(response.headers.get('Content-Type', 'image/png'))
+                if content_type is None:
+                    logger.warning(f"⚠️ Proxy de imagem: conteúdo não é imagem ({response.headers.get('Content-Type')})")
+                    self.send_json_response(502, {
+                        'sucesso': False,
+                        'erro': 'Conteúdo retornado não é uma imagem'
+                    })
+                    return
+                upstream_etag = response.headers.get('ETag')
+                chunks = response.iter_content(IMAGE_PROXY_CHUNK_SIZE)
+
+                body = bytearray()
+                if not upstream_etag:
+                    for chunk in chunks:
+                        body += chunk
+                        if len(body) > image_proxy_cache.max_entry_bytes:
+                            break
+                    else:
+                        entry = image_proxy_cache.put(image_url, bytes(body), content_type)
+                        self.send_response(200)
+                        self.send_header('Content-Type', content_type)
+                        self.send_header('X-Content-Type-Options', 'nosniff')
+                        self.send_header('Content-Length', str(len(entry['body'])))
+                        self.send_header('ETag', entry['etag'])
+                        self.send_header('Access-Control-Allow-Origin', '*')
+                        self.send_header('Cache-Control', 'public, max-age=3600')
+                        self.end_headers()
+                        headers_sent = True
+                        self.wfile.write(entry['body'])
+                        logger.info(f"✅ Imagem proxy enviada e cacheada: {len(body)} bytes")
+                        return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('X-Content-Type-Options', 'nosniff')
+                if response.headers.get('Content-Length') and not response.headers.get('Content-Encoding'):
+                    self.send_header('Content-Length', response.headers['Content-Length'])
+                else:
+                    self.close_connection = True
+                if upstream_etag:
+                    self.send_header('ETag', upstream_etag)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Cache-Control', 'public, max-age=3600')
+                self.end_headers()
+                headers_sent = True
+
+                # Com ETag do upstream o corpo é acumulado aqui; sem ele, o que já
+                # foi lido passou do limite do cache e só é repassado
+                prefix = [bytes(body)] if body else []
+                if prefix:
+                    body = None
+                client_connected = True
+                for chunk in itertools.chain(prefix, chunks):
+                    if client_connected:
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            client_connected = False
+                    if body is not None:
+                        body += chunk
+                        if len(body) > image_proxy_cache.max_entry_bytes:
+                            body = None
+                    if body is None and not client_connected:
+                        break
+
+            if body is not None:
+                image_proxy_cache.put(image_url, bytes(body), content_type, upstream_etag)
+                logger.info(f"✅ Imagem proxy enviada e cacheada: {len(body)} bytes")
+        except Exception as e:
+            if not headers_sent:
+                raise
+            logger.error(f"❌ Erro no proxy de imagem após o início da resposta: {str(e)}")
+            self.close_connection = True
+        finally:
+            image_proxy_cache.release(image_url)
+
     def handle_safeweb_biometria(self):
         """Handler para verificar biometria via Safeweb"""
         try:
@@ -1037,6 +4716,41 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'erro': 'Erro interno no servidor'
             })
 
+    def handle_safeweb_pre_check(self):
+        """Handler para verificar biometria e consultar CPF na RFB em paralelo"""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            if content_length == 0:
+                self.send_json_response(400, {
+                    'sucesso': False,
+                    'erro': 'Corpo da requisição vazio'
+                })
+                return
+
+            post_data = self.rfile.read(content_length)
+            dados = json.loads(post_data.decode('utf-8'))
+
+            cpf = dados.get('cpf')
+            data_nascimento = dados.get('dataNascimento')
+
+            if not cpf or not data_nascimento:
+                self.send_json_response(400, {
+                    'sucesso': False,
+                    'erro': 'CPF e data de nascimento são obrigatórios'
+                })
+                return
+
+            resultado = run_pre_check(self.safeweb, cpf, data_nascimento)
+            # Sempre retornar 200 - o frontend decide por etapa (resultado parcial)
+            self.send_json_response(200, resultado)
+
+        except Exception as e:
+            logger.error(f"❌ Erro em handle_safeweb_pre_check: {str(e)}", exc_info=True)
+            self.send_json_response(500, {
+                'sucesso': False,
+                'erro': 'Erro interno no servidor'
+            })
+
     def handle_safeweb_gerar_protocolo(self):
         """Handler para gerar protocolo via Safeweb"""
         try:
@@ -1074,6 +4788,31 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 'erro': 'Erro interno no servidor'
             })
 
+    def handle_checkout(self):
+        """Handler do checkout em uma requisição (protocolo + PIX)"""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            if content_length == 0:
+                self.send_json_response(400, {
+                    'sucesso': False,
+                    'erro': 'Corpo da requisição vazio'
+                })
+                return
+
+            post_data = self.rfile.read(content_length)
+            dados = json.loads(post_data.decode('utf-8'))
+
+            resultado, status_code = run_checkout(self.safeweb, self.safe2pay, dados)
+            logger.info(f"🧾 Checkout: etapa={resultado.get('etapa', 'concluido')} tempos={resultado.get('timings')}")
+            self.send_json_response(status_code, resultado)
+
+        except Exception as e:
+            logger.error(f"❌ Erro em handle_checkout: {str(e)}", exc_info=True)
+            self.send_json_response(500, {
+                'sucesso': False,
+                'erro': 'Erro interno no servidor'
+            })
+
     def handle_hope_create_solicitation(self):
         """Handler para criar solicitação Hope após pagamento aprovado"""
         try:
@@ -1096,52 +4835,21 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
                 })
                 return
 
-            logger.info(f"📋 Criando solicitação Hope para protocolo: {protocol}")
-
-            # Obter token Safeweb
-            token = self.safeweb.ensure_valid_token()
-            if not token:
-                self.send_json_response(500, {
+            # Normalmente o webhook de aprovação já gravou os efeitos: a gravação é
+            # idempotente e cobre webhooks perdidos. Aguardar o link sem chamar a Hope aqui
+            resultado = post_approval.result(protocol)
+            if resultado is None:
+                enqueue_post_approval(protocol)
+                resultado = post_approval.wait_for(protocol, wait_timeout=POST_APPROVAL_WAIT_SECONDS)
+            if resultado is None:
+                # Falhas ficam na outbox com retentativa; o link chega pela consulta de status
+                self.send_json_response(503, {
                     'sucesso': False,
-                    'erro': 'Erro ao autenticar com Safeweb'
-                })
+                    'erro': 'Solicitação Hope ainda em processamento. Tente novamente.'
+                }, headers={'Retry-After': '5'})
                 return
 
-            # Chamar API Hope
-            hope_url = os.getenv('SAFEWEB_HOPE_API_URL')
-            attendance_place_id = int(os.getenv('SAFEWEB_ATTENDANCE_PLACE_ID', '348'))
-
-            headers = {
-                'Authorization': f'bearer {token}',
-                'Content-Type': 'application/json'
-            }
-
-            payload = {
-                'protocol': protocol,
-                'attendancePlaceId': attendance_place_id,
-                'aciRemovalCandidate': False
-            }
-
-            logger.info(f"🔄 Chamando Hope API: {hope_url}")
-            response = requests.post(hope_url, headers=headers, json=payload, timeout=30)
-
-            if response.status_code == 200:
-                result = response.json()
-                logger.info(f"✅ Solicitação Hope criada com sucesso")
-                logger.info(f"📎 URL de upload: {result.get('url')}")
-
-                self.send_json_response(200, {
-                    'sucesso': True,
-                    'uploadUrl': result.get('url'),
-                    'emailEnviado': result.get('emailSend', False)
-                })
-            else:
-                logger.error(f"❌ Erro na API Hope: Status {response.status_code}")
-                logger.error(f"   Resposta: {response.text}")
-                self.send_json_response(500, {
-                    'sucesso': False,
-                    'erro': f'Erro na API Hope: {response.text}'
-                })
+            self.send_json_response(200, resultado)
 
         except Exception as e:
             logger.error(f"❌ Erro em handle_hope_create_solicitation: {str(e)}", exc_info=True)
@@ -1154,82 +4862,54 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
         """
         Recebe notificações do Safe2Pay sobre mudanças de status de transação
         Documentação: https://developers.safe2pay.com.br/reference/webhook-ordem-de-pagamento-copy
+
+        Só valida o mínimo e grava o evento na fila durável: o processamento
+        (status, long-polls, ações pós-aprovação) roda no worker da fila.
         """
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length)
+
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
             data = json.loads(body.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            data = None
 
-            logger.info("="*60)
-            logger.info("🔔 WEBHOOK Safe2Pay recebido")
-            logger.info(f"📦 Payload: {json.dumps(data, indent=2)}")
-            logger.info("="*60)
-
-            # Extrair informações do payload
-            # Estrutura do webhook Safe2Pay:
-            # {
-            #   "IdTransaction": 12345678,
-            #   "TransactionStatus": {
-            #     "Id": 3,
-            #     "Code": "3",
-            #     "Name": "Autorizado"
-            #   },
-            #   ...
-            # }
-
-            transaction_id = data.get('IdTransaction')
-            transaction_status = data.get('TransactionStatus', {})
-            status_id = transaction_status.get('Id')
-            status_name = transaction_status.get('Name')
-
-            logger.info(f"💳 Transaction ID: {transaction_id}")
-            logger.info(f"📊 Status: {status_name} (ID: {status_id})")
-
-            # Status 3 = Aprovado/Autorizado
-            if status_id == 3 or status_id == '3':
-                logger.info("✅ Pagamento APROVADO via webhook!")
-
-                # Aqui você pode:
-                # 1. Salvar em banco de dados
-                # 2. Enviar email
-                # 3. Disparar eventos para frontend via WebSocket/SSE
-                # 4. Criar solicitação Hope automaticamente
-
-                # TODO: Implementar ações pós-aprovação
-                # - Buscar dados do pedido pelo transaction_id
-                # - Chamar API Hope
-                # - Notificar frontend
-
-            elif status_id == 9 or status_id == '9':
-                logger.warning("⏰ Pagamento EXPIRADO via webhook")
-
-            elif status_id == 4 or status_id == '4':
-                logger.warning("❌ Pagamento CANCELADO via webhook")
-
-            else:
-                logger.info(f"ℹ️ Status intermediário: {status_name}")
+        log_payload("🔔 Webhook Safe2Pay recebido (RAW)", data)
 
-            # Sempre retornar 200 OK para o Safe2Pay saber que recebemos
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'success': True,
-                'message': 'Webhook recebido com sucesso'
-            }).encode('utf-8'))
+        if not extract_safe2pay_notification(data).get('IdTransaction'):
+            logger.warning("⚠️ Webhook Safe2Pay sem IdTransaction descartado")
+            self.send_webhook_response(400, {
+                'success': False,
+                'error': 'IdTransaction não fornecido'
+            })
+            return
 
+        try:
+            event_id = webhook_queue.enqueue(data)
         except Exception as e:
-            logger.error(f"❌ Erro ao processar webhook: {str(e)}", exc_info=True)
-
-            # Mesmo em caso de erro, retornar 200 para não ficar recebendo retentativas
-            # (mas logar o erro para investigação)
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            # Sem gravar o evento não confirmar: o Safe2Pay reenvia depois
+            logger.error(f"❌ Erro ao enfileirar webhook: {str(e)}", exc_info=True)
+            self.send_webhook_response(503, {
                 'success': False,
-                'error': str(e)
-            }).encode('utf-8'))
+                'error': 'Fila de webhooks indisponível'
+            })
+            return
+
+        webhook_worker.ensure_started()
+        webhook_worker.notify()
+        logger.info(f"📥 Webhook Safe2Pay enfileirado (evento {event_id})")
+
+        self.send_webhook_response(200, {
+            'success': True,
+            'message': 'Webhook recebido com sucesso'
+        })
+
+    def send_webhook_response(self, status_code, data):
+        """Resposta ao Safe2Pay (chamada servidor-a-servidor, sem CORS)"""
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode('utf-8'))
 
     def get_allowed_origin(self):
         """Retorna origem permitida baseado no header Origin (SEGURANÇA)"""
@@ -1260,13 +4940,14 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', allowed_origin)
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key, X-Debug-Timing, X-Request-ID, traceparent')
         self.send_header('Access-Control-Allow-Credentials', 'true')
         self.end_headers()
 
-    def send_json_response(self, status_code, data):
+    def send_json_response(self, status_code, data, headers=None):
         """Envia resposta JSON com CORS RESTRITO (SEGURANÇA)"""
         allowed_origin = self.get_allowed_origin()
+        self._last_response = (status_code, data)
 
         if not allowed_origin and self.headers.get('Origin'):
             # Bloquear requisições de origens não autorizadas
@@ -1279,34 +4960,163 @@ class APIRequestHandler(http.server.BaseHTTPRequestHandler):
             }).encode('utf-8'))
             return
 
+        timing = getattr(self, '_timing', None)
+        if timing is not None and isinstance(data, dict) and self.headers.get('X-Debug-Timing') == '1':
+            data = {**data, '_timings': timing.as_dict()}
+
+        serialize_started = time.perf_counter()
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        if timing is not None:
+            timing.add('serialize', time.perf_counter() - serialize_started)
+
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', allowed_origin or ALLOWED_ORIGINS[0])
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key, X-Debug-Timing, X-Request-ID, traceparent')
         self.send_header('Access-Control-Allow-Credentials', 'true')
+        self.send_header('Access-Control-Expose-Headers', 'Server-Timing, X-Request-ID, Retry-After')
+        if timing is not None:
+            self.send_header('Server-Timing', timing.header())
+            self.send_header('Timing-Allow-Origin', allowed_origin or ALLOWED_ORIGINS[0])
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        self.wfile.write(body)
+
+
+class ThreadPoolTCPServer(socketserver.TCPServer):
+    """
+    TCPServer que atende conexões em um pool fixo de threads.
+
+    Conexões aceitas entram numa fila limitada; com a fila cheia o servidor
+    responde 503 imediatamente em vez de acumular conexões sem limite.
+    Assim uma chamada lenta à Safeweb/Safe2Pay ocupa apenas um worker.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers=API_WORKERS,
+                 accept_queue=API_ACCEPT_QUEUE, bind_and_activate=True):
+        """
+        Args:
+            workers: Número de threads que processam requisições
+            accept_queue: Máximo de conexões aguardando um worker livre
+        """
+        self.workers = max(1, int(workers))
+        self.accept_queue = max(1, int(accept_queue))
+        self.request_queue_size = self.accept_queue  # backlog do listen()
+        self.rejected_requests = 0
+
+        self._pending = queue.Queue(maxsize=self.accept_queue)
+        self._threads = []
+
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'api-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        """Enfileira a conexão para um worker (ou rejeita com 503 se a fila estiver cheia)"""
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected_requests += 1
+            logger.warning(f"🚫 Fila de conexões cheia ({self.accept_queue}), rejeitando {client_address[0]}")
+            self._reject(request)
+
+    def _reject(self, request):
+        body = json.dumps({
+            'sucesso': False,
+            'erro': 'Servidor ocupado. Tente novamente em alguns segundos.'
+        }).encode('utf-8')
+        try:
+            request.sendall(
+                b'HTTP/1.0 503 Service Unavailable\r\n'
+                b'Content-Type: application/json\r\n'
+                b'Retry-After: 1\r\n'
+                b'Connection: close\r\n'
+                + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii')
+                + body
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # Conexões ainda na fila não serão atendidas: fechá-las abre espaço para os sinais de parada
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        # Mais workers que vagas na fila: cada sinal consumido libera a vaga do próximo.
+        # Workers presos em requisições longas não seguram o desligamento (threads daemon)
+        deadline = time.monotonic() + 5
+        for _ in self._threads:
+            try:
+                self._pending.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+
+
+def create_server(port=API_PORT, mode=API_SERVER_MODE, workers=API_WORKERS, accept_queue=API_ACCEPT_QUEUE):
+    """Cria o servidor HTTP da API no modo configurado ('threaded' ou 'single')"""
+    if mode == 'single':
+        return socketserver.TCPServer(("", port), APIRequestHandler)
+
+    return ThreadPoolTCPServer(("", port), APIRequestHandler, workers=workers, accept_queue=accept_queue)
 
 
 def main():
     try:
-        with socketserver.TCPServer(("", API_PORT), APIRequestHandler) as httpd:
+        with create_server() as httpd:
             logger.info("=" * 60)
             logger.info(f"🚀 API Server v2.0 iniciado")
             logger.info(f"🌐 Endereço: http://localhost:{API_PORT}")
+            if isinstance(httpd, ThreadPoolTCPServer):
+                logger.info(f"🧵 Modo concorrente: {httpd.workers} workers, fila de {httpd.accept_queue} conexões")
+            else:
+                logger.info("🧵 Modo single-thread (uma requisição por vez)")
             logger.info("=" * 60)
             logger.info("📋 Endpoints disponíveis:")
             logger.info(f"   POST /api/pix/create               - Criar pagamento PIX")
             logger.info(f"   GET  /api/pix/status/<id>          - Verificar status")
+            logger.info(f"   GET  /api/pix/wait/<id>            - Aguardar mudança de status (long-poll)")
             logger.info(f"   POST /api/hope/create-solicitation - Criar solicitação Hope")
             logger.info(f"   POST /webhook/safe2pay             - Webhook Safe2Pay")
             logger.info(f"   GET  /api/health                   - Health check")
+            logger.info(f"   GET  /api/ops/outbox               - Fila de efeitos Safeweb")
+            logger.info(f"   GET  /api/metrics                  - Métricas de latência (Prometheus)")
             logger.info(f"   GET  /api/proxy-image              - Proxy de imagens")
             logger.info("=" * 60)
             logger.info(f"🌐 Frontend: http://localhost:{STATIC_PORT}")
             logger.info(f"⏹️  Pressione Ctrl+C para parar")
             logger.info("=" * 60)
+            # Processar webhooks e efeitos que ficaram na fila de uma execução anterior
+            webhook_worker.ensure_started()
+            outbox_worker.ensure_started()
             httpd.serve_forever()
 
     except KeyboardInterrupt:
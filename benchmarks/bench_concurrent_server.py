@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark - Vazão do api_server.py com latência simulada de upstream
+
+Compara o modo single-thread com o pool de workers, substituindo a chamada
+à Safe2Pay por um sleep para simular a latência do upstream.
+
+Uso:
+    python3 benchmarks/bench_concurrent_server.py
+    python3 benchmarks/bench_concurrent_server.py --latencies 0.05 0.2 --requests 200
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api_server  # noqa: E402
+
+api_server.logger.disabled = True
+
+
+def simulate_upstream(latency):
+    """Substitui a consulta de status por um sleep com a latência informada"""
+    def check_payment_status(self, transaction_id):
+        time.sleep(latency)
+        return {'sucesso': True, 'status': 'pendente', 'statusCode': 1}
+
+    api_server.Safe2PayAPI.check_payment_status = check_payment_status
+
+
+def run(mode, workers, latency, total_requests, clients):
+    simulate_upstream(latency)
+    server = api_server.create_server(port=0, mode=mode, workers=workers, accept_queue=max(clients, 64))
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def call(_):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request('GET', '/api/pix/status/123')
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        statuses = list(pool.map(call, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    server.shutdown()
+    server.server_close()
+
+    errors = sum(1 for s in statuses if s != 200)
+    return total_requests / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latencies', type=float, nargs='+', default=[0.0, 0.05, 0.2])
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--requests', type=int, default=160)
+    parser.add_argument('--clients', type=int, default=32)
+    args = parser.parse_args()
+
+    # Limite de IP do servidor não deve interferir na medição
+    for policy, (_, window) in list(api_server.rate_limiter.policies.items()):
+        api_server.rate_limiter.add_policy(policy, 10 ** 9, window)
+
+    print(f"{'modo':<14}{'latência':>10}{'req/s':>12}{'erros':>8}")
+    for latency in args.latencies:
+        # O modo single fica lento demais com latência alta; limitar o volume
+        single_requests = args.requests if latency < 0.05 else max(10, int(2 / max(latency, 0.01)))
+        rps, errors = run('single', 1, latency, single_requests, args.clients)
+        print(f"{'single':<14}{latency:>9.3f}s{rps:>12.1f}{errors:>8}")
+
+        for workers in args.workers:
+            rps, errors = run('threaded', workers, latency, args.requests, args.clients)
+            print(f"{f'threaded x{workers}':<14}{latency:>9.3f}s{rps:>12.1f}{errors:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Benchmark - Mascaramento de PII em payloads de webhook Safe2Pay
+
+Compara o mask_sensitive_data antigo (copia todo dict, testa os 18 campos
+em cada nível e recria as listas) com o PIIRedactor do api_server.py
+(plano compilado, subárvores sem PII compartilhadas): tempo por chamada
+e bytes alocados por chamada, em três formatos reais de payload:
+
+    webhook   notificação Safe2Pay com Customer/Address/Products
+    evento    evento API Gateway inteiro com o webhook no body
+    status    notificação só de status (sem PII)
+
+Antes de medir, confere que as duas implementações produzem o mesmo
+resultado para cada payload.
+
+Uso:
+    python3 benchmarks/bench_pii_redaction.py
+    python3 benchmarks/bench_pii_redaction.py --iterations 50000
+"""
+
+import argparse
+import copy
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api_server  # noqa: E402
+
+api_server.logger.disabled = True
+
+
+# ==========================================
+# Implementação anterior (cópia fiel)
+# ==========================================
+
+def legacy_mask_cpf(cpf):
+    if not cpf:
+        return cpf
+    cpf_clean = re.sub(r'\D', '', str(cpf))
+    if len(cpf_clean) < 11:
+        return "***.***.***-**"
+    return f"{cpf_clean[:3]}.***.***-{cpf_clean[-2:]}"
+
+def legacy_mask_email(email):
+    if not email or '@' not in str(email):
+        return email
+    parts = str(email).split('@')
+    if len(parts[0]) <= 1:
+        return f"*@{parts[1]}"
+    return f"{parts[0][0]}{'*' * (len(parts[0]) - 1)}@{parts[1]}"
+
+def legacy_mask_phone(phone):
+    if not phone:
+        return phone
+    phone_clean = re.sub(r'\D', '', str(phone))
+    if len(phone_clean) < 10:
+        return "(**) ****-****"
+    return f"({phone_clean[:2]}) {phone_clean[2]}****-**{phone_clean[-2:]}"
+
+def legacy_mask_name(name):
+    if not name:
+        return name
+    parts = str(name).split()
+    if len(parts) <= 1:
+        return parts[0]
+    return f"{parts[0]} ***"
+
+def legacy_mask_address(address):
+    if not address:
+        return address
+    return re.sub(r'\d+', '***', str(address))
+
+def legacy_mask_sensitive_data(data):
+    if not isinstance(data, dict):
+        return data
+
+    masked = data.copy()
+
+    sensitive_fields = {
+        'cpf': legacy_mask_cpf,
+        'CPF': legacy_mask_cpf,
+        'cnpj': legacy_mask_cpf,
+        'CNPJ': legacy_mask_cpf,
+        'Identity': legacy_mask_cpf,
+        'email': legacy_mask_email,
+        'Email': legacy_mask_email,
+        'telefone': legacy_mask_phone,
+        'Phone': legacy_mask_phone,
+        'PhoneNumber': legacy_mask_phone,
+        'nome': legacy_mask_name,
+        'Name': legacy_mask_name,
+        'nomeCompleto': legacy_mask_name,
+        'nome_completo': legacy_mask_name,
+        'endereco': legacy_mask_address,
+        'Address': legacy_mask_address,
+        'Street': legacy_mask_address,
+        'logradouro': legacy_mask_address
+    }
+
+    for field, mask_func in sensitive_fields.items():
+        if field in masked:
+            masked[field] = mask_func(masked[field])
+
+    for key, value in masked.items():
+        if isinstance(value, dict):
+            masked[key] = legacy_mask_sensitive_data(value)
+        elif isinstance(value, list):
+            masked[key] = [legacy_mask_sensitive_data(item) if isinstance(item, dict) else item for item in value]
+
+    return masked
+
+
+# ==========================================
+# Payloads
+# ==========================================
+
+def webhook_payload():
+    return {
+        'IdTransaction': 48213377,
+        'TransactionStatus': {'Id': 3, 'Code': '3', 'Name': 'Autorizado'},
+        'PaymentMethod': {'Code': '6', 'Name': 'Pix'},
+        'Application': 'Certificado Digital',
+        'Vendor': 'Certificado Campinas',
+        'Reference': '1000123456',
+        'Amount': 180.0,
+        'NetValue': 178.2,
+        'PaymentDate': '2026-10-17 08:12:44',
+        'CreatedDate': '2026-10-17 08:03:10',
+        'Customer': {
+            'Name': 'Maria Aparecida dos Santos',
+            'Identity': '123.456.789-01',
+            'Email': 'maria.santos@example.com',
+            'Phone': '(19) 98765-4321',
+            'Address': {
+                'ZipCode': '13010-111',
+                'Street': 'Rua Barão de Jaguara',
+                'Number': '1481',
+                'District': 'Centro',
+                'CityName': 'Campinas',
+                'StateInitials': 'SP',
+                'CountryName': 'Brasil'
+            }
+        },
+        'Products': [
+            {'Code': '001', 'Description': 'e-CPF A1 (1 ano)', 'UnitPrice': 180.0, 'Quantity': 1}
+        ],
+        'PaymentObject': {
+            'IdTransaction': 48213377,
+            'Key': '00020101021226880014br.gov.bcb.pix2566qrpix.example.com/v2/cobv/9d36b84f',
+            'Expiration': 1296000
+        },
+        'Splits': [],
+        'Meta': {'Source': 'API', 'Attempts': [1, 2]}
+    }
+
+
+def event_payload():
+    return {
+        'version': '2.0',
+        'routeKey': 'POST /webhook/safe2pay',
+        'rawPath': '/webhook/safe2pay',
+        'rawQueryString': '',
+        'headers': {
+            'accept': '*/*',
+            'content-type': 'application/json',
+            'content-length': '1432',
+            'host': 'u4w4tf2o4f.execute-api.us-east-1.amazonaws.com',
+            'user-agent': 'Safe2Pay-Webhook/1.0',
+            'x-amzn-trace-id': 'Root=1-6710c8f2-1b2c3d4e5f6a7b8c9d0e1f2a',
+            'x-forwarded-for': '200.155.10.21',
+            'x-forwarded-port': '443',
+            'x-forwarded-proto': 'https'
+        },
+        'requestContext': {
+            'accountId': '123456789012',
+            'apiId': 'u4w4tf2o4f',
+            'domainName': 'u4w4tf2o4f.execute-api.us-east-1.amazonaws.com',
+            'domainPrefix': 'u4w4tf2o4f',
+            'http': {
+                'method': 'POST',
+                'path': '/webhook/safe2pay',
+                'protocol': 'HTTP/1.1',
+                'sourceIp': '200.155.10.21',
+                'userAgent': 'Safe2Pay-Webhook/1.0'
+            },
+            'requestId': 'fW2p3hZxIAMEb6Q=',
+            'routeKey': 'POST /webhook/safe2pay',
+            'stage': '$default',
+            'time': '17/Oct/2026:08:12:45 +0000',
+            'timeEpoch': 1792224765000
+        },
+        'isBase64Encoded': False,
+        'body': webhook_payload()
+    }
+
+
+def status_payload():
+    payload = webhook_payload()
+    del payload['Customer']
+    return payload
+
+
+PAYLOADS = [('webhook', webhook_payload), ('evento', event_payload), ('status', status_payload)]
+
+
+# ==========================================
+# Medição
+# ==========================================
+
+def time_per_call(func, payload, iterations):
+    begin = time.perf_counter()
+    for _ in range(iterations):
+        func(payload)
+    return (time.perf_counter() - begin) / iterations
+
+
+def bytes_per_call(func, payload, iterations):
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(iterations):
+        results.append(func(payload))
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20_000)
+    args = parser.parse_args()
+
+    implementations = [
+        ('legado', legacy_mask_sensitive_data),
+        ('compilado', api_server.mask_sensitive_data)
+    ]
+
+    for name, factory in PAYLOADS:
+        payload = factory()
+        original = copy.deepcopy(payload)
+        expected = legacy_mask_sensitive_data(payload)
+        got = api_server.mask_sensitive_data(payload)
+        if got != expected or payload != original:
+            sys.exit(f"❌ Resultado divergente no payload '{name}'")
+
+    print(f"{'payload':<10}{'máscara':<12}{'µs/chamada':>12}{'bytes/chamada':>16}")
+    for name, factory in PAYLOADS:
+        payload = factory()
+        for impl_name, func in implementations:
+            seconds = time_per_call(func, payload, args.iterations)
+            allocated = bytes_per_call(func, payload, min(args.iterations, 2_000))
+            print(f"{name:<10}{impl_name:<12}{seconds * 1e6:>12.2f}{allocated:>16.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Benchmark - Geração local do QR Code PIX (PixQRCode do api_server.py)
+
+Mede o tempo por payload da codificação (matriz + escolha de máscara) e da
+renderização PNG/SVG, para payloads no tamanho típico de um PIX copia-e-cola.
+
+Uso:
+    python3 benchmarks/bench_qr_encode.py
+    python3 benchmarks/bench_qr_encode.py --lengths 120 250 500 --iterations 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api_server  # noqa: E402
+
+api_server.logger.disabled = True
+
+# PIX dinâmico típico (BR Code com URL de cobrança)
+PIX_TEMPLATE = (
+    '00020101021226850014br.gov.bcb.pix2563qrcodepix.bb.com.br/pix/v2/cobv/'
+    '{txid}5204000053039865802BR5925NOME DO CLIENTE DA SILVA6009SAO PAULO62070503***6304ABCD'
+)
+
+
+def payload_of_length(length, seed):
+    payload = PIX_TEMPLATE.format(txid=f'{seed:032x}')
+    while len(payload) < length:
+        payload += payload
+    return payload[:length]
+
+
+def measure(function, iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        function(i)
+    return (time.perf_counter() - started) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', type=int, nargs='+', default=[80, 150, 250, 400])
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'bytes':>6}{'versão':>8}{'encode ms':>12}{'png ms':>10}{'svg ms':>10}{'data URI':>10}")
+    for length in args.lengths:
+        payloads = [payload_of_length(length, i) for i in range(args.iterations)]
+        codes = [api_server.PixQRCode(p) for p in payloads]
+
+        encode_ms = measure(lambda i: api_server.PixQRCode(payloads[i]), args.iterations)
+        png_ms = measure(lambda i: codes[i].png(), args.iterations)
+        svg_ms = measure(lambda i: codes[i].svg(), args.iterations)
+        uri_size = len(codes[0].data_uri())
+
+        print(f"{length:>6}{codes[0].version:>8}{encode_ms:>12.2f}{png_ms:>10.2f}{svg_ms:>10.2f}{uri_size:>10}")
+
+
+if __name__ == '__main__':
+    main()
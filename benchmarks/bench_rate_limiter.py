@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark - Rate limiter com 100 mil chaves distintas
+
+Compara o limitador antigo (lista de timestamps por IP, nunca removida)
+com o RateLimiter por janela deslizante aproximada do api_server.py:
+tempo por chamada, memória retida e chaves restantes após as chaves
+ficarem ociosas.
+
+Uso:
+    python3 benchmarks/bench_rate_limiter.py
+    python3 benchmarks/bench_rate_limiter.py --keys 100000 --hits-per-key 5 50
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api_server  # noqa: E402
+
+api_server.logger.disabled = True
+
+
+class LegacyRateLimiter:
+    """Implementação anterior: lista de timestamps por IP"""
+
+    def __init__(self, max_requests=200, window_seconds=60):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.requests = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def is_allowed(self, ip, now):
+        with self._lock:
+            self.requests[ip] = [t for t in self.requests[ip] if now - t < self.window_seconds]
+            if len(self.requests[ip]) >= self.max_requests:
+                return False
+            self.requests[ip].append(now)
+            return True
+
+
+def fill(hit, keys, hits_per_key, started_at):
+    calls = 0
+    for round_ in range(hits_per_key):
+        now = started_at + round_
+        for key in keys:
+            hit(key, now)
+            calls += 1
+    return calls
+
+
+def run(name, factory, keys, hits_per_key):
+    """
+    factory() -> (hit(key, now), idle_check(now), remaining_keys())
+
+    Tempo e memória são medidos em instâncias separadas (tracemalloc
+    distorce o tempo por chamada).
+    """
+    started_at = 1_000_000.0
+
+    hit, _, _ = factory()
+    begin = time.perf_counter()
+    calls = fill(hit, keys, hits_per_key, started_at)
+    elapsed = time.perf_counter() - begin
+
+    hit, idle_check, remaining_keys = factory()
+    tracemalloc.start()
+    fill(hit, keys, hits_per_key, started_at)
+    retained = tracemalloc.get_traced_memory()[0]
+
+    # Chaves ociosas por 10 minutos; uma chamada nova dispara a limpeza (se houver)
+    idle_check(started_at + 600)
+    after_idle = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{name:<12}{hits_per_key:>10}{elapsed / calls * 1e6:>12.2f}{retained / 1024 / 1024:>14.1f}"
+          f"{after_idle / 1024 / 1024:>16.1f}{remaining_keys():>10}")
+
+
+def legacy_factory():
+    legacy = LegacyRateLimiter(max_requests=200, window_seconds=60)
+    return legacy.is_allowed, lambda now: legacy.is_allowed('novo-ip', now), lambda: len(legacy.requests)
+
+
+def window_factory():
+    limiter = api_server.RateLimiter({'ip': (200, 60)}, sweep_interval=60)
+    limiter._next_sweep = 1_000_000.0 + 60
+    return (
+        lambda key, now: limiter.hit('ip', key, now),
+        lambda now: limiter.hit('ip', 'novo-ip', now),
+        lambda: limiter.stats()['keys']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=100_000)
+    parser.add_argument('--hits-per-key', type=int, nargs='+', default=[5, 50])
+    args = parser.parse_args()
+
+    keys = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.keys)]
+
+    print(f"{'limitador':<12}{'req/chave':>10}{'µs/chamada':>12}{'MiB retidos':>14}{'MiB pós-ociosa':>16}{'chaves':>10}")
+    for hits_per_key in args.hits_per_key:
+        run('legado', legacy_factory, keys, hits_per_key)
+        run('janela', window_factory, keys, hits_per_key)
+
+
+if __name__ == '__main__':
+    main()
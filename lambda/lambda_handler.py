@@ -6,11 +6,27 @@ Adaptação do api_server.py para Lambda + API Gateway
 
 import json
 import os
+import logging
+import logging.handlers
+import queue
+import random
 import boto3
 import requests
+from requests.adapters import HTTPAdapter
+import http.cookiejar
+import threading
+import urllib.parse
+import sqlite3
+import hashlib
+import hmac
 import re
+import base64
+import contextvars
+import zlib
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+import sys
 import time
 
 # Cliente AWS Secrets Manager
@@ -19,11 +35,13 @@ secrets_client = boto3.client('secretsmanager')
 # Cache de secrets (evita múltiplas chamadas ao Secrets Manager)
 _secrets_cache = {}
 
-# Cache de status de pagamentos (armazenados a partir dos webhooks)
-_payment_status_cache = {}
-
 # 🔒 Rate Limiter por CPF/CNPJ (previne enumeração e abuso)
-_cpf_rate_limiter = {}  # {cpf: [timestamp1, timestamp2, ...]}
+# Políticas por rota: {rota: (max_tentativas, janela_segundos)}
+CPF_RATE_LIMITS = {
+    '/api/safeweb/verificar-biometria': (5, 300),
+    '/api/safeweb/consultar-cpf': (5, 300),
+    '/api/safeweb/pre-check': (5, 300),
+}
 
 # Catálogo de produtos (source of truth para preços)
 PRODUCT_CATALOG = {
@@ -56,13 +74,18 @@ PRODUCT_CATALOG = {
 # Protege dados sensíveis em logs (LGPD/GDPR compliance)
 # ==========================================
 
+_NON_DIGITS = re.compile(r'\D+')
+_DIGIT_RUNS = re.compile(r'\d+')
+_EMAIL_PARTS = re.compile(r'([^@]*)@([^@]*)')
+
+
 def mask_cpf(cpf):
     """
     Mascara CPF para logs: 123.456.789-01 -> 123.***.***-01
     """
     if not cpf:
         return cpf
-    cpf_clean = re.sub(r'\D', '', str(cpf))
+    cpf_clean = _NON_DIGITS.sub('', str(cpf))
     if len(cpf_clean) < 11:
         return "***.***.***-**"
     return f"{cpf_clean[:3]}.***.***-{cpf_clean[-2:]}"
@@ -71,12 +94,15 @@ def mask_email(email):
     """
     Mascara email para logs: usuario@dominio.com -> u******@dominio.com
     """
-    if not email or '@' not in str(email):
+    if not email:
+        return email
+    match = _EMAIL_PARTS.match(str(email))
+    if match is None:
         return email
-    parts = str(email).split('@')
-    if len(parts[0]) <= 1:
-        return f"*@{parts[1]}"
-    return f"{parts[0][0]}{'*' * (len(parts[0]) - 1)}@{parts[1]}"
+    local, domain = match.groups()
+    if len(local) <= 1:
+        return f"*@{domain}"
+    return f"{local[0]}{'*' * (len(local) - 1)}@{domain}"
 
 def mask_phone(phone):
     """
@@ -84,7 +110,7 @@ def mask_phone(phone):
     """
     if not phone:
         return phone
-    phone_clean = re.sub(r'\D', '', str(phone))
+    phone_clean = _NON_DIGITS.sub('', str(phone))
     if len(phone_clean) < 10:
         return "(**) ****-****"
     return f"({phone_clean[:2]}) {phone_clean[2]}****-**{phone_clean[-2:]}"
@@ -96,7 +122,9 @@ def mask_name(name):
     if not name:
         return name
     parts = str(name).split()
-    if len(parts) <= 1:
+    if not parts:
+        return name
+    if len(parts) == 1:
         return parts[0]
     return f"{parts[0]} ***"
 
@@ -106,51 +134,252 @@ def mask_address(address):
     """
     if not address:
         return address
-    return re.sub(r'\d+', '***', str(address))
+    return _DIGIT_RUNS.sub('***', str(address))
+
+
+# Campos que devem ser mascarados (nome exato da chave -> máscara)
+SENSITIVE_FIELDS = {
+    'cpf': mask_cpf,
+    'CPF': mask_cpf,
+    'cnpj': mask_cpf,
+    'CNPJ': mask_cpf,
+    'Identity': mask_cpf,
+    'email': mask_email,
+    'Email': mask_email,
+    'telefone': mask_phone,
+    'Phone': mask_phone,
+    'PhoneNumber': mask_phone,
+    'nome': mask_name,
+    'Name': mask_name,
+    'nomeCompleto': mask_name,
+    'nome_completo': mask_name,
+    'endereco': mask_address,
+    'Address': mask_address,
+    'Street': mask_address,
+    'logradouro': mask_address
+}
 
-def mask_sensitive_data(data):
+
+class PIIRedactor:
     """
-    Mascara todos os dados sensíveis em um dicionário (para logs)
-    Retorna cópia com dados mascarados
+    Mascaramento de PII com plano compilado uma única vez
+
+    O plano (chave -> máscara) vira um dict e um frozenset; em cada dict do
+    payload a interseção com as chaves do plano é feita em C, e só valores
+    dict/list são visitados. Nada é copiado enquanto não houver o que
+    mascarar: subárvores sem PII são devolvidas como estão (compartilhadas
+    com a entrada), e um dict só é copiado (raso) quando algo abaixo dele
+    muda. O resultado é somente leitura - quem precisar alterá-lo deve
+    copiar antes.
     """
-    if not isinstance(data, dict):
+
+    def __init__(self, fields):
+        self.plan = dict(fields)
+        self.keys = frozenset(self.plan)
+
+    def redact(self, data):
+        if isinstance(data, dict):
+            return self._redact_dict(data)
+        if isinstance(data, list):
+            return self._redact_list(data)
         return data
 
-    masked = data.copy()
-
-    # Campos que devem ser mascarados
-    sensitive_fields = {
-        'cpf': mask_cpf,
-        'CPF': mask_cpf,
-        'cnpj': mask_cpf,
-        'CNPJ': mask_cpf,
-        'email': mask_email,
-        'Email': mask_email,
-        'telefone': mask_phone,
-        'Phone': mask_phone,
-        'PhoneNumber': mask_phone,
-        'nome': mask_name,
-        'Name': mask_name,
-        'nomeCompleto': mask_name,
-        'nome_completo': mask_name,
-        'endereco': mask_address,
-        'Address': mask_address,
-        'Street': mask_address,
-        'logradouro': mask_address
-    }
+    def _redact_dict(self, node):
+        out = None
+        hits = self.keys.intersection(node) if node else ()
+        for key in hits:
+            value = node[key]
+            masked = self.plan[key](value)
+            if isinstance(masked, (dict, list)):
+                masked = self.redact(masked)
+            if masked is not value:
+                if out is None:
+                    out = dict(node)
+                out[key] = masked
+        for key, value in node.items():
+            if key in hits or not isinstance(value, (dict, list)):
+                continue
+            redacted = self.redact(value)
+            if redacted is not value:
+                if out is None:
+                    out = dict(node)
+                out[key] = redacted
+        return node if out is None else out
+
+    def _redact_list(self, node):
+        out = None
+        for index, item in enumerate(node):
+            if not isinstance(item, (dict, list)):
+                continue
+            redacted = self.redact(item)
+            if redacted is not item:
+                if out is None:
+                    out = list(node)
+                out[index] = redacted
+        return node if out is None else out
+
+
+pii_redactor = PIIRedactor(SENSITIVE_FIELDS)
+
+
+def mask_sensitive_data(data):
+    """
+    Mascara todos os dados sensíveis em um payload (para logs)
+
+    Subárvores sem PII são compartilhadas com a entrada - não alterar o retorno.
+    """
+    return pii_redactor.redact(data)
+
+# ==========================================
+# 📝 LOGGING ESTRUTURADO (FILA + JSON)
+# ==========================================
+# Registros de uma linha JSON, com request_id/trace_id da invocação.
+# O handler só enfileira; formatação e escrita rodam na thread do
+# QueueListener e o fim do handler aguarda a fila esvaziar (o container
+# congela depois do return). Payloads verbosos saem mascarados e por
+# amostragem, com taxa por rota.
+# ==========================================
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+
+
+def parse_sample_routes(value):
+    """'/webhook/safe2pay=0.1,/api/pix/create=0.05' -> {rota: taxa}"""
+    routes = {}
+    for item in value.split(','):
+        route, _, rate = item.strip().partition('=')
+        if route and rate:
+            routes[route.strip()] = float(rate)
+    return routes
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Uma linha JSON por registro: horário, nível, mensagem, IDs da requisição e payload mascarado"""
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'trace_id': getattr(record, 'trace_id', None)
+        }
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            entry['payload'] = payload
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """Formato legível (desenvolvimento local), com o payload mascarado numa linha só"""
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        line = super().format(record)
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            line += ' ' + json.dumps(payload, ensure_ascii=False, default=str)
+        return line
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que só anota o contexto da requisição (request_id, trace_id)
+
+    Diferente do QueueHandler padrão, não formata a mensagem na thread de
+    quem chamou: formatação, JSON e I/O ficam na thread do QueueListener.
+    Com a fila cheia o registro é descartado e contado, sem o traceback
+    síncrono do handleError na thread da requisição.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        trace = _request_trace.get()
+        record.request_id = trace.request_id if trace is not None else '-'
+        record.trace_id = trace.trace_id if trace is not None else None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def payload_sampled(route):
+    """Sorteio da amostragem de payloads pela taxa da rota (LOG_PAYLOAD_SAMPLE_ROUTES)"""
+    rate = LOG_PAYLOAD_SAMPLE_ROUTES.get(route, LOG_PAYLOAD_SAMPLE_RATE) if route else LOG_PAYLOAD_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
 
-    for field, mask_func in sensitive_fields.items():
-        if field in masked:
-            masked[field] = mask_func(masked[field])
 
-    # Mascarar recursivamente em objetos aninhados
-    for key, value in masked.items():
-        if isinstance(value, dict):
-            masked[key] = mask_sensitive_data(value)
-        elif isinstance(value, list):
-            masked[key] = [mask_sensitive_data(item) if isinstance(item, dict) else item for item in value]
+def log_payload(message, payload, level=logging.INFO):
+    """
+    Registra um payload verboso (corpo de webhook, resposta upstream) mascarado e amostrado
+
+    Nível desligado ou registro fora da amostra retornam antes de qualquer
+    cópia, máscara ou serialização.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    trace = _request_trace.get()
+    if not payload_sampled(trace.route if trace is not None else None):
+        return
+    logger.log(level, message, extra={'payload': mask_sensitive_data(payload)})
+
+
+LOG_PAYLOAD_SAMPLE_ROUTES = parse_sample_routes(os.environ.get('LOG_PAYLOAD_SAMPLE_ROUTES', '/webhook/safe2pay=0.1'))
+
+log_queue = queue.Queue(maxsize=10000)
+_log_output = logging.StreamHandler(sys.stdout)
+if LOG_FORMAT == 'json':
+    _log_output.setFormatter(JsonLogFormatter())
+else:
+    _log_output.setFormatter(TextLogFormatter('[%(levelname)s] [%(request_id)s] %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, _log_output)
+log_listener.start()
+
+# Logger próprio (sem propagar para o handler do runtime da Lambda)
+logger = logging.getLogger('ecommerce')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_handler = ContextQueueHandler(log_queue)
+logger.addHandler(log_handler)
+
+# Linhas prontas (EMF, spans OTLP) passam pelo mesmo listener: saem na ordem,
+# sem intercalar com os logs, e não dependem de LOG_LEVEL
+_raw_logger = logging.getLogger('ecommerce.raw')
+_raw_logger.setLevel(logging.INFO)
+_raw_logger.propagate = False
+_raw_logger.addHandler(log_handler)
+
+
+def log_raw(line):
+    """Escreve uma linha pronta (JSON EMF/OTLP) no stdout, sem formatação"""
+    _raw_logger.info(line, extra={'raw': True})
+
+
+def flush_logs(timeout=1.0):
+    """Aguarda o listener escrever os registros da invocação (antes do container congelar)"""
+    deadline = time.monotonic() + timeout
+    with log_queue.all_tasks_done:
+        while log_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            log_queue.all_tasks_done.wait(remaining)
+    return True
 
-    return masked
 
 # ==========================================
 # 🛡️ RATE LIMITING POR CPF/CNPJ
@@ -158,6 +387,105 @@ def mask_sensitive_data(data):
 # Previne enumeração e abuso de consultas
 # ==========================================
 
+class RateLimiter:
+    """
+    Rate limiter por janela deslizante aproximada (sliding window counter)
+
+    Cada chave guarda apenas o contador da janela atual e o da anterior
+    (memória constante por chave, independente do limite). A contagem
+    estimada é `anterior * fração_restante_da_janela + atual`. Chaves sem
+    uso desde a penúltima janela são removidas periodicamente.
+    """
+
+    def __init__(self, policies, sweep_interval=60):
+        """
+        Args:
+            policies: {nome: (max_requests, window_seconds)}
+            sweep_interval: Intervalo em segundos entre remoções de chaves ociosas
+        """
+        self.policies = dict(policies)
+        self.sweep_interval = sweep_interval
+        # {política: {chave: [índice_da_janela, contagem_atual, contagem_anterior]}}
+        self._counters = {name: {} for name in self.policies}
+        self._next_sweep = time.time() + sweep_interval
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def add_policy(self, name, max_requests, window_seconds):
+        with self._lock:
+            self.policies[name] = (max_requests, window_seconds)
+            self._counters.setdefault(name, {})
+
+    def hit(self, policy, key, now=None):
+        """
+        Registra uma requisição da chave na política
+
+        Returns:
+            (bool, int, int): (permitido, requisições_restantes, retry_after_segundos)
+        """
+        max_requests, window = self.policies[policy]
+        if max_requests <= 0:
+            # Política bloqueada (limite zero): sempre nega, sem contar
+            return (False, 0, max(1, int(window)))
+        now = time.time() if now is None else now
+        window_index = int(now // window)
+        elapsed = now - window_index * window
+
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            counters = self._counters[policy]
+            counter = counters.get(key)
+            if counter is None:
+                counter = counters[key] = [window_index, 0, 0]
+            elif counter[0] != window_index:
+                # Nova janela: a atual vira anterior (ou zera se pulou mais de uma)
+                counter[2] = counter[1] if counter[0] == window_index - 1 else 0
+                counter[1] = 0
+                counter[0] = window_index
+
+            estimated = counter[2] * (1 - elapsed / window) + counter[1]
+            if estimated + 1 > max_requests:
+                return (False, 0, self._retry_after(counter, max_requests, window, elapsed))
+
+            counter[1] += 1
+            return (True, max(0, int(max_requests - estimated - 1)), 0)
+
+    @staticmethod
+    def _retry_after(counter, max_requests, window, elapsed):
+        """Segundos até a contagem estimada abrir espaço para mais uma requisição"""
+        current, previous = counter[1], counter[2]
+        if current + 1 > max_requests:
+            # Só na próxima janela, quando a atual passa a ser a anterior
+            wait = (window - elapsed) + window * (1 - (max_requests - 1) / current)
+        else:
+            wait = window * (1 - (max_requests - 1 - current) / previous) - elapsed
+        return max(1, int(wait + 0.999))
+
+    def _sweep(self, now):
+        """Remove chaves sem acesso desde a penúltima janela (contagem estimada já é zero)"""
+        for name, counters in self._counters.items():
+            oldest_active = int(now // self.policies[name][1]) - 1
+            active = {key: counter for key, counter in counters.items() if counter[0] >= oldest_active}
+            self._evicted += len(counters) - len(active)
+            # Dicionário novo: o antigo não devolve memória ao remover chaves
+            self._counters[name] = active
+        self._next_sweep = now + self.sweep_interval
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': sum(len(counters) for counters in self._counters.values()),
+                'evicted': self._evicted,
+                'policies': {name: {'limit': limit, 'window': window} for name, (limit, window) in self.policies.items()}
+            }
+
+
+# Instância do container (contadores por CPF sobrevivem entre invocações quentes)
+rate_limiter = RateLimiter({})
+
+
 def check_cpf_rate_limit(cpf, max_attempts=5, window_seconds=300):
     """
     Verifica rate limit por CPF/CNPJ
@@ -168,316 +496,2215 @@ def check_cpf_rate_limit(cpf, max_attempts=5, window_seconds=300):
         window_seconds: Janela de tempo em segundos (default: 5 minutos)
 
     Returns:
-        (bool, int): (permitido, tentativas_restantes)
+        (bool, int, int): (permitido, tentativas_restantes, retry_after)
     """
     if not cpf:
-        return (True, max_attempts)
+        return (True, max_attempts, 0)
 
     # Limpar CPF (apenas números)
     cpf_clean = re.sub(r'\D', '', str(cpf))
 
-    now = time.time()
+    policy = f'cpf:{max_attempts}/{window_seconds}'
+    if policy not in rate_limiter.policies:
+        rate_limiter.add_policy(policy, max_attempts, window_seconds)
 
-    # Inicializar lista de tentativas se não existir
-    if cpf_clean not in _cpf_rate_limiter:
-        _cpf_rate_limiter[cpf_clean] = []
+    allowed, remaining, retry_after = distributed_rate_limiter.hit(policy, cpf_clean)
+    if not allowed:
+        logger.warning(f"🚫 Rate limit excedido para CPF {mask_cpf(cpf_clean)}: {max_attempts} tentativas em {window_seconds}s")
 
-    attempts = _cpf_rate_limiter[cpf_clean]
-
-    # Remover tentativas antigas (fora da janela)
-    attempts[:] = [t for t in attempts if now - t < window_seconds]
-
-    # Verificar se excedeu o limite
-    if len(attempts) >= max_attempts:
-        retry_after = int(window_seconds - (now - attempts[0]))
-        print(f"🚫 Rate limit excedido para CPF {mask_cpf(cpf_clean)}: {len(attempts)}/{max_attempts} tentativas")
-        return (False, 0, retry_after)
-
-    # Adicionar tentativa atual
-    attempts.append(now)
-    remaining = max_attempts - len(attempts)
-
-    return (True, remaining, 0)
+    return (allowed, remaining, retry_after)
 
 def get_secret(secret_arn):
     """Busca secret do AWS Secrets Manager com cache"""
     if secret_arn in _secrets_cache:
         return _secrets_cache[secret_arn]
 
+    started = time.perf_counter()
+    start_ns = time.time_ns()
     response = secrets_client.get_secret_value(SecretId=secret_arn)
+    record_timing('secret', time.perf_counter() - started, 'Secrets Manager')
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.add_span('SecretsManager GetSecretValue', start_ns, time.time_ns(), {'rpc.service': 'SecretsManager'})
     secret_data = json.loads(response['SecretString'])
     _secrets_cache[secret_arn] = secret_data
     return secret_data
 
 
-class Validator:
-    """Validação de dados (copiado do api_server.py)"""
+# ==========================================
+# 📈 MÉTRICAS DE LATÊNCIA (CLOUDWATCH EMF)
+# ==========================================
+# Rota da invocação e cada chamada upstream (host + endpoint, status ou
+# timeout) são acumuladas durante a invocação e impressas numa única
+# linha Embedded Metric Format no fim do handler: o CloudWatch extrai as
+# métricas do log, sem chamadas a PutMetricData no caminho da requisição.
+# ==========================================
 
-    @staticmethod
-    def validate_cpf_or_cnpj(documento):
-        if not documento:
-            return False, "CPF ou CNPJ é obrigatório"
-        doc_limpo = re.sub(r'\D', '', documento)
-        if len(doc_limpo) == 11:
-            if doc_limpo == doc_limpo[0] * 11:
-                return False, "CPF inválido"
-            return True, doc_limpo
-        elif len(doc_limpo) == 14:
-            if doc_limpo == doc_limpo[0] * 14:
-                return False, "CNPJ inválido"
-            return True, doc_limpo
-        else:
-            return False, "Documento deve ter 11 (CPF) ou 14 (CNPJ) dígitos"
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Ecommerce/API')
+METRICS_SERVICE = 'ecommerce-api-lambda'
 
-    @staticmethod
-    def validate_email(email):
-        if not email:
-            return False, "Email é obrigatório"
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(pattern, email):
-            return False, "Email inválido"
-        return True, email
+# Rotas com parâmetro no caminho: a dimensão leva o modelo da rota, nunca o valor enviado
+METRIC_ROUTE_TEMPLATES = (
+    ('/api/pix/status/', '/api/pix/status/{id}'),
+    ('/api/pix/wait/', '/api/pix/wait/{id}'),
+)
 
-    @staticmethod
-    def validate_telefone(telefone):
-        if not telefone:
-            return False, "Telefone é obrigatório"
-        tel_limpo = re.sub(r'\D', '', telefone)
-        if len(tel_limpo) < 10 or len(tel_limpo) > 11:
-            return False, "Telefone deve ter 10 ou 11 dígitos"
-        return True, tel_limpo
+# Rotas fixas conhecidas; qualquer outro caminho (seja qual for o status) vira 'unmatched'
+METRIC_ROUTES = frozenset((
+    '/api/health', '/api/metrics', '/api/ops/outbox', '/api/proxy-image', '/api/pix/create',
+    '/api/checkout', '/api/safeweb/verificar-biometria', '/api/safeweb/consultar-cpf',
+    '/api/safeweb/gerar-protocolo', '/api/safeweb/pre-check', '/api/hope/create-solicitation',
+    '/webhook/safe2pay'
+))
 
-    @staticmethod
-    def validate_checkout_data(dados):
-        erros = []
+# Segmentos com cara de ID (números longos, hashes, UUIDs) viram {id} nas dimensões
+_METRIC_ID_SEGMENT = re.compile(r'^(\d{4,}|[0-9a-fA-F-]{16,}|(?=.*\d)[A-Za-z0-9_.-]{8,})$')
 
-        is_valid, result = Validator.validate_cpf_or_cnpj(dados.get('cpf'))
-        if not is_valid:
-            erros.append(result)
 
-        nome = dados.get('nome_completo', '').strip()
-        if not nome or len(nome) < 3:
-            erros.append('Nome é obrigatório (mínimo 3 caracteres)')
+def metric_route_label(path):
+    """Dimensão de rota da API: só rotas conhecidas, o resto agrupado em 'unmatched'"""
+    path = urllib.parse.urlsplit(path or '').path
+    if path in METRIC_ROUTES:
+        return path
+    return next((template for prefix, template in METRIC_ROUTE_TEMPLATES if path.startswith(prefix)), 'unmatched')
 
-        is_valid, result = Validator.validate_email(dados.get('email'))
-        if not is_valid:
-            erros.append(result)
 
-        is_valid, result = Validator.validate_telefone(dados.get('telefone'))
-        if not is_valid:
-            erros.append(result)
+def metric_path_label(path):
+    """Caminho sem query e com IDs trocados por {id} (cardinalidade limitada)"""
+    path = urllib.parse.urlsplit(path).path or '/'
+    return '/'.join('{id}' if _METRIC_ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
 
-        if erros:
-            return False, erros
-        return True, None
 
+class InvocationMetrics:
+    """
+    Métricas de uma invocação, emitidas numa única linha CloudWatch EMF
 
-class Safe2PayAPI:
-    """Cliente Safe2Pay para Lambda"""
+    A latência da rota sai com as dimensões Route/Method/Status. Cada
+    upstream vira uma métrica própria (UpstreamLatency <host><endpoint>,
+    com todas as chamadas da invocação no mesmo array) e timeouts/erros
+    viram contadores; o detalhe por chamada, com o status HTTP, vai junto
+    na linha para consultas no Logs Insights.
+    """
 
-    def __init__(self):
-        secret_arn = os.environ.get('SAFE2PAY_SECRET_ARN')
-        if not secret_arn:
-            raise Exception("SAFE2PAY_SECRET_ARN não configurado")
+    def __init__(self, namespace=METRICS_NAMESPACE, service=METRICS_SERVICE):
+        self.namespace = namespace
+        self.service = service
+        self._upstream = []
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._upstream = []
+
+    def record_upstream(self, host, endpoint, method, status, seconds):
+        with self._lock:
+            self._upstream.append({
+                'host': host,
+                'endpoint': endpoint,
+                'method': method,
+                'status': status,
+                'ms': round(seconds * 1000, 1)
+            })
+
+    def build(self, route, method, status, seconds, properties=None):
+        """Monta o documento EMF da invocação (properties: campos extras, sem virar métrica)"""
+        with self._lock:
+            calls = list(self._upstream)
+
+        document = {
+            'Service': self.service,
+            'Route': route,
+            'Method': method,
+            'Status': str(status),
+            'RequestLatency': round(seconds * 1000, 1),
+            'upstream': calls,
+            **(properties or {})
+        }
+        upstream_metrics = []
+        for call in calls:
+            target = f"{call['host']}{call['endpoint']}"
+            latency_name = f"UpstreamLatency {target}"
+            if latency_name not in document:
+                document[latency_name] = []
+                upstream_metrics.append({'Name': latency_name, 'Unit': 'Milliseconds'})
+            document[latency_name].append(call['ms'])
+
+            if call['status'] in ('timeout', 'error') or call['status'].startswith('5'):
+                counter_name = f"{'UpstreamTimeouts' if call['status'] == 'timeout' else 'UpstreamErrors'} {target}"
+                if counter_name not in document:
+                    document[counter_name] = 0
+                    upstream_metrics.append({'Name': counter_name, 'Unit': 'Count'})
+                document[counter_name] += 1
+
+        directives = [{
+            'Namespace': self.namespace,
+            'Dimensions': [['Route', 'Method', 'Status']],
+            'Metrics': [{'Name': 'RequestLatency', 'Unit': 'Milliseconds'}]
+        }]
+        if upstream_metrics:
+            # EMF aceita até 100 métricas por diretiva
+            for start in range(0, len(upstream_metrics), 100):
+                directives.append({
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': upstream_metrics[start:start + 100]
+                })
 
-        secret = get_secret(secret_arn)
-        self.token = secret['token']
-        self.api_url = secret['base_url']
-        self.pix_expiration = 30
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': directives
+        }
+        return document
 
-    def create_pix_payment(self, dados_checkout):
-        """Criar pagamento PIX Dinâmico - OTIMIZADO"""
+    def emit(self, route, method, status, seconds, properties=None):
+        try:
+            log_raw(json.dumps(self.build(route, method, status, seconds, properties), ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao emitir métricas: {str(e)}")
+        finally:
+            self.reset()
 
-        # OTIMIZAÇÃO: Validação mínima para máxima velocidade
-        if not dados_checkout.get('protocolo'):
-            return {'sucesso': False, 'erro': 'Protocolo é obrigatório'}
 
-        try:
-            # VALIDAÇÃO DE SEGURANÇA: Obter produto do catálogo (source of truth)
-            product_id = dados_checkout.get('product_id', 'ecpf-a1')  # Default: e-CPF A1
+# Coletor da invocação atual (o container atende uma invocação por vez)
+invocation_metrics = InvocationMetrics()
 
-            if product_id not in PRODUCT_CATALOG:
-                print(f"❌ Produto inválido: {product_id}")
-                return {
-                    'sucesso': False,
-                    'erro': 'Produto inválido',
-                    'detalhes': f'Produto {product_id} não existe no catálogo'
-                }
 
-            product = PRODUCT_CATALOG[product_id]
+class ServerTiming:
+    """
+    Spans de uma requisição (segredo, token, upstreams, serialização) para o header Server-Timing
+    (copiado do api_server.py)
+    """
 
-            # VALIDAÇÃO CRÍTICA: Verificar se valor enviado corresponde ao catálogo
-            valor_enviado = dados_checkout.get('valor')
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, desc=None):
+        with self._lock:
+            self._spans.append((name, round(seconds * 1000, 1), desc))
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def header(self):
+        """Valor do header: um item por span + o total da requisição"""
+        with self._lock:
+            spans = list(self._spans)
+        items = []
+        for name, ms, desc in spans:
+            item = f"{name};dur={ms}"
+            if desc:
+                # Header HTTP: só ASCII, sem aspas ou barras dentro do desc
+                desc = desc.encode('ascii', 'ignore').decode('ascii').replace('\\', '').replace('"', '')
+                item += f';desc="{desc}"'
+            items.append(item)
+        items.append(f"total;dur={self.total_ms()}")
+        return ', '.join(items)
+
+    def as_dict(self):
+        """Mesmos spans para o corpo da resposta (header X-Debug-Timing)"""
+        with self._lock:
+            spans = list(self._spans)
+        return {
+            'total_ms': self.total_ms(),
+            'spans': [{'name': name, 'ms': ms, 'desc': desc} for name, ms, desc in spans]
+        }
 
-            # 🔍 LOG DETALHADO PARA DEBUG
-            print(f"=" * 80)
-            print(f"🔍 DEBUG - VALIDAÇÃO DE PREÇO")
-            print(f"=" * 80)
-            print(f"📦 Product ID: {product_id}")
-            print(f"💰 Valor no catálogo: R$ {product['price']} (tipo: {type(product['price'])})")
-            print(f"📥 Valor recebido (raw): {repr(valor_enviado)} (tipo: {type(valor_enviado)})")
-            print(f"📋 Dados completos recebidos: {dados_checkout}")
-            print(f"=" * 80)
 
-            if valor_enviado is not None:
-                valor_enviado = float(valor_enviado)
-                print(f"📥 Valor recebido (convertido): {valor_enviado} (tipo: {type(valor_enviado)})")
-                print(f"🔢 Diferença: {abs(valor_enviado - product['price'])}")
+# Spans da invocação atual (copiados para as tarefas do BoundedExecutor)
+_request_timing = contextvars.ContextVar('request_timing', default=None)
 
-                # TEMPORÁRIO: Aceitar 5.00 OU 8.00 devido a cache CloudFront
-                valores_aceitos = [5.00, 8.00]
-                valor_valido = any(abs(valor_enviado - v) <= 0.01 for v in valores_aceitos)
 
-                if not valor_valido:
-                    print(f"🚨 VALOR INVÁLIDO!")
-                    print(f"   - Valor enviado: R$ {valor_enviado}")
-                    print(f"   - Valor correto: R$ {product['price']}")
-                    print(f"=" * 80)
-                    return {
-                        'sucesso': False,
-                        'erro': 'Valor inválido',
-                        'detalhes': f'Valor enviado (R$ {valor_enviado}) não corresponde'
-                    }
-                else:
-                    if abs(valor_enviado - 5.00) <= 0.01:
-                        print(f"⚠️  Valor antigo R$ 5.00 aceito temporariamente")
-                    print(f"✅ Validação OK!")
-                    print(f"=" * 80)
+def record_timing(name, seconds, desc=None):
+    """Registra um span na requisição atual (sem requisição, ex.: renovação em background, não faz nada)"""
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add(name, seconds, desc)
 
-            # OTIMIZADO: PIX Dinâmico (com apenas dados essenciais)
-            protocolo = dados_checkout.get('protocolo', f"ECPF-{datetime.now().strftime('%Y%m%d%H%M%S')}")
 
-            # Safe2Pay exige descrição com no máximo 30 caracteres
-            description_short = product['description'][:30] if len(product['description']) > 30 else product['description']
+def serialize_body(data, **kwargs):
+    """json.dumps do corpo da resposta, medido como span 'serialize'"""
+    started = time.perf_counter()
+    body = json.dumps(data, **kwargs)
+    record_timing('serialize', time.perf_counter() - started)
+    return body
 
-            # PIX DINÂMICO: Usar dados do formulário do usuário
-            # Limpar CPF e CEP (remover formatação)
-            cpf_raw = str(dados_checkout.get('cpf', ''))
-            cpf = cpf_raw.replace('.', '').replace('-', '').replace(' ', '').strip()
 
-            cep_raw = str(dados_checkout.get('cep', ''))
-            cep = cep_raw.replace('-', '').replace(' ', '').strip()
+# ==========================================
+# 🔗 TRACING (X-REQUEST-ID + OTLP/JSON)
+# ==========================================
+# Cada invocação tem um request_id (X-Request-ID recebido ou gerado) e um
+# trace_id (traceparent recebido ou gerado), repassados aos upstreams. Os
+# spans (upstreams, Secrets Manager) saem numa linha OTLP/JSON no fim da
+# invocação, junto com a linha EMF. Como o container atende uma invocação
+# por vez, os logs entre a linha "🔗" e o trace pertencem à requisição.
+# ==========================================
 
-            print(f"📋 CPF recebido: '{cpf_raw}' → limpo: '{cpf}' (len={len(cpf)})")
-            print(f"📋 CEP recebido: '{cep_raw}' → limpo: '{cep}' (len={len(cep)})")
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT', 'stdout')
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/ecommerce-traces.jsonl')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'ecommerce-api-lambda')
+# Só hosts parceiros que aceitam os headers recebem X-Request-ID/traceparent (vazio = nenhum)
+TRACE_PROPAGATION_HOSTS = {h.strip() for h in os.environ.get('TRACE_PROPAGATION_HOSTS', '').split(',') if h.strip()}
+
+# Trace da invocação atual (copiado para as tarefas do BoundedExecutor)
+_request_trace = contextvars.ContextVar('request_trace', default=None)
+
+
+# W3C traceparent (versão 00) e X-Request-ID aceitos do cliente
+_TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+# Códigos OTLP (SpanKind / StatusCode)
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_CONSUMER = 5
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+
+
+def _otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
 
-            payment_data = {
-                "IsSandbox": False,
-                "Application": "Certificado Digital",
-                "Vendor": "Certificado Campinas",
-                "CallbackUrl": "https://u4w4tf2o4f.execute-api.us-east-1.amazonaws.com/webhook/safe2pay",
-                "PaymentMethod": "6",  # PIX
-                "Reference": str(protocolo),
-                "Customer": {
-                    "Name": dados_checkout.get('nome_completo', 'Cliente'),
-                    "Identity": cpf,
-                    "Address": {
-                        "ZipCode": cep or "00000000",
-                        "Street": dados_checkout.get('endereco', 'Rua'),
-                        "Number": dados_checkout.get('numero', 'S/N'),
-                        "District": dados_checkout.get('bairro', 'Centro'),
-                        "CityName": dados_checkout.get('cidade', 'Cidade'),
-                        "StateInitials": dados_checkout.get('uf', 'SP'),
-                        "CountryName": "Brasil"
-                    }
-                },
-                "PaymentObject": {
-                    "Expiration": 1296000  # 15 dias (15 dias × 24h × 60min × 60s)
-                },
-                "Products": [
-                    {
-                        "Code": product['code'],
-                        "Description": description_short,
-                        "UnitPrice": product['price'],
-                        "Quantity": 1
-                    }
-                ]
-            }
 
-            headers = {
-                'Content-Type': 'application/json',
-                'X-API-KEY': self.token
-            }
+class RequestTrace:
+    """
+    Trace de uma requisição: IDs de correlação e spans no formato OTLP/JSON
 
-            # OTIMIZADO: Chamada rápida sem logs pesados
-            response = requests.post(
-                f"{self.api_url}/Payment",
-                json=payment_data,
-                headers=headers,
-                timeout=10  # OTIMIZADO: 10s
-            )
+    O trace_id vem do `traceparent` recebido (ou é gerado); o request_id é o
+    X-Request-ID recebido, ou o próprio trace_id. Os spans ficam em memória
+    até o fim da requisição e saem numa única linha pelo TraceExporter.
+    """
 
-            if response.status_code in [200, 201]:
-                result = response.json()
+    def __init__(self, request_id=None, traceparent=None, kind=SPAN_KIND_SERVER):
+        match = _TRACEPARENT_PATTERN.match(traceparent or '')
+        self.trace_id = match.group(1) if match else os.urandom(16).hex()
+        self.parent_span_id = match.group(2) if match else None
+        self.request_id = request_id if request_id and _REQUEST_ID_PATTERN.match(request_id) else self.trace_id
+        self.span_id = os.urandom(8).hex()
+        self.kind = kind
+        self.route = None  # rota da API (amostragem de logs por rota)
+        self.start_ns = time.time_ns()
+        self._spans = []
+        self._lock = threading.Lock()
 
-                print(f"✅ Safe2Pay Payment (PIX Dinâmico) Response: {json.dumps(result, indent=2)}")
+    @staticmethod
+    def new_span_id():
+        return os.urandom(8).hex()
+
+    def traceparent(self, span_id):
+        """Header traceparent para uma chamada filha deste trace"""
+        return f"00-{self.trace_id}-{span_id}-01"
+
+    def add_span(self, name, start_ns, end_ns, attributes, error=False, span_id=None, kind=SPAN_KIND_CLIENT):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': span_id or self.new_span_id(),
+            'parentSpanId': self.span_id,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(end_ns),
+            'attributes': _otlp_attributes(attributes),
+            'status': {'code': SPAN_STATUS_ERROR if error else SPAN_STATUS_OK}
+        }
+        with self._lock:
+            self._spans.append(span)
+
+    def finish(self, name, attributes, error=False):
+        """Fecha o span raiz e retorna o documento OTLP/JSON (resourceSpans) da requisição"""
+        root = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(time.time_ns()),
+            'attributes': _otlp_attributes({'http.request_id': self.request_id, **attributes}),
+            'status': {'code': SPAN_STATUS_ERROR if error else SPAN_STATUS_OK}
+        }
+        if self.parent_span_id:
+            root['parentSpanId'] = self.parent_span_id
+        with self._lock:
+            spans = [root] + self._spans
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({'service.name': TRACE_SERVICE_NAME})},
+                'scopeSpans': [{'scope': {'name': 'ecommerce.tracing'}, 'spans': spans}]
+            }]
+        }
 
-                if result.get('HasError'):
-                    return {
-                        'sucesso': False,
-                        'erro': f"Erro Safe2Pay: {result.get('ErrorMessage', result.get('Error', 'Desconhecido'))}"
-                    }
 
-                response_detail = result.get('ResponseDetail', {})
-                # Safe2Pay retorna Key e QrCode direto no ResponseDetail, não em PaymentObject
-                pix_key = response_detail.get('Key', '')
-                qr_code_image = response_detail.get('QrCode', '')
+def trace_propagation_allowed(host):
+    """Hosts upstream que recebem X-Request-ID/traceparent (TRACE_PROPAGATION_HOSTS, '*' = todos)"""
+    return '*' in TRACE_PROPAGATION_HOSTS or host in TRACE_PROPAGATION_HOSTS
 
-                print(f"📋 ResponseDetail.IdTransaction: {response_detail.get('IdTransaction')}")
-                print(f"📋 ResponseDetail.Key (PIX): {pix_key[:50]}..." if pix_key else "None")
-                print(f"📋 ResponseDetail.QrCode: {qr_code_image}")
 
-                return {
-                    'sucesso': True,
-                    'dados': {
-                        'transactionId': str(response_detail.get('IdTransaction')),
-                        'qrCode': pix_key,
-                        'qrCodeImage': qr_code_image,
-                        'pixCopiaECola': pix_key,
-                        'valor': product['price'],
-                        'status': 'pending',
-                        'reference': payment_data['Reference'],
-                        'expiresAt': (datetime.now() + timedelta(minutes=30)).isoformat()
-                    }
-                }
-            else:
-                error_text = response.text
-                print(f"❌ Erro HTTP {response.status_code}: {error_text}")
-                return {
-                    'sucesso': False,
-                    'erro': f'Erro HTTP {response.status_code}',
-                    'detalhes': error_text
-                }
+def trace_upstream_call(method, url, kwargs):
+    """
+    Prepara o span de uma chamada upstream da requisição atual
 
-        except Exception as e:
-            print(f"❌ Exception ao criar PIX: {str(e)}")
-            return {
-                'sucesso': False,
-                'erro': 'Erro interno',
-                'detalhes': str(e)
+    Returns:
+        (trace, span_id) - e os headers de correlação já incluídos em kwargs -
+        ou (None, None) fora de uma requisição
+    """
+    trace = _request_trace.get()
+    if trace is None:
+        return None, None
+
+    span_id = trace.new_span_id()
+    if trace_propagation_allowed(urllib.parse.urlsplit(url).netloc):
+        kwargs['headers'] = {
+            **(kwargs.get('headers') or {}),
+            'X-Request-ID': trace.request_id,
+            'traceparent': trace.traceparent(span_id)
+        }
+    return trace, span_id
+
+
+class TraceExporter:
+    """Grava o trace da invocação (uma linha OTLP/JSON); síncrono, threads congelam com o container"""
+
+    def __init__(self, target):
+        """
+        Args:
+            target: 'stdout', 'off' ou caminho do arquivo (JSON Lines)
+        """
+        self.target = target
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, document):
+        if self.target == 'off':
+            return
+        try:
+            line = json.dumps(document, separators=(',', ':'))
+            if self.target == 'stdout':
+                log_raw(line)
+            else:
+                with open(self.target, 'a', encoding='utf-8') as stream:
+                    stream.write(line + '\n')
+            self.exported += 1
+        except Exception as e:
+            self.dropped += 1
+            logger.warning(f"⚠️ Erro ao gravar trace: {str(e)}")
+
+    def stats(self):
+        return {'target': self.target, 'exported': self.exported, 'dropped': self.dropped}
+
+
+trace_exporter = TraceExporter(TRACE_FILE if TRACE_EXPORT == 'file' else TRACE_EXPORT)
+
+
+def attach_server_timing(response, timing, debug=False, request_id=None):
+    """Adiciona Server-Timing e X-Request-ID (e, com X-Debug-Timing: 1, os spans no corpo) à resposta HTTP"""
+    if not isinstance(response, dict) or 'statusCode' not in response:
+        return response
+
+    headers = dict(response.get('headers') or {})
+    if debug:
+        try:
+            data = json.loads(response.get('body') or '{}')
+            if isinstance(data, dict):
+                data['_timings'] = timing.as_dict()
+                response = {**response, 'body': json.dumps(data, ensure_ascii=False)}
+        except ValueError:
+            pass
+
+    headers['Server-Timing'] = timing.header()
+    headers['Timing-Allow-Origin'] = headers.get('Access-Control-Allow-Origin', '*')
+    if request_id:
+        headers['X-Request-ID'] = request_id
+    return {**response, 'headers': headers}
+
+
+# ==========================================
+# 🌐 SESSÕES HTTP UPSTREAM (KEEP-ALIVE)
+# ==========================================
+# Uma Session com pool de conexões por host upstream, criada no módulo
+# para sobreviver entre invocações quentes do mesmo container
+# ==========================================
+
+class UpstreamHTTP:
+    """Sessões HTTP keep-alive compartilhadas por host (copiado do api_server.py)"""
+
+    def __init__(self, pool_maxsize=4):
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}  # {origin: Session}
+        self._lock = threading.Lock()
+
+    def _session_for(self, url):
+        parts = urllib.parse.urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+
+        session = self._sessions.get(origin)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(origin)
+                if session is None:
+                    session = requests.Session()
+                    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._sessions[origin] = session
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        trace, span_id = trace_upstream_call(method, url, kwargs)
+        start_ns = time.time_ns()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self._session_for(url).request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            parts = urllib.parse.urlsplit(url)
+            endpoint = metric_path_label(parts.path)
+            invocation_metrics.record_upstream(parts.netloc, endpoint, method, status, elapsed)
+            record_timing('upstream', elapsed, f"{parts.netloc}{endpoint} {status}")
+            if trace is not None:
+                trace.add_span(f"{method} {parts.netloc}{endpoint}", start_ns, time.time_ns(), {
+                    'http.request.method': method,
+                    'server.address': parts.netloc,
+                    'url.path': endpoint,
+                    'http.response.status_code': int(status) if status.isdigit() else None,
+                    'error.type': None if status.isdigit() else status
+                }, error=not status.isdigit() or status.startswith('5'), span_id=span_id)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Por host: requisições que reutilizaram conexão vs. conexões novas abertas"""
+        result = {}
+
+        for origin, session in list(self._sessions.items()):
+            pools = session.get_adapter(origin).poolmanager.pools
+            total_requests = 0
+            new_connections = 0
+
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    new_connections += pool.num_connections
+
+            result[urllib.parse.urlsplit(origin).netloc] = {
+                'requests': total_requests,
+                'new_connections': new_connections,
+                'reused_connections': max(0, total_requests - new_connections),
+                'pool_maxsize': self.pool_maxsize
             }
 
-    def check_payment_status(self, transaction_id):
+        return result
+
+
+# Sessões upstream reutilizadas entre invocações quentes
+upstream_http = UpstreamHTTP(pool_maxsize=int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 4)))
+
+
+# ==========================================
+# ⚡ MICRO-CACHE DE CONSULTAS AO SAFE2PAY
+# ==========================================
+# Enquanto o webhook não chega, consultas simultâneas da mesma transação
+# (abas abertas, retries) compartilham uma chamada a /transaction/get.
+# Sem revalidação em background: threads congelam junto com o container.
+# ==========================================
+
+class _InflightLoad:
+    """Chamada ao upstream em andamento: resultado (ou exceção) entregue a quem aguarda"""
+
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_COALESCED = object()  # marcador: aguardar a chamada de outra requisição
+
+
+class MicroCache:
+    """
+    Cache de curta duração com stale-while-revalidate e coalescência de requisições
+
+    - Dentro de `ttl` a resposta é servida do cache (hit)
+    - Entre `ttl` e `ttl + stale_ttl` a resposta antiga é servida enquanto uma
+      única revalidação roda (stale)
+    - Requisições simultâneas pela mesma chave sem cache aguardam uma única
+      chamada ao upstream (coalesced)
+    """
+
+    def __init__(self, ttl, stale_ttl, max_entries=5000, background=True):
+        """
+        Args:
+            ttl: Segundos em que a resposta é considerada fresca
+            stale_ttl: Segundos extras em que a resposta antiga ainda pode ser servida
+            max_entries: Máximo de chaves em cache (LRU)
+            background: Revalida em thread separada. Sem ela, quem encontra a
+                entrada vencida revalida e as requisições simultâneas recebem a antiga
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.background = background
+        self._entries = OrderedDict()   # chave -> (valor, armazenado_em)
+        self._inflight = {}             # chave -> _InflightLoad da chamada em andamento
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0, 'revalidations': 0, 'errors': 0}
+
+    def get_or_load(self, key, loader, cacheable=lambda value: True):
+        """
+        Retorna o valor da chave, chamando `loader()` no máximo uma vez por vez
+
+        Requisições coalescidas recebem o resultado da chamada em andamento,
+        inclusive quando ele não é cacheável (erro do upstream) ou é uma
+        exceção: uma queda do upstream não vira uma chamada por requisição.
+        Na revalidação sem background, um resultado não cacheável devolve a
+        resposta antiga.
+
+        Args:
+            key: Chave do cache
+            loader: Função sem argumentos que consulta o upstream
+            cacheable: Define se o resultado do loader pode ser armazenado
+                (erros não são cacheados)
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            age = now - entry[1] if entry else None
+
+            if entry and age < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[0]
+
+            flight = self._inflight.get(key)
+            if entry and age < self.ttl + self.stale_ttl:
+                # Resposta antiga: servir e garantir uma única revalidação
+                self._stats['stale_hits'] += 1
+                if flight is not None:
+                    return entry[0]
+                flight = self._inflight[key] = _InflightLoad()
+                self._stats['revalidations'] += 1
+                if self.background:
+                    threading.Thread(target=self._revalidate, args=(key, flight, loader, cacheable), daemon=True).start()
+                    return entry[0]
+                stale_value = entry[0]
+            elif flight is None:
+                flight = self._inflight[key] = _InflightLoad()
+                self._stats['misses'] += 1
+                stale_value = None
+            else:
+                self._stats['coalesced'] += 1
+                stale_value = _COALESCED
+
+        if stale_value is _COALESCED:
+            # Aguardar a chamada em andamento e devolver o mesmo resultado
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = self._load(key, flight, loader, cacheable)
+        except Exception:
+            if stale_value is None:
+                raise
+            return stale_value
+        if stale_value is not None and not cacheable(value):
+            return stale_value
+        return value
+
+    def _revalidate(self, key, flight, loader, cacheable):
+        """Revalidação em background: o erro já foi contado em _load, aqui só é registrado"""
+        try:
+            self._load(key, flight, loader, cacheable)
+        except Exception as e:
+            logger.warning(f"⚠️ MicroCache: revalidação em background falhou: {str(e)}")
+
+    def _load(self, key, flight, loader, cacheable):
+        try:
+            value = loader()
+            flight.value = value
+            if cacheable(value):
+                with self._lock:
+                    self._entries[key] = (value, time.time())
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            else:
+                with self._lock:
+                    self._stats['errors'] += 1
+            return value
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+            flight.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl
+            }
+
+
+transaction_status_cache = MicroCache(
+    ttl=float(os.environ.get('TRANSACTION_CACHE_TTL', 3)),
+    stale_ttl=float(os.environ.get('TRANSACTION_CACHE_STALE', 10)),
+    background=False
+)
+
+
+class SafewebLookupCache:
+    """
+    Cache TTL das consultas Safeweb (biometria e RFB) com chave em hash salgado
+
+    - Nenhum CPF em claro fica em memória: a chave é um HMAC-SHA256 das
+      entradas e o campo `cpf` é removido do resultado armazenado
+    - Resultados positivos e negativos têm TTLs separados
+    - Erros transitórios (HTTP, exceções, código 999) não são cacheados
+    """
+
+    def __init__(self, positive_ttl, negative_ttl, max_entries=10000, salt=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._salt = salt.encode('utf-8') if salt else os.urandom(16)
+        self._entries = OrderedDict()   # hash -> (resultado, expira_em)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'evictions': 0}
+
+    def _key(self, parts):
+        return hmac.new(self._salt, '\x1f'.join(parts).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def get_or_load(self, parts, loader, classify):
+        """
+        Retorna o resultado em cache ou chama `loader()` e armazena conforme `classify`
+
+        Args:
+            parts: Entradas da consulta (tipo, CPF, ...) que formam a chave
+            loader: Função sem argumentos que consulta a Safeweb
+            classify: Recebe o resultado e retorna 'positive', 'negative' ou
+                None (não cachear)
+        """
+        key = self._key(parts)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return dict(entry[0])
+            if entry:
+                del self._entries[key]
+            self._stats['misses'] += 1
+
+        resultado = loader()
+        kind = classify(resultado)
+        with self._lock:
+            if kind is None:
+                self._stats['skipped'] += 1
+                return resultado
+            ttl = self.positive_ttl if kind == 'positive' else self.negative_ttl
+            stored = {k: v for k, v in resultado.items() if k != 'cpf'}
+            self._entries[key] = (stored, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return resultado
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+                'positive_ttl': self.positive_ttl,
+                'negative_ttl': self.negative_ttl
+            }
+
+
+# Códigos da consulta prévia RFB que são respostas definitivas (1-5: CPF inválido,
+# inexistente, cancelado, data divergente, nulo). 700 e 999 não são cacheados.
+RFB_NEGATIVE_CODES = (1, 2, 3, 4, 5)
+
+
+def classify_biometria_result(resultado):
+    if not resultado.get('sucesso'):
+        return None
+    return 'positive' if resultado.get('temBiometria') else 'negative'
+
+
+def classify_consulta_result(resultado):
+    if 'erro' in resultado:
+        return None
+    if resultado.get('codigo') == 0:
+        return 'positive'
+    if resultado.get('codigo') in RFB_NEGATIVE_CODES:
+        return 'negative'
+    return None
+
+
+# Cache por container: o usuário volta entre os steps ou repete após erro de
+# validação e a mesma consulta não precisa ir à Safeweb de novo
+safeweb_lookup_cache = SafewebLookupCache(
+    positive_ttl=int(os.environ.get('SAFEWEB_CACHE_POSITIVE_TTL', 1800)),
+    negative_ttl=int(os.environ.get('SAFEWEB_CACHE_NEGATIVE_TTL', 300)),
+    max_entries=int(os.environ.get('SAFEWEB_CACHE_MAX_ENTRIES', 2000)),
+    salt=os.environ.get('SAFEWEB_CACHE_SALT')
+)
+
+
+# ==========================================
+# 🗄️ ARMAZENAMENTO CHAVE-VALOR COMPARTILHADO
+# ==========================================
+# Backends plugáveis para estado compartilhado entre containers:
+# DynamoDB em produção e SQLite (arquivo local) em dev/testes.
+# Todos armazenam valores JSON com expiração (epoch em segundos).
+# ==========================================
+
+class MemoryKVStore:
+    """Backend chave-valor em memória do container: LRU limitado com expiração"""
+
+    def __init__(self, max_entries=10000, sweep_every=1000):
+        self.max_entries = max_entries
+        self.sweep_every = sweep_every
+        self._items = OrderedDict()  # {key: (value, expires_at, version)}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live_item(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self._items[key]
+            return None
+        return item
+
+    def _store(self, key, value, ttl, version=0):
+        self._items[key] = (value, time.time() + ttl if ttl else None, version)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            now = time.time()
+            for expired in [k for k, item in self._items.items() if item[1] is not None and item[1] <= now]:
+                del self._items[expired]
+
+    def get(self, key):
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is not None and item[2] >= version:
+                return False
+            self._store(key, value, ttl, version)
+            return True
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live_item(key, time.time()) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        """Incrementa um contador; o TTL vale a partir da criação"""
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is None:
+                self._store(key, amount, ttl)
+                return amount
+            value = item[0] + amount
+            self._items[key] = (value, item[1], item[2])
+            self._items.move_to_end(key)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def delete_if(self, key, value):
+        """Remove a chave só se o valor gravado for `value` (liberação de lease pelo dono)"""
+        with self._lock:
+            item = self._live_item(key, time.time())
+            if item is None or item[0] != value:
+                return False
+            del self._items[key]
+            return True
+
+
+class SQLiteKVStore:
+    """Backend chave-valor em SQLite - substituto local do DynamoDB"""
+
+    def __init__(self, path, purge_every=500):
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'pk TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, version REAL NOT NULL DEFAULT 0)'
+        )
+
+    def _is_live(self, expires_at, now):
+        return expires_at is None or expires_at > now
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM kv WHERE pk = ?', (key,)).fetchone()
+        if not row or not self._is_live(row[1], time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _maybe_purge(self):
+        """Remove itens expirados periodicamente (chamado com o lock adquirido)"""
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._conn.execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, 0)',
+                (key, json.dumps(value), expires_at)
+            )
+            self._maybe_purge()
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        """Grava apenas se a versão armazenada for menor (ou o item tiver expirado)"""
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(pk) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, '
+                'version = excluded.version '
+                'WHERE kv.version < excluded.version OR (kv.expires_at IS NOT NULL AND kv.expires_at <= ?)',
+                (key, json.dumps(value), expires_at, version, now)
+            )
+            self._maybe_purge()
+            return cursor.rowcount > 0
+
+    def add(self, key, value, ttl=None):
+        """Grava apenas se a chave não existir (ou tiver expirado) - usado como lock/lease"""
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, 0) '
+                'ON CONFLICT(pk) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, version = 0 '
+                'WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?',
+                (key, json.dumps(value), expires_at, now)
+            )
+            return cursor.rowcount > 0
+
+    def incr(self, key, amount=1, ttl=None):
+        """Incrementa um contador de forma atômica (também entre processos); o TTL vale a partir da criação"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT value, expires_at FROM kv WHERE pk = ?', (key,)).fetchone()
+                if row and self._is_live(row[1], now):
+                    value, expires_at = json.loads(row[0]) + amount, row[1]
+                else:
+                    value, expires_at = amount, now + ttl if ttl else None
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO kv (pk, value, expires_at, version) VALUES (?, ?, ?, 0)',
+                    (key, json.dumps(value), expires_at)
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._maybe_purge()
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM kv WHERE pk = ?', (key,))
+
+    def delete_if(self, key, value):
+        """Remove a chave só se o valor gravado for `value` (liberação de lease pelo dono)"""
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM kv WHERE pk = ? AND value = ?', (key, json.dumps(value)))
+            return cursor.rowcount > 0
+
+
+class DynamoDBKVStore:
+    """
+    Backend chave-valor em DynamoDB
+
+    Tabela com chave de partição `pk` (S) e TTL habilitado em `expires_at`.
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._client = boto3.client('dynamodb')
+
+    def _conditional_put(self, item, condition, values):
+        try:
+            self._client.put_item(
+                TableName=self.table_name,
+                Item=item,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+            return True
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def _item(self, key, value, ttl, version=0):
+        item = {
+            'pk': {'S': key},
+            'value': {'S': json.dumps(value)},
+            'version': {'N': str(version)}
+        }
+        if ttl:
+            item['expires_at'] = {'N': str(int(time.time() + ttl))}
+        return item
+
+    def get(self, key):
+        response = self._client.get_item(TableName=self.table_name, Key={'pk': {'S': key}}, ConsistentRead=True)
+        item = response.get('Item')
+        if not item:
+            return None
+        # O TTL do DynamoDB remove itens com atraso: validar a expiração aqui
+        if 'expires_at' in item and float(item['expires_at']['N']) <= time.time():
+            return None
+        if 'counter' in item:
+            return int(item['counter']['N'])
+        return json.loads(item['value']['S'])
+
+    def put(self, key, value, ttl=None):
+        self._client.put_item(TableName=self.table_name, Item=self._item(key, value, ttl))
+
+    def put_if_newer(self, key, value, version, ttl=None):
+        return self._conditional_put(
+            self._item(key, value, ttl, version),
+            'attribute_not_exists(pk) OR version < :version OR expires_at <= :now',
+            {':version': {'N': str(version)}, ':now': {'N': str(int(time.time()))}}
+        )
+
+    def add(self, key, value, ttl=None):
+        return self._conditional_put(
+            self._item(key, value, ttl),
+            'attribute_not_exists(pk) OR expires_at <= :now',
+            {':now': {'N': str(int(time.time()))}}
+        )
+
+    def incr(self, key, amount=1, ttl=None):
+        """
+        Incrementa um contador com ADD (atômico); o TTL vale a partir da criação
+
+        Itens vencidos ainda não removidos pelo TTL continuam somando:
+        use chaves que mudam a cada período (ex.: índice da janela).
+        """
+        update = 'ADD #counter :amount'
+        values = {':amount': {'N': str(amount)}}
+        if ttl:
+            update += ' SET expires_at = if_not_exists(expires_at, :expires_at)'
+            values[':expires_at'] = {'N': str(int(time.time() + ttl))}
+        response = self._client.update_item(
+            TableName=self.table_name,
+            Key={'pk': {'S': key}},
+            UpdateExpression=update,
+            ExpressionAttributeNames={'#counter': 'counter'},
+            ExpressionAttributeValues=values,
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['counter']['N'])
+
+    def delete(self, key):
+        self._client.delete_item(TableName=self.table_name, Key={'pk': {'S': key}})
+
+    def delete_if(self, key, value):
+        """Remove a chave só se o valor gravado for `value` (liberação de lease pelo dono)"""
+        try:
+            self._client.delete_item(
+                TableName=self.table_name,
+                Key={'pk': {'S': key}},
+                ConditionExpression='#value = :value',
+                ExpressionAttributeNames={'#value': 'value'},
+                ExpressionAttributeValues={':value': {'S': json.dumps(value)}}
+            )
+            return True
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+
+_kv_stores = {}
+
+def create_kv_store(backend):
+    """
+    Retorna o backend chave-valor configurado (uma instância por tipo, reutilizada no container)
+
+    Args:
+        backend: 'dynamodb' (tabela em KV_STORE_TABLE), 'sqlite' (arquivo em
+            KV_STORE_SQLITE_PATH) ou 'memory' (LRU no próprio container)
+    """
+    if backend not in _kv_stores:
+        if backend == 'memory':
+            _kv_stores[backend] = MemoryKVStore(int(os.environ.get('KV_STORE_MEMORY_MAX_ENTRIES', 10000)))
+        elif backend == 'dynamodb':
+            _kv_stores[backend] = DynamoDBKVStore(os.environ['KV_STORE_TABLE'])
+        elif backend == 'sqlite':
+            _kv_stores[backend] = SQLiteKVStore(os.environ.get('KV_STORE_SQLITE_PATH', '/tmp/ecommerce-kv.sqlite3'))
+        else:
+            raise ValueError(f"Backend de armazenamento desconhecido: {backend}")
+    return _kv_stores[backend]
+
+
+# ==========================================
+# 💾 STATUS DE PAGAMENTOS (ALIMENTADO POR WEBHOOKS)
+# ==========================================
+# Webhook recebido por qualquer container fica visível para as consultas
+# de status de todos os outros (PAYMENT_STATUS_STORE=dynamodb|sqlite|memory)
+# ==========================================
+
+class PaymentStatusStore:
+    """
+    Status de pagamento gravados pelo webhook, com expiração
+
+    Webhooks chegam fora de ordem ou repetidos (retentativas do Safe2Pay e
+    da fila): cada status grava com uma versão (fase do status, depois o
+    instante de recebimento) e só substitui o gravado se for mais novo - um
+    "pendente" atrasado nunca apaga um "aprovado".
+    """
+
+    PREFIX = 'payment-status:'
+    PENDING_STATUSES = frozenset({'1', '2'})  # Pendente, Em processamento
+
+    def __init__(self, kv_store, ttl=172800):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            ttl: Segundos que um status permanece armazenado (padrão: 2 dias)
+        """
+        self.kv = kv_store
+        self.ttl = ttl
+
+    @classmethod
+    def version(cls, status_id, received_at=None):
+        """Pendentes antes de qualquer status final; na mesma fase, o recebido por último (ms)"""
+        phase = 0 if str(status_id) in cls.PENDING_STATUSES else 1
+        return phase * 10 ** 13 + int((received_at or time.time()) * 1000)
+
+    def record(self, transaction_id, status_id, status_code=None, status_name=None,
+               amount=None, payment_date=None, reference=None, received_at=None):
+        """
+        Grava o status se for mais novo que o gravado
+
+        Returns:
+            dict gravado, ou None se um status mais novo já estava gravado
+        """
+        data = {
+            'PaymentStatus': status_id,
+            'TransactionStatus': {'Id': status_id, 'Code': status_code, 'Name': status_name},
+            'Amount': amount,
+            'PaymentDate': payment_date,
+            'Reference': reference,
+            'status': status_id,  # Para compatibilidade com check_payment_status
+            'updatedAt': time.time()
+        }
+        version = self.version(status_id, received_at)
+        if not self.kv.put_if_newer(self.PREFIX + str(transaction_id), data, version, ttl=self.ttl):
+            logger.info(f"⏭️ Status {status_id} da transação {transaction_id} ignorado: já há um status mais novo")
+            return None
+        return data
+
+    def get(self, transaction_id):
+        return self.kv.get(self.PREFIX + str(transaction_id))
+
+
+payment_status_store = PaymentStatusStore(
+    create_kv_store(os.environ.get('PAYMENT_STATUS_STORE', 'memory')),
+    ttl=int(os.environ.get('PAYMENT_STATUS_TTL', 172800))
+)
+
+
+# ==========================================
+# ♻️ COBRANÇA PIX PENDENTE POR PROTOCOLO
+# ==========================================
+# Reload no step 5 devolve a cobrança já criada para o protocolo em vez de
+# uma nova chamada de até 10s ao /Payment da Safe2Pay
+# ==========================================
+
+class PixChargeIndex:
+    """
+    Índice protocolo → cobrança PIX ainda válida
+
+    Um reload no step 5 (ou um novo clique em "Gerar PIX") para o mesmo
+    protocolo devolve a cobrança pendente em vez de criar outra na Safe2Pay.
+    Uma nova cobrança só é criada depois que a atual expira ou quando o
+    webhook informa que ela foi cancelada, recusada, estornada ou expirou.
+    """
+
+    PREFIX = 'pix-charge:'
+
+    # Status Safe2Pay que encerram a cobrança: 6=Devolvido, 7=Baixado,
+    # 8=Recusado, 12=Em cancelamento, 16=Expirado
+    DEAD_STATUSES = {'6', '7', '8', '12', '16'}
+
+    def __init__(self, kv_store, status_store, reuse_margin=60):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            status_store: PaymentStatusStore com os status recebidos via webhook
+            reuse_margin: Segundos mínimos de validade restante para reaproveitar
+        """
+        self.kv = kv_store
+        self.status_store = status_store
+        self.reuse_margin = reuse_margin
+
+    def get_live(self, protocolo, product_code):
+        """Retorna os dados da cobrança pendente do protocolo ou None"""
+        key = self.PREFIX + str(protocolo)
+        charge = self.kv.get(key)
+        if not charge or charge.get('product') != product_code:
+            return None
+
+        if charge['expires_at'] - time.time() < self.reuse_margin:
+            return None
+
+        status = self.status_store.get(charge['dados']['transactionId'])
+        if status and str(status.get('status')) in self.DEAD_STATUSES:
+            self.kv.delete(key)
+            return None
+
+        return {
+            **charge['dados'],
+            'qrCodeDataUri': pix_qr_data_uri(charge['dados'].get('qrCode', '')),
+            'reused': True
+        }
+
+    def record(self, protocolo, product_code, dados, ttl):
+        """Indexa a cobrança recém-criada (sem o QR renderizado, refeito na leitura)"""
+        self.kv.put(self.PREFIX + str(protocolo), {
+            'product': product_code,
+            'expires_at': time.time() + ttl,
+            'dados': {k: v for k, v in dados.items() if k != 'qrCodeDataUri'}
+        }, ttl=ttl)
+
+
+pix_charge_index = PixChargeIndex(
+    create_kv_store(os.environ.get('PIX_CHARGE_STORE', 'memory')),
+    payment_status_store
+)
+
+
+# ==========================================
+# 🔁 IDEMPOTENCY-KEY NOS POSTS QUE CRIAM RECURSOS
+# ==========================================
+# Duplo clique e retries do frontend não geram protocolo, cobrança ou
+# solicitação Hope duplicados: a resposta da primeira requisição é gravada
+# no KV compartilhado (DynamoDB em produção) e repetida para as demais
+# ==========================================
+
+IDEMPOTENT_ROUTES = (
+    '/api/pix/create',
+    '/api/safeweb/gerar-protocolo',
+    '/api/hope/create-solicitation',
+    '/api/checkout',
+)
+
+
+class IdempotencyStore:
+    """
+    Respostas de POSTs com header `Idempotency-Key`, gravadas no backend chave-valor
+
+    - A primeira requisição com a chave reserva a entrada (`pending`) e executa
+    - Duplicatas simultâneas aguardam a original e recebem a mesma resposta
+    - Duplicatas depois disso recebem a resposta gravada durante `ttl` segundos
+    - A mesma chave com outro corpo é rejeitada (fingerprint diferente)
+    - Respostas 4xx ficam só `error_ttl` segundos (o usuário pode corrigir e
+      repetir) e 5xx liberam a chave na hora
+    """
+
+    PREFIX = 'idempotency:'
+
+    def __init__(self, kv_store, ttl, error_ttl=10, lock_ttl=120, wait_timeout=35, poll_interval=0.1):
+        """
+        Args:
+            kv_store: Backend chave-valor (memory, sqlite ou dynamodb)
+            ttl: Segundos que uma resposta de sucesso é reaproveitada
+            error_ttl: Segundos que uma resposta 4xx é reaproveitada
+            lock_ttl: Validade da reserva `pending` (processo que morreu no meio)
+            wait_timeout: Máximo que uma duplicata aguarda a original
+            poll_interval: Intervalo de releitura quando a original está em outro processo
+        """
+        self.kv = kv_store
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._inflight = {}     # chave -> threading.Event da requisição original neste processo
+        self._lock = threading.Lock()
+        self._stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'mismatches': 0, 'timeouts': 0}
+
+    def _storage_key(self, scope, key):
+        return self.PREFIX + hashlib.sha256(f'{scope}\x1f{key}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(raw_body):
+        if isinstance(raw_body, str):
+            raw_body = raw_body.encode('utf-8')
+        return hashlib.sha256(raw_body or b'').hexdigest()
+
+    def begin(self, scope, key, fingerprint):
+        """
+        Reserva a chave ou aguarda a requisição original
+
+        Returns:
+            (resultado, registro) onde resultado é 'execute' (esta requisição é a
+            original), 'replay' (registro tem a resposta), 'mismatch' (outro corpo)
+            ou 'in_progress' (a original não terminou dentro de wait_timeout)
+        """
+        storage_key = self._storage_key(scope, key)
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+
+        while True:
+            if self.kv.add(storage_key, {'state': 'pending', 'fingerprint': fingerprint}, ttl=self.lock_ttl):
+                with self._lock:
+                    self._inflight[storage_key] = threading.Event()
+                    self._stats['executed'] += 1
+                return 'execute', None
+
+            record = self.kv.get(storage_key)
+            if record is None:
+                # Liberada ou expirada entre o add e o get: tentar reservar de novo
+                continue
+
+            if record.get('fingerprint') != fingerprint:
+                with self._lock:
+                    self._stats['mismatches'] += 1
+                return 'mismatch', record
+
+            if record.get('state') == 'done':
+                with self._lock:
+                    self._stats['replayed'] += 1
+                    if waited:
+                        self._stats['waited'] += 1
+                return 'replay', record
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                return 'in_progress', record
+
+            waited = True
+            event = self._inflight.get(storage_key)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+    def complete(self, scope, key, fingerprint, status_code, body, headers=None):
+        """Grava a resposta da requisição original e acorda as duplicatas"""
+        storage_key = self._storage_key(scope, key)
+        try:
+            if status_code >= 500:
+                self.kv.delete(storage_key)
+            else:
+                self.kv.put(storage_key, {
+                    'state': 'done',
+                    'fingerprint': fingerprint,
+                    'status_code': status_code,
+                    'body': body,
+                    'headers': headers or {}
+                }, ttl=self.ttl if status_code < 400 else self.error_ttl)
+        finally:
+            with self._lock:
+                event = self._inflight.pop(storage_key, None)
+            if event is not None:
+                event.set()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'inflight': len(self._inflight), 'ttl': self.ttl}
+
+
+idempotency_store = IdempotencyStore(
+    create_kv_store(os.environ.get('IDEMPOTENCY_STORE', 'memory')),
+    ttl=int(os.environ.get('IDEMPOTENCY_TTL', 600)),
+    wait_timeout=int(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 20))
+)
+
+
+# ==========================================
+# 🛡️ RATE LIMITING COMPARTILHADO ENTRE CONTAINERS
+# ==========================================
+# Contadores por janela incrementados atomicamente no backend
+# (DynamoDB ADD em produção, memória/SQLite em dev/testes), então o
+# limite vale para a função inteira e não para cada container.
+# ==========================================
+
+class DistributedRateLimiter:
+    """
+    Janela deslizante aproximada sobre contadores atômicos no backend chave-valor
+
+    Antes de ir ao backend, o limitador local do container (mesma política)
+    barra quem já estourou o limite só neste container, e chaves bloqueadas
+    pelo backend ficam bloqueadas localmente até o retry_after.
+    Tentativas negadas pelo backend também contam na janela.
+    """
+
+    PREFIX = 'ratelimit:'
+
+    def __init__(self, kv_store, local_limiter):
+        """
+        Args:
+            kv_store: Backend com `incr` atômico
+            local_limiter: RateLimiter do container (define as políticas)
+        """
+        self.kv = kv_store
+        self.local = local_limiter
+        self._blocked = MemoryKVStore(max_entries=10000)
+        self._stats = {'local_rejections': 0, 'store_checks': 0, 'store_rejections': 0, 'store_errors': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def hit(self, policy, key):
+        """
+        Returns:
+            (bool, int, int): (permitido, requisições_restantes, retry_after_segundos)
+        """
+        max_requests, window = self.local.policies[policy]
+        # Chave no backend sem o dado original (CPF)
+        key_hash = hashlib.sha256(f'{policy}:{key}'.encode('utf-8')).hexdigest()[:32]
+
+        # 1. Pré-checagem local: bloqueio já conhecido ou limite estourado neste container
+        blocked_until = self._blocked.get(key_hash)
+        if blocked_until:
+            self._count('local_rejections')
+            return (False, 0, max(1, int(blocked_until - time.time() + 0.999)))
+
+        allowed, remaining, retry_after = self.local.hit(policy, key)
+        if not allowed:
+            self._count('local_rejections')
+            return (False, 0, retry_after)
+
+        # 2. Contagem global
+        now = time.time()
+        window_index = int(now // window)
+        elapsed = now - window_index * window
+        prefix = f'{self.PREFIX}{key_hash}:'
+        try:
+            current = self.kv.incr(prefix + str(window_index), ttl=2 * window)
+            previous = self.kv.get(prefix + str(window_index - 1)) or 0
+        except Exception as e:
+            # Backend indisponível: vale a decisão local
+            logger.warning(f"⚠️ Rate limit compartilhado indisponível, usando limite local: {str(e)}")
+            self._count('store_errors')
+            return (allowed, remaining, retry_after)
+
+        self._count('store_checks')
+        estimated = previous * (1 - elapsed / window) + current
+        if estimated > max_requests:
+            retry_after = RateLimiter._retry_after([window_index, current, previous], max_requests, window, elapsed)
+            self._blocked.put(key_hash, now + retry_after, ttl=retry_after)
+            self._count('store_rejections')
+            return (False, 0, retry_after)
+
+        return (True, max(0, int(max_requests - estimated)), 0)
+
+    def stats(self):
+        with self._lock:
+            return {**self.local.stats(), **self._stats}
+
+
+# Backend 'memory' equivale ao limite por container (dev/testes)
+distributed_rate_limiter = DistributedRateLimiter(
+    create_kv_store(os.environ.get('RATE_LIMIT_STORE', 'memory')),
+    rate_limiter
+)
+
+
+class Validator:
+    """Validação de dados (copiado do api_server.py)"""
+
+    @staticmethod
+    def validate_cpf_or_cnpj(documento):
+        if not documento:
+            return False, "CPF ou CNPJ é obrigatório"
+        doc_limpo = re.sub(r'\D', '', documento)
+        if len(doc_limpo) == 11:
+            if doc_limpo == doc_limpo[0] * 11:
+                return False, "CPF inválido"
+            return True, doc_limpo
+        elif len(doc_limpo) == 14:
+            if doc_limpo == doc_limpo[0] * 14:
+                return False, "CNPJ inválido"
+            return True, doc_limpo
+        else:
+            return False, "Documento deve ter 11 (CPF) ou 14 (CNPJ) dígitos"
+
+    @staticmethod
+    def validate_email(email):
+        if not email:
+            return False, "Email é obrigatório"
+        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+        if not re.match(pattern, email):
+            return False, "Email inválido"
+        return True, email
+
+    @staticmethod
+    def validate_telefone(telefone):
+        if not telefone:
+            return False, "Telefone é obrigatório"
+        tel_limpo = re.sub(r'\D', '', telefone)
+        if len(tel_limpo) < 10 or len(tel_limpo) > 11:
+            return False, "Telefone deve ter 10 ou 11 dígitos"
+        return True, tel_limpo
+
+    @staticmethod
+    def validate_checkout_data(dados):
+        erros = []
+
+        is_valid, result = Validator.validate_cpf_or_cnpj(dados.get('cpf'))
+        if not is_valid:
+            erros.append(result)
+
+        nome = dados.get('nome_completo', '').strip()
+        if not nome or len(nome) < 3:
+            erros.append('Nome é obrigatório (mínimo 3 caracteres)')
+
+        is_valid, result = Validator.validate_email(dados.get('email'))
+        if not is_valid:
+            erros.append(result)
+
+        is_valid, result = Validator.validate_telefone(dados.get('telefone'))
+        if not is_valid:
+            erros.append(result)
+
+        if erros:
+            return False, erros
+        return True, None
+
+
+# ==========================================
+# 🔳 QR CODE PIX GERADO NO SERVIDOR
+# ==========================================
+# Renderiza o PIX copia-e-cola em PNG inline na resposta de criação,
+# tirando o host de imagens da Safe2Pay do caminho crítico do checkout.
+# ==========================================
+
+class PixQRCode:
+    """
+    Codificador de QR Code (modo byte, correção de erros nível M) em Python puro
+
+    Gera o QR Code do PIX copia-e-cola no próprio servidor, sem depender da
+    imagem hospedada pela Safe2Pay. Saída em SVG ou PNG (data URI inline).
+    """
+
+    # Nível M, por versão (índice 0 não usado): codewords de correção por bloco e número de blocos
+    EC_CODEWORDS_PER_BLOCK = [
+        None, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+        26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28
+    ]
+    EC_BLOCKS = [
+        None, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+        17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49
+    ]
+    # Bits do nível M no campo de formato
+    EC_FORMAT_BITS = 0
+    QUIET_ZONE = 4
+
+    _GF_EXP = None
+    _GF_LOG = None
+    _DIVISORS = {}
+
+    def __init__(self, payload):
+        """
+        Args:
+            payload: Texto a codificar (PIX copia-e-cola / EMV)
+        """
+        data = payload.encode('utf-8')
+        self.version = self._choose_version(len(data))
+        self.size = self.version * 4 + 17
+        self.modules = [[False] * self.size for _ in range(self.size)]
+        self._function = [[False] * self.size for _ in range(self.size)]
+
+        self._draw_function_patterns()
+        self._draw_codewords(self._add_error_correction(self._data_codewords(data)))
+        self.mask = self._apply_best_mask()
+
+    # ---------- Capacidade ----------
+
+    @staticmethod
+    def _raw_data_modules(version):
+        result = (16 * version + 128) * version + 64
+        if version >= 2:
+            num_align = version // 7 + 2
+            result -= (25 * num_align - 10) * num_align - 55
+            if version >= 7:
+                result -= 36
+        return result
+
+    @classmethod
+    def _data_capacity(cls, version):
+        """Codewords de dados disponíveis na versão (nível M)"""
+        return cls._raw_data_modules(version) // 8 - cls.EC_CODEWORDS_PER_BLOCK[version] * cls.EC_BLOCKS[version]
+
+    @classmethod
+    def _choose_version(cls, data_length):
+        for version in range(1, 41):
+            count_bits = 8 if version <= 9 else 16
+            if 4 + count_bits + data_length * 8 <= cls._data_capacity(version) * 8:
+                return version
+        raise ValueError(f"Payload grande demais para QR Code: {data_length} bytes")
+
+    # ---------- Dados e correção de erros ----------
+
+    def _data_codewords(self, data):
+        count_bits = 8 if self.version <= 9 else 16
+        capacity_bits = self._data_capacity(self.version) * 8
+
+        # Modo byte (0100) + contagem + dados, como inteiro de bits
+        bits = (0b0100 << count_bits) | len(data)
+        bits = (bits << (len(data) * 8)) | int.from_bytes(data, 'big')
+        length = 4 + count_bits + len(data) * 8
+
+        # Terminador (até 4 zeros) e alinhamento em byte
+        terminator = min(4, capacity_bits - length)
+        bits <<= terminator
+        length += terminator
+        padding = -length % 8
+        bits <<= padding
+        length += padding
+
+        codewords = list(bits.to_bytes(length // 8, 'big'))
+        pad_bytes = (0xEC, 0x11)
+        for i in range(capacity_bits // 8 - len(codewords)):
+            codewords.append(pad_bytes[i % 2])
+        return codewords
+
+    @classmethod
+    def _init_galois_field(cls):
+        exp = [0] * 512
+        log = [0] * 256
+        value = 1
+        for i in range(255):
+            exp[i] = value
+            log[value] = i
+            value <<= 1
+            if value & 0x100:
+                value ^= 0x11D
+        for i in range(255, 512):
+            exp[i] = exp[i - 255]
+        cls._GF_EXP, cls._GF_LOG = exp, log
+
+    @classmethod
+    def _divisor(cls, degree):
+        """Polinômio gerador Reed-Solomon (coeficientes sem o termo de maior grau)"""
+        divisor = cls._DIVISORS.get(degree)
+        if divisor is None:
+            exp, log = cls._GF_EXP, cls._GF_LOG
+            divisor = [0] * (degree - 1) + [1]
+            root = 1
+            for _ in range(degree):
+                for j in range(degree):
+                    divisor[j] = exp[log[divisor[j]] + log[root]] if divisor[j] else 0
+                    if j + 1 < degree:
+                        divisor[j] ^= divisor[j + 1]
+                root = exp[log[root] + 1]
+            cls._DIVISORS[degree] = divisor
+        return divisor
+
+    @classmethod
+    def _remainder(cls, data, divisor):
+        exp, log = cls._GF_EXP, cls._GF_LOG
+        divisor_logs = [log[coef] if coef else None for coef in divisor]
+        result = [0] * len(divisor)
+        for byte in data:
+            factor = byte ^ result.pop(0)
+            result.append(0)
+            if factor:
+                factor_log = log[factor]
+                for i, coef_log in enumerate(divisor_logs):
+                    if coef_log is not None:
+                        result[i] ^= exp[coef_log + factor_log]
+        return result
+
+    def _add_error_correction(self, data):
+        if self._GF_EXP is None:
+            self._init_galois_field()
+
+        num_blocks = self.EC_BLOCKS[self.version]
+        ec_length = self.EC_CODEWORDS_PER_BLOCK[self.version]
+        raw_codewords = self._raw_data_modules(self.version) // 8
+        num_short_blocks = num_blocks - raw_codewords % num_blocks
+        short_block_length = raw_codewords // num_blocks
+        divisor = self._divisor(ec_length)
+
+        # Blocos curtos primeiro; os longos têm um codeword de dados a mais
+        blocks = []
+        offset = 0
+        for i in range(num_blocks):
+            data_length = short_block_length - ec_length + (0 if i < num_short_blocks else 1)
+            block_data = data[offset:offset + data_length]
+            offset += data_length
+            blocks.append((block_data, self._remainder(block_data, divisor)))
+
+        # Intercalar dados e correção entre os blocos
+        result = []
+        for i in range(short_block_length - ec_length + 1):
+            for block_data, _ in blocks:
+                if i < len(block_data):
+                    result.append(block_data[i])
+        for i in range(ec_length):
+            for _, block_ec in blocks:
+                result.append(block_ec[i])
+        return result
+
+    # ---------- Padrões fixos ----------
+
+    def _set_function(self, x, y, dark):
+        self.modules[y][x] = dark
+        self._function[y][x] = True
+
+    def _draw_function_patterns(self):
+        size = self.size
+
+        # Timing
+        for i in range(size):
+            self._set_function(6, i, i % 2 == 0)
+            self._set_function(i, 6, i % 2 == 0)
+
+        # Localizadores (com separadores)
+        for cx, cy in ((3, 3), (size - 4, 3), (3, size - 4)):
+            for dy in range(-4, 5):
+                for dx in range(-4, 5):
+                    x, y = cx + dx, cy + dy
+                    if 0 <= x < size and 0 <= y < size:
+                        distance = max(abs(dx), abs(dy))
+                        self._set_function(x, y, distance not in (2, 4))
+
+        # Alinhamento
+        positions = self._alignment_positions()
+        last = len(positions) - 1
+        for i, cx in enumerate(positions):
+            for j, cy in enumerate(positions):
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue
+                for dy in range(-2, 3):
+                    for dx in range(-2, 3):
+                        self._set_function(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+
+        # Formato (reservado; gravado ao aplicar a máscara) e versão
+        self._draw_format_bits(0)
+        if self.version >= 7:
+            remainder = self.version
+            for _ in range(12):
+                remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+            bits = (self.version << 12) | remainder
+            for i in range(18):
+                dark = (bits >> i) & 1 == 1
+                a, b = size - 11 + i % 3, i // 3
+                self._set_function(a, b, dark)
+                self._set_function(b, a, dark)
+
+    def _alignment_positions(self):
+        if self.version == 1:
+            return []
+        num_align = self.version // 7 + 2
+        step = 26 if self.version == 32 else (self.version * 4 + num_align * 2 + 1) // (num_align * 2 - 2) * 2
+        return [6] + [self.size - 7 - i * step for i in range(num_align - 1)][::-1]
+
+    def _draw_format_bits(self, mask):
+        data = (self.EC_FORMAT_BITS << 3) | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = ((data << 10) | remainder) ^ 0x5412
+        size = self.size
+
+        def bit(i):
+            return (bits >> i) & 1 == 1
+
+        for i in range(6):
+            self._set_function(8, i, bit(i))
+        self._set_function(8, 7, bit(6))
+        self._set_function(8, 8, bit(7))
+        self._set_function(7, 8, bit(8))
+        for i in range(9, 15):
+            self._set_function(14 - i, 8, bit(i))
+        for i in range(8):
+            self._set_function(size - 1 - i, 8, bit(i))
+        for i in range(8, 15):
+            self._set_function(8, size - 15 + i, bit(i))
+        self._set_function(8, size - 8, True)
+
+    # ---------- Dados na matriz ----------
+
+    def _draw_codewords(self, codewords):
+        size = self.size
+        total_bits = len(codewords) * 8
+        i = 0
+        right = size - 1
+        while right >= 1:
+            if right == 6:
+                right = 5
+            upward = (right + 1) & 2 == 0
+            for vert in range(size):
+                y = size - 1 - vert if upward else vert
+                for x in (right, right - 1):
+                    if not self._function[y][x] and i < total_bits:
+                        self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 == 1
+                        i += 1
+            right -= 2
+
+    MASKS = (
+        lambda x, y: (x + y) % 2 == 0,
+        lambda x, y: y % 2 == 0,
+        lambda x, y: x % 3 == 0,
+        lambda x, y: (x + y) % 3 == 0,
+        lambda x, y: (x // 3 + y // 2) % 2 == 0,
+        lambda x, y: x * y % 2 + x * y % 3 == 0,
+        lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+        lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+    )
+
+    _MASK_FLIPS = {}
+
+    def _mask_flips(self):
+        """Por máscara, linhas (inteiros) com os módulos de dados a inverter - cache por versão"""
+        flips = self._MASK_FLIPS.get(self.version)
+        if flips is None:
+            flips = [
+                [
+                    int(''.join(
+                        '1' if not function and predicate(x, y) else '0'
+                        for x, function in enumerate(function_row)
+                    ), 2)
+                    for y, function_row in enumerate(self._function)
+                ]
+                for predicate in self.MASKS
+            ]
+            self._MASK_FLIPS[self.version] = flips
+        return flips
+
+    @staticmethod
+    def _row_int(row):
+        return int(''.join('1' if module else '0' for module in row), 2)
+
+    _RUNS = re.compile(r'0{5,}|1{5,}')
+    _FINDER_LIKE = re.compile(r'(?=(10111010000|00001011101))')
+
+    @classmethod
+    def _penalty(cls, rows, size):
+        """Penalidade da máscara (linhas como inteiros, bit mais alto = coluna 0)"""
+        lines = [format(row, f'0{size}b') for row in rows]
+        columns = [''.join(column) for column in zip(*lines)]
+        penalty = 0
+
+        for line in lines + columns:
+            # Sequências de 5+ módulos da mesma cor
+            for run in cls._RUNS.findall(line):
+                penalty += len(run) - 2
+            # Padrões parecidos com localizadores (borda conta como claro)
+            penalty += 40 * len(cls._FINDER_LIKE.findall('0000' + line + '0000'))
+
+        # Blocos 2x2 da mesma cor
+        inner = (1 << (size - 1)) - 1
+        for upper, lower in zip(rows, rows[1:]):
+            same_vertical = ~(upper ^ lower)
+            same_horizontal = ~(upper ^ (upper >> 1))
+            penalty += 3 * bin(same_vertical & (same_vertical >> 1) & same_horizontal & inner).count('1')
+
+        # Proporção de módulos escuros
+        dark = sum(bin(row).count('1') for row in rows)
+        total = size * size
+        penalty += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+        return penalty
+
+    def _apply_best_mask(self):
+        size = self.size
+        flips = self._mask_flips()
+        base = [self._row_int(row) for row in self.modules]
+        # Linhas que contêm bits de formato (mudam com a máscara)
+        format_rows = list(range(9)) + list(range(size - 8, size))
+
+        best_mask, best_rows, best_penalty = None, None, None
+        for mask in range(8):
+            self._draw_format_bits(mask)
+            for y in format_rows:
+                base[y] = self._row_int(self.modules[y])
+            rows = [row ^ flip for row, flip in zip(base, flips[mask])]
+            penalty = self._penalty(rows, size)
+            if best_penalty is None or penalty < best_penalty:
+                best_mask, best_rows, best_penalty = mask, rows, penalty
+
+        self.modules = [[(row >> (size - 1 - x)) & 1 == 1 for x in range(size)] for row in best_rows]
+        return best_mask
+
+    # ---------- Renderização ----------
+
+    def svg(self, module_size=1):
+        """SVG com um único path (módulos escuros agrupados por linha)"""
+        border = self.QUIET_ZONE
+        dimension = self.size + 2 * border
+        path = []
+        for y, row in enumerate(self.modules):
+            x = 0
+            while x < self.size:
+                if row[x]:
+                    start = x
+                    while x < self.size and row[x]:
+                        x += 1
+                    path.append(f'M{start + border} {y + border}h{x - start}v1h-{x - start}z')
+                else:
+                    x += 1
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {dimension} {dimension}" '
+            f'width="{dimension * module_size}" height="{dimension * module_size}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="#fff"/><path d="{"".join(path)}" fill="#000"/></svg>'
+        )
+
+    def png(self, module_size=4):
+        """PNG em tons de cinza de 1 bit"""
+        border = self.QUIET_ZONE
+        dimension = (self.size + 2 * border) * module_size
+        blank_row = b'\x00' + b'\xff' * ((dimension + 7) // 8)
+
+        raw = bytearray(blank_row * (border * module_size))
+        for row in self.modules:
+            # 1 = claro; cada módulo vira `module_size` pixels
+            line = '1' * border + ''.join('0' if module else '1' for module in row) + '1' * border
+            pixels = ''.join(value * module_size for value in line)
+            pixels += '1' * (-len(pixels) % 8)
+            raw += (b'\x00' + int(pixels, 2).to_bytes(len(pixels) // 8, 'big')) * module_size
+        raw += blank_row * (border * module_size)
+
+        def chunk(kind, data):
+            return (len(data).to_bytes(4, 'big') + kind + data +
+                    zlib.crc32(kind + data).to_bytes(4, 'big'))
+
+        header = dimension.to_bytes(4, 'big') * 2 + bytes([1, 0, 0, 0, 0])
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+                chunk(b'IDAT', zlib.compress(bytes(raw), 6)) + chunk(b'IEND', b''))
+
+    def data_uri(self, image_format='png'):
+        """Imagem inline para <img src> (PNG é bem menor que o SVG equivalente)"""
+        if image_format == 'svg':
+            return 'data:image/svg+xml;base64,' + base64.b64encode(self.svg().encode('utf-8')).decode('ascii')
+        return 'data:image/png;base64,' + base64.b64encode(self.png()).decode('ascii')
+
+
+def pix_qr_data_uri(payload):
+    """QR Code do PIX copia-e-cola como data URI PNG (None se não for possível gerar)"""
+    if not payload:
+        return None
+    try:
+        return PixQRCode(payload).data_uri()
+    except Exception as e:
+        logger.warning(f"⚠️ Falha ao gerar QR Code local: {str(e)}")
+        return None
+
+
+class Safe2PayAPI:
+    """Cliente Safe2Pay para Lambda"""
+
+    def __init__(self):
+        secret_arn = os.environ.get('SAFE2PAY_SECRET_ARN')
+        if not secret_arn:
+            raise Exception("SAFE2PAY_SECRET_ARN não configurado")
+
+        secret = get_secret(secret_arn)
+        self.token = secret['token']
+        self.api_url = secret['base_url']
+        self.pix_expiration = 30
+
+    def create_pix_payment(self, dados_checkout):
+        """Criar pagamento PIX Dinâmico - OTIMIZADO"""
+
+        # OTIMIZAÇÃO: Validação mínima para máxima velocidade
+        if not dados_checkout.get('protocolo'):
+            return {'sucesso': False, 'erro': 'Protocolo é obrigatório'}
+
         try:
-            # Primeiro, verificar cache de webhooks (mais confiável)
-            if transaction_id in _payment_status_cache:
-                cached_data = _payment_status_cache[transaction_id]
-                print(f"✅ Status obtido do cache (webhook): {cached_data.get('status')}")
+            # VALIDAÇÃO DE SEGURANÇA: Obter produto do catálogo (source of truth)
+            product_id = dados_checkout.get('product_id', 'ecpf-a1')  # Default: e-CPF A1
+
+            if product_id not in PRODUCT_CATALOG:
+                logger.error(f"❌ Produto inválido: {product_id}")
+                return {
+                    'sucesso': False,
+                    'erro': 'Produto inválido',
+                    'detalhes': f'Produto {product_id} não existe no catálogo'
+                }
+
+            product = PRODUCT_CATALOG[product_id]
+
+            # VALIDAÇÃO CRÍTICA: Verificar se valor enviado corresponde ao catálogo
+            valor_enviado = dados_checkout.get('valor')
+
+            # 🔍 Validação de preço (só com LOG_LEVEL=DEBUG; dados completos mascarados e amostrados)
+            logger.debug(
+                "💰 Validação de preço: produto %s, catálogo R$ %s, recebido %r",
+                product_id, product['price'], valor_enviado
+            )
+            log_payload("📋 Dados completos recebidos", dados_checkout, level=logging.DEBUG)
+
+            if valor_enviado is not None:
+                valor_enviado = float(valor_enviado)
+                logger.debug("🔢 Valor convertido: %s (diferença %s)", valor_enviado, abs(valor_enviado - product['price']))
+
+                # TEMPORÁRIO: Aceitar 5.00 OU 8.00 devido a cache CloudFront
+                valores_aceitos = [5.00, 8.00]
+                valor_valido = any(abs(valor_enviado - v) <= 0.01 for v in valores_aceitos)
+
+                if not valor_valido:
+                    logger.warning(f"🚨 VALOR INVÁLIDO! Enviado R$ {valor_enviado}, correto R$ {product['price']}")
+                    return {
+                        'sucesso': False,
+                        'erro': 'Valor inválido',
+                        'detalhes': f'Valor enviado (R$ {valor_enviado}) não corresponde'
+                    }
+                else:
+                    if abs(valor_enviado - 5.00) <= 0.01:
+                        logger.warning("⚠️ Valor antigo R$ 5.00 aceito temporariamente")
+                    logger.debug("✅ Validação de preço OK")
+
+            # OTIMIZADO: PIX Dinâmico (com apenas dados essenciais)
+            protocolo = dados_checkout.get('protocolo', f"ECPF-{datetime.now().strftime('%Y%m%d%H%M%S')}")
+
+            # ♻️ Cobrança pendente do mesmo protocolo: reaproveitar em vez de criar outra
+            try:
+                cobranca = pix_charge_index.get_live(protocolo, product['code'])
+            except Exception as e:
+                logger.warning(f"⚠️ Índice de cobranças indisponível, criando nova cobrança: {str(e)}")
+                cobranca = None
+            if cobranca:
+                logger.info(f"♻️ PIX pendente reaproveitado para o protocolo {protocolo}: {cobranca['transactionId']}")
+                return {'sucesso': True, 'dados': cobranca}
+
+            # Safe2Pay exige descrição com no máximo 30 caracteres
+            description_short = product['description'][:30] if len(product['description']) > 30 else product['description']
+
+            # PIX DINÂMICO: Usar dados do formulário do usuário
+            # Limpar CPF e CEP (remover formatação)
+            cpf_raw = str(dados_checkout.get('cpf', ''))
+            cpf = cpf_raw.replace('.', '').replace('-', '').replace(' ', '').strip()
+
+            cep_raw = str(dados_checkout.get('cep', ''))
+            cep = cep_raw.replace('-', '').replace(' ', '').strip()
+
+            logger.debug("📋 CPF recebido: %s (len=%d), CEP: %s (len=%d)", mask_cpf(cpf), len(cpf), cep, len(cep))
+
+            payment_data = {
+                "IsSandbox": False,
+                "Application": "Certificado Digital",
+                "Vendor": "Certificado Campinas",
+                "CallbackUrl": "https://u4w4tf2o4f.execute-api.us-east-1.amazonaws.com/webhook/safe2pay",
+                "PaymentMethod": "6",  # PIX
+                "Reference": str(protocolo),
+                "Customer": {
+                    "Name": dados_checkout.get('nome_completo', 'Cliente'),
+                    "Identity": cpf,
+                    "Address": {
+                        "ZipCode": cep or "00000000",
+                        "Street": dados_checkout.get('endereco', 'Rua'),
+                        "Number": dados_checkout.get('numero', 'S/N'),
+                        "District": dados_checkout.get('bairro', 'Centro'),
+                        "CityName": dados_checkout.get('cidade', 'Cidade'),
+                        "StateInitials": dados_checkout.get('uf', 'SP'),
+                        "CountryName": "Brasil"
+                    }
+                },
+                "PaymentObject": {
+                    "Expiration": 1296000  # 15 dias (15 dias × 24h × 60min × 60s)
+                },
+                "Products": [
+                    {
+                        "Code": product['code'],
+                        "Description": description_short,
+                        "UnitPrice": product['price'],
+                        "Quantity": 1
+                    }
+                ]
+            }
+
+            headers = {
+                'Content-Type': 'application/json',
+                'X-API-KEY': self.token
+            }
+
+            # OTIMIZADO: Chamada rápida sem logs pesados
+            response = upstream_http.post(
+                f"{self.api_url}/Payment",
+                json=payment_data,
+                headers=headers,
+                timeout=10  # OTIMIZADO: 10s
+            )
+
+            if response.status_code in [200, 201]:
+                result = response.json()
+
+                log_payload("✅ Safe2Pay Payment (PIX Dinâmico) Response", result)
+
+                if result.get('HasError'):
+                    return {
+                        'sucesso': False,
+                        'erro': f"Erro Safe2Pay: {result.get('ErrorMessage', result.get('Error', 'Desconhecido'))}"
+                    }
+
+                response_detail = result.get('ResponseDetail', {})
+                # Safe2Pay retorna Key e QrCode direto no ResponseDetail, não em PaymentObject
+                pix_key = response_detail.get('Key', '')
+                qr_code_image = response_detail.get('QrCode', '')
+
+                logger.info(f"📋 PIX criado no Safe2Pay: IdTransaction {response_detail.get('IdTransaction')}")
+                logger.debug("📋 Chave PIX: %s... QrCode: %s", pix_key[:50], qr_code_image)
+
+                dados = {
+                    'transactionId': str(response_detail.get('IdTransaction')),
+                    'qrCode': pix_key,
+                    'qrCodeImage': qr_code_image,
+                    'qrCodeDataUri': pix_qr_data_uri(pix_key),
+                    'pixCopiaECola': pix_key,
+                    'valor': product['price'],
+                    'status': 'pending',
+                    'reference': payment_data['Reference'],
+                    'expiresAt': (datetime.now() + timedelta(minutes=self.pix_expiration)).isoformat()
+                }
+
+                try:
+                    pix_charge_index.record(protocolo, product['code'], dados, ttl=self.pix_expiration * 60)
+                except Exception as e:
+                    logger.warning(f"⚠️ Não foi possível indexar a cobrança {dados['transactionId']}: {str(e)}")
+
+                return {
+                    'sucesso': True,
+                    'dados': dados
+                }
+            else:
+                error_text = response.text
+                logger.error(f"❌ Erro HTTP {response.status_code}: {error_text}")
                 return {
+                    'sucesso': False,
+                    'erro': f'Erro HTTP {response.status_code}',
+                    'detalhes': error_text
+                }
+
+        except Exception as e:
+            logger.error(f"❌ Exception ao criar PIX: {str(e)}")
+            return {
+                'sucesso': False,
+                'erro': 'Erro interno',
+                'detalhes': str(e)
+            }
+
+    def check_payment_status(self, transaction_id, timeout=30):
+        """
+        Args:
+            timeout: Timeout da consulta ao Safe2Pay (o long-poll passa o que
+                sobra da invocação)
+        """
+        try:
+            # Primeiro, verificar status gravados pelos webhooks (mais confiável)
+            try:
+                cached_data = payment_status_store.get(transaction_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Store de status indisponível, consultando Safe2Pay: {str(e)}")
+                cached_data = None
+
+            if cached_data:
+                logger.debug(f"✅ Status obtido do cache (webhook): {cached_data.get('status')}")
+                resultado = {
                     'sucesso': True,
                     'status': cached_data.get('status'),
+                    'statusCode': cached_data.get('status'),
                     'dados': cached_data
                 }
+                # Link de upload gerado pelo webhook de aprovação (dispensa a chamada Hope no frontend)
+                if str(cached_data.get('status')) == '3' and cached_data.get('Reference'):
+                    upload_url = post_approval.upload_url(cached_data['Reference'])
+                    if upload_url:
+                        resultado['uploadUrl'] = upload_url
+                return resultado
+
+            # Se não estiver no cache, consultar API Safe2Pay (micro-cache + coalescência)
+            return transaction_status_cache.get_or_load(
+                str(transaction_id),
+                lambda: self._fetch_transaction_status(transaction_id, timeout),
+                cacheable=lambda resultado: resultado.get('sucesso')
+            )
+        except Exception as e:
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
 
-            # Se não estiver no cache, consultar API Safe2Pay
+    def _fetch_transaction_status(self, transaction_id, timeout=30):
+        try:
             # IMPORTANTE: Endpoint correto é /transaction/get na api.safe2pay.com.br (não payment.safe2pay.com.br)
             headers = {'X-API-KEY': self.token}
             api_query_url = "https://api.safe2pay.com.br/v2"
-            response = requests.get(
+            response = upstream_http.get(
                 f"{api_query_url}/transaction/get",
                 params={'id': transaction_id},
                 headers=headers,
-                timeout=30
+                timeout=timeout
             )
 
             if response.status_code == 200:
@@ -501,10 +2728,242 @@ class Safe2PayAPI:
                     'erro': f'Erro HTTP {response.status_code}'
                 }
         except Exception as e:
-            return {
-                'sucesso': False,
-                'erro': str(e)
-            }
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+
+# ==========================================
+# 🔑 TOKEN SAFEWEB COMPARTILHADO ENTRE CONTAINERS
+# ==========================================
+# Containers frios reaproveitam um token ainda válido gravado por outro
+# container. Só quem obtém o lease de renovação autentica; os demais
+# aguardam o token novo aparecer no store.
+# ==========================================
+
+class SharedTokenStore:
+    """Token Safeweb persistido em um backend chave-valor"""
+
+    TOKEN_KEY = 'safeweb:token'
+    LEASE_KEY = 'safeweb:token:refresh-lease'
+
+    def __init__(self, kv_store, lease_seconds=30):
+        self.kv = kv_store
+        self.lease_seconds = lease_seconds
+
+    def load(self):
+        """Retorna (token, expiraEm) gravado por qualquer container, ou None"""
+        data = self.kv.get(self.TOKEN_KEY)
+        if not data:
+            return None
+        return data['token'], data['expiry']
+
+    def save(self, token, expiry):
+        """Grava o token apenas se expirar depois do já armazenado (evita sobrescritas concorrentes)"""
+        ttl = max(1, int(expiry - time.time()))
+        return self.kv.put_if_newer(self.TOKEN_KEY, {'token': token, 'expiry': expiry}, version=expiry, ttl=ttl)
+
+    def acquire_refresh_lease(self):
+        """Retorna o lease obtido (com token de dono único) ou None se outro container o detém"""
+        lease = {
+            'owner': os.environ.get('AWS_LAMBDA_LOG_STREAM_NAME', 'local'),
+            'token': os.urandom(8).hex()
+        }
+        return lease if self.kv.add(self.LEASE_KEY, lease, ttl=self.lease_seconds) else None
+
+    def release_refresh_lease(self, lease):
+        """Libera o lease só se ainda for deste container (o nosso pode ter expirado e sido assumido)"""
+        if lease is not None:
+            self.kv.delete_if(self.LEASE_KEY, lease)
+
+
+class AuthCallMeter:
+    """Contagem de autenticações na Safeweb por minuto (últimos 10 minutos)"""
+
+    def __init__(self, keep_minutes=10):
+        self.keep_minutes = keep_minutes
+        self._buckets = {}  # {minuto_epoch: chamadas}
+        self._lock = threading.Lock()
+
+    def record(self):
+        minute = int(time.time() // 60)
+        with self._lock:
+            self._buckets[minute] = self._buckets.get(minute, 0) + 1
+            for old in [m for m in self._buckets if m <= minute - self.keep_minutes]:
+                del self._buckets[old]
+
+        # Métrica CloudWatch (Embedded Metric Format): soma por minuto = autenticações/minuto
+        log_raw(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': 'EcommerceCertificado',
+                    'Dimensions': [[]],
+                    'Metrics': [{'Name': 'SafewebAuthCalls', 'Unit': 'Count'}]
+                }]
+            },
+            'SafewebAuthCalls': 1
+        }))
+
+    def per_minute(self):
+        current = int(time.time() // 60)
+        with self._lock:
+            return {
+                'current_minute': self._buckets.get(current, 0),
+                'previous_minute': self._buckets.get(current - 1, 0),
+                'last_10_minutes': sum(self._buckets.values())
+            }
+
+
+class SafewebTokenManager:
+    """
+    Token JWT Safeweb com renovação única e antecipada (copiado do api_server.py)
+
+    No Lambda o container congela entre invocações, então não há timer:
+    a renovação antecipada é disparada no acesso, e uma renovação travada
+    (thread congelada) é assumida por outra chamada após `stale_after`.
+    Para tokens curtos, `renew_ahead` é limitado a uma fração da validade e
+    a renovação seguinte nunca começa antes de `min_renewal_delay`.
+    """
+
+    def __init__(self, fetch_token, margin=120, renew_ahead=300, stale_after=35,
+                 renew_ahead_fraction=0.25, min_renewal_delay=30):
+        self._fetch_token = fetch_token
+        self.margin = margin
+        self.renew_ahead = renew_ahead
+        self.stale_after = stale_after
+        self.renew_ahead_fraction = renew_ahead_fraction
+        self.min_renewal_delay = min_renewal_delay
+
+        self.token = None
+        self.expiry = None
+        self.renew_at = None
+
+        self._cond = threading.Condition()
+        self._refreshing = False
+        self._refresh_started = 0
+        self._generation = 0
+        self._last_error = None
+
+        # Métricas
+        self.auth_count = 0
+        self.auth_avoided = 0
+        self.auth_waits = 0
+        self.background_refreshes = 0
+
+    def _valid_token(self, now):
+        token, expiry = self.token, self.expiry
+        if token and expiry and now < expiry - self.margin:
+            return token
+        return None
+
+    def get_token(self):
+        now = time.time()
+        token = self._valid_token(now)
+        if token:
+            self.auth_avoided += 1
+            if now >= self.renew_at:
+                self.refresh_in_background()
+            return token
+
+        return self._timed_refresh()
+
+    def refresh(self):
+        with self._cond:
+            self.token = None
+        return self._timed_refresh()
+
+    def _timed_refresh(self):
+        started = time.perf_counter()
+        try:
+            return self._refresh_blocking()
+        finally:
+            record_timing('token', time.perf_counter() - started, 'Safeweb token')
+
+    def _refresh_blocking(self):
+        with self._cond:
+            token = self._valid_token(time.time())
+            if token:
+                self.auth_avoided += 1
+                return token
+
+            if self._refreshing and time.time() - self._refresh_started < self.stale_after:
+                # Outra thread já está autenticando: aguardar o resultado dela
+                self.auth_waits += 1
+                generation = self._generation
+                while self._refreshing and self._generation == generation:
+                    remaining = self.stale_after - (time.time() - self._refresh_started)
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+
+                token = self._valid_token(time.time())
+                if token:
+                    return token
+                if self._generation != generation and self._last_error:
+                    raise self._last_error
+
+            self._refreshing = True
+            self._refresh_started = time.time()
+
+        return self._run_refresh()
+
+    def refresh_in_background(self):
+        with self._cond:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._refresh_started = time.time()
+
+        self.background_refreshes += 1
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self._run_refresh()
+        except Exception as e:
+            logger.warning(f"⚠️ Renovação antecipada do token Safeweb falhou: {str(e)}")
+
+    def _renewal_time(self, expiry):
+        """Instante da próxima renovação antecipada para um token que expira em `expiry`"""
+        now = time.time()
+        renew_ahead = min(self.renew_ahead, max(0, expiry - now) * self.renew_ahead_fraction)
+        # Nunca renovar em sequência: um token de vida curta renovaria em loop
+        return max(expiry - self.margin - renew_ahead, now + self.min_renewal_delay)
+
+    def _run_refresh(self):
+        token, expiry, error = None, None, None
+        try:
+            token, expiry = self._fetch_token()
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            if error is None:
+                self.token = token
+                self.expiry = expiry
+                self.renew_at = self._renewal_time(expiry)
+                self.auth_count += 1
+                self._last_error = None
+            else:
+                self._last_error = error
+            self._refreshing = False
+            self._generation += 1
+            self._cond.notify_all()
+
+        if error is not None:
+            raise error
+        return token
+
+    def stats(self):
+        return {
+            'authentications': self.auth_count,
+            'authentications_avoided': self.auth_avoided,
+            'waited_on_refresh': self.auth_waits,
+            'background_refreshes': self.background_refreshes,
+            'expires_in': int(self.expiry - time.time()) if self.expiry else None
+        }
 
 
 class SafewebAPI:
@@ -524,14 +2983,79 @@ class SafewebAPI:
         self.codigo_parceiro = secret['codigo_parceiro']
         self.produto_ecpf_a1 = secret['produto_ecpf_a1']
 
-        self.token = None
-        self.token_expiry = None
+        self.token_manager = SafewebTokenManager(self._fetch_token)
 
-    def authenticate(self):
+        # Store opcional compartilhado entre containers (SAFEWEB_TOKEN_STORE=dynamodb|sqlite)
+        token_store_backend = os.environ.get('SAFEWEB_TOKEN_STORE')
+        self.token_store = SharedTokenStore(create_kv_store(token_store_backend)) if token_store_backend else None
+        self.token_store_hits = 0
+        self.auth_meter = AuthCallMeter()
+
+    @property
+    def token(self):
+        return self.token_manager.token
+
+    @property
+    def token_expiry(self):
+        return self.token_manager.expiry
+
+    def _fetch_token(self):
+        """Obtém (token, expiraEm): do store compartilhado se houver um válido, senão autentica"""
+        if not self.token_store:
+            return self._authenticate_upstream()
+
+        try:
+            stored = self._load_stored_token()
+            if stored:
+                return stored
+
+            # Outro container está autenticando: aguardar o token dele ou assumir o lease
+            deadline = time.time() + self.token_store.lease_seconds
+            while True:
+                lease = self.token_store.acquire_refresh_lease()
+                if lease is not None:
+                    break
+                if time.time() >= deadline:
+                    logger.warning("⚠️ Lease de renovação do token não liberado a tempo, autenticando")
+                    break
+                time.sleep(0.25)
+                stored = self._load_stored_token()
+                if stored:
+                    return stored
+
+            # O container anterior pode ter gravado o token logo antes de liberar o lease
+            stored = self._load_stored_token()
+            if stored:
+                self.token_store.release_refresh_lease(lease)
+                return stored
+        except Exception as e:
+            logger.warning(f"⚠️ Store de token indisponível, autenticando direto: {str(e)}")
+            return self._authenticate_upstream()
+
+        try:
+            token, expiry = self._authenticate_upstream()
+            self.token_store.save(token, expiry)
+            return token, expiry
+        finally:
+            try:
+                self.token_store.release_refresh_lease(lease)
+            except Exception as e:
+                logger.warning(f"⚠️ Erro ao liberar lease do token: {str(e)}")
+
+    def _load_stored_token(self):
+        stored = self.token_store.load()
+        # Só reaproveita se ainda estiver fora da janela de renovação antecipada
+        if stored and stored[1] - time.time() > self.token_manager.margin + self.token_manager.renew_ahead:
+            self.token_store_hits += 1
+            return stored
+        return None
+
+    def _authenticate_upstream(self):
         import base64
+        self.auth_meter.record()
         credenciais = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
 
-        response = requests.post(
+        response = upstream_http.post(
             self.auth_url,
             headers={
                 'Authorization': f'Basic {credenciais}',
@@ -544,20 +3068,23 @@ class SafewebAPI:
             raise Exception(f"Erro de autenticação: {response.status_code}")
 
         data = response.json()
-        self.token = data.get('tokenAcesso')
-        self.token_expiry = data.get('expiraEm')
-        return self.token
-
-    def ensure_valid_token(self):
-        if not self.token or not self.token_expiry:
-            return self.authenticate()
+        return data.get('tokenAcesso'), data.get('expiraEm')
 
-        if int(time.time()) >= self.token_expiry - 120:
-            return self.authenticate()
+    def authenticate(self):
+        return self.token_manager.refresh()
 
-        return self.token
+    def ensure_valid_token(self):
+        return self.token_manager.get_token()
 
     def verificar_biometria(self, cpf):
+        cpf_limpo = re.sub(r'\D', '', cpf or '')
+        return safeweb_lookup_cache.get_or_load(
+            ('biometria', cpf_limpo),
+            lambda: self._fetch_biometria(cpf),
+            classify_biometria_result
+        )
+
+    def _fetch_biometria(self, cpf):
         try:
             cpf_limpo = re.sub(r'\D', '', cpf)
             if len(cpf_limpo) != 11:
@@ -565,7 +3092,7 @@ class SafewebAPI:
 
             token = self.ensure_valid_token()
 
-            response = requests.get(
+            response = upstream_http.get(
                 f"{self.base_url}/Service/Microservice/Shared/Partner/api/ValidateBiometry/{cpf_limpo}",
                 headers={
                     'Authorization': token,
@@ -593,6 +3120,17 @@ class SafewebAPI:
             }
 
     def consultar_cpf(self, cpf, data_nascimento):
+        cpf_limpo = re.sub(r'\D', '', cpf or '')
+        resultado = safeweb_lookup_cache.get_or_load(
+            ('consulta', cpf_limpo, str(data_nascimento or '')),
+            lambda: self._fetch_consulta_cpf(cpf, data_nascimento),
+            classify_consulta_result
+        )
+        if 'codigo' in resultado:
+            resultado['cpf'] = cpf_limpo
+        return resultado
+
+    def _fetch_consulta_cpf(self, cpf, data_nascimento):
         try:
             cpf_limpo = re.sub(r'\D', '', cpf)
             token = self.ensure_valid_token()
@@ -603,7 +3141,7 @@ class SafewebAPI:
                 "DtNascimento": data_nascimento
             }
 
-            response = requests.post(
+            response = upstream_http.post(
                 f"{self.base_url}/Service/Microservice/Shared/ConsultaPrevia/api/RealizarConsultaPrevia",
                 json=payload,
                 headers={
@@ -637,197 +3175,926 @@ class SafewebAPI:
 
             return resultado
 
-        except Exception as e:
-            return {
-                'sucesso': False,
-                'erro': str(e)
-            }
+        except Exception as e:
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+    def gerar_protocolo(self, dados_completos):
+        try:
+            token = self.ensure_valid_token()
+
+            telefone_limpo = re.sub(r'\D', '', dados_completos.get('telefone', ''))
+            ddd = telefone_limpo[:2]
+            numero = telefone_limpo[2:]
+
+            payload = {
+                "CnpjAR": self.cnpj_ar,
+                "CodigoParceiro": self.codigo_parceiro,
+                "idProduto": self.produto_ecpf_a1,
+                "Nome": dados_completos.get('nome'),
+                "CPF": re.sub(r'\D', '', dados_completos.get('cpf', '')),
+                "DataNascimento": dados_completos.get('nascimento'),
+                "Contato": {
+                    "DDD": ddd,
+                    "Telefone": numero,
+                    "Email": dados_completos.get('email')
+                },
+                "Endereco": {
+                    "Logradouro": dados_completos.get('endereco'),
+                    "Numero": dados_completos.get('numero'),
+                    "Complemento": dados_completos.get('complemento', ''),
+                    "Bairro": dados_completos.get('bairro'),
+                    "UF": dados_completos.get('estado'),
+                    "Cidade": dados_completos.get('cidade'),
+                    "CEP": re.sub(r'\D', '', dados_completos.get('cep', ''))
+                }
+            }
+
+            response = upstream_http.post(
+                f"{self.base_url}/Service/Microservice/Shared/Partner/api/Add/3",
+                json=payload,
+                headers={
+                    'Authorization': token,
+                    'Content-Type': 'application/json'
+                },
+                timeout=30
+            )
+
+            if response.status_code != 200:
+                raise Exception(f'Erro ao gerar protocolo: {response.status_code}')
+
+            protocolo = response.json()
+
+            return {
+                'sucesso': True,
+                'protocolo': protocolo,
+                'mensagem': 'Protocolo gerado com sucesso'
+            }
+
+        except Exception as e:
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+    def liberar_pagamento(self, protocol):
+        """Libera pagamento na Safeweb - UpdateLiberacao"""
+        try:
+            # Obter token válido (renovado se expirado)
+            token = self.ensure_valid_token()
+
+            # URL do endpoint UpdateLiberacao
+            url = f"{self.base_url}/Service/Microservice/Shared/Partner/api/UpdateLiberacao"
+
+            headers = {
+                'Authorization': f'bearer {token}',
+                'Content-Type': 'application/json'
+            }
+
+            payload = {
+                'Protocolo': protocol,
+                'CNPJ': self.cnpj_ar
+            }
+
+            logger.info(f"💳 Liberando pagamento na Safeweb para protocolo: {protocol}")
+            response = upstream_http.post(url, headers=headers, json=payload, timeout=30)
+
+            if response.status_code == 200:
+                result = response.json()
+                if result == True or result == "true":
+                    logger.info(f"✅ Pagamento liberado com sucesso na Safeweb")
+                    return {'sucesso': True}
+                else:
+                    logger.error(f"❌ Safeweb retornou false para liberação de pagamento")
+                    return {'sucesso': False, 'erro': 'Safeweb não aceitou a liberação'}
+            else:
+                error_msg = f"HTTP {response.status_code}: {response.text}"
+                logger.error(f"❌ Erro ao liberar pagamento: {error_msg}")
+                return {
+                    'sucesso': False,
+                    'erro': error_msg
+                }
+
+        except Exception as e:
+            logger.error(f"❌ Erro em liberar_pagamento: {str(e)}")
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+    def criar_solicitacao_hope(self, protocol):
+        """Cria solicitação Hope para upload de documentos (a liberação é um efeito separado da outbox)"""
+        try:
+            token = self.ensure_valid_token()
+
+            hope_url = os.environ.get('SAFEWEB_HOPE_API_URL')
+            attendance_place_id = int(os.environ.get('SAFEWEB_ATTENDANCE_PLACE_ID', '348'))
+
+            if not hope_url:
+                raise Exception("SAFEWEB_HOPE_API_URL não configurado")
+
+            headers = {
+                'Authorization': f'bearer {token}',
+                'Content-Type': 'application/json'
+            }
+            payload = {
+                'protocol': protocol,
+                'attendancePlaceId': attendance_place_id,
+                'aciRemovalCandidate': False
+            }
+            logger.info(f"🔄 Chamando Hope API: {hope_url}")
+            hope_response = upstream_http.post(hope_url, headers=headers, json=payload, timeout=30)
+
+            if hope_response.status_code == 200:
+                result = hope_response.json()
+                upload_url = result.get('url')
+                logger.info(f"✅ Solicitação Hope criada com sucesso")
+                logger.debug("📎 URL de upload: %s", upload_url)
+
+                return {
+                    'sucesso': True,
+                    'uploadUrl': upload_url,
+                    'emailEnviado': result.get('emailSend', False)
+                }
+            else:
+                error_msg = f"HTTP {hope_response.status_code}: {hope_response.text}"
+                logger.error(f"❌ Erro na API Hope: {error_msg}")
+                return {
+                    'sucesso': False,
+                    'erro': error_msg
+                }
+
+        except Exception as e:
+            logger.error(f"❌ Erro em criar_solicitacao_hope: {str(e)}")
+            return {
+                'sucesso': False,
+                'erro': str(e)
+            }
+
+
+# ==========================================
+# ⏳ LONG-POLL DE STATUS PIX
+# ==========================================
+# Uma invocação segura a requisição até o webhook registrar um status
+# novo (ou o tempo esgotar), no lugar de uma invocação por segundo
+# ==========================================
+
+PIX_WAIT_MAX_SECONDS = int(os.environ.get('PIX_WAIT_MAX_SECONDS', 25))
+PIX_WAIT_UPSTREAM_INTERVAL = int(os.environ.get('PIX_WAIT_UPSTREAM_INTERVAL', 25))
+PIX_WAIT_STORE_INTERVAL = float(os.environ.get('PIX_WAIT_STORE_INTERVAL', 1))
+PIX_WAIT_UPSTREAM_TIMEOUT = float(os.environ.get('PIX_WAIT_UPSTREAM_TIMEOUT', 5))
+
+def wait_payment_status(safe2pay, transaction_id, since, timeout):
+    """
+    Aguarda o status da transação ficar diferente de `since`
+
+    O store de status (alimentado pelos webhooks de todos os containers) é
+    lido a cada PIX_WAIT_STORE_INTERVAL segundos; o Safe2Pay só é consultado
+    a cada PIX_WAIT_UPSTREAM_INTERVAL segundos e ao fim do tempo, para cobrir
+    webhooks perdidos. Cada consulta tem timeout PIX_WAIT_UPSTREAM_TIMEOUT e
+    nenhuma começa no meio se não terminar antes do prazo: o pior caso é
+    `timeout` + PIX_WAIT_UPSTREAM_TIMEOUT.
+    """
+    transaction_id = str(transaction_id)
+    since = str(since)
+    deadline = time.time() + timeout
+    next_upstream_check = time.time() + PIX_WAIT_UPSTREAM_INTERVAL
+
+    while True:
+        cached_data = payment_status_store.get(transaction_id)
+        if cached_data and str(cached_data.get('status')) != since:
+            return safe2pay.check_payment_status(transaction_id, timeout=PIX_WAIT_UPSTREAM_TIMEOUT)
+
+        now = time.time()
+        if now >= deadline:
+            return safe2pay.check_payment_status(transaction_id, timeout=PIX_WAIT_UPSTREAM_TIMEOUT)
+
+        if now >= next_upstream_check and deadline - now > PIX_WAIT_UPSTREAM_TIMEOUT:
+            resultado = safe2pay.check_payment_status(transaction_id, timeout=PIX_WAIT_UPSTREAM_TIMEOUT)
+            if resultado.get('sucesso') and str(resultado.get('statusCode')) != since:
+                return resultado
+            next_upstream_check = now + PIX_WAIT_UPSTREAM_INTERVAL
+
+        time.sleep(min(PIX_WAIT_STORE_INTERVAL, max(0, deadline - now)))
+
+
+# ==========================================
+# ♻️ CLIENTES COMPARTILHADOS (INVOCAÇÕES QUENTES)
+# ==========================================
+# Criados uma vez por container: o token Safeweb e as sessões HTTP
+# sobrevivem entre invocações
+# ==========================================
+
+_api_clients_lock = threading.Lock()
+_safe2pay_client = None
+_safeweb_client = None
+
+def get_safe2pay_client():
+    """Retorna a instância compartilhada de Safe2PayAPI (criada no primeiro uso)"""
+    global _safe2pay_client
+    if _safe2pay_client is None:
+        with _api_clients_lock:
+            if _safe2pay_client is None:
+                _safe2pay_client = Safe2PayAPI()
+    return _safe2pay_client
+
+def get_safeweb_client():
+    """Retorna a instância compartilhada de SafewebAPI (criada no primeiro uso)"""
+    global _safeweb_client
+    if _safeweb_client is None:
+        with _api_clients_lock:
+            if _safeweb_client is None:
+                _safeweb_client = SafewebAPI()
+    return _safeweb_client
+
+
+# ==========================================
+# ⚡ PRÉ-CHECAGEM SAFEWEB EM PARALELO
+# ==========================================
+# Biometria e consulta RFB na mesma invocação, em paralelo: o tempo do
+# step 2 passa a ser o da chamada mais lenta, não a soma das duas
+# ==========================================
+
+SAFEWEB_PRECHECK_WORKERS = int(os.environ.get('SAFEWEB_PRECHECK_WORKERS', 4))
+SAFEWEB_PRECHECK_TIMEOUT = int(os.environ.get('SAFEWEB_PRECHECK_TIMEOUT', 25))
+
+class BoundedExecutor:
+    """
+    Pool de threads compartilhado com limite de tarefas em andamento
+
+    Quando o limite é atingido a tarefa roda na própria thread de quem
+    chamou (sem fila ilimitada crescendo sob carga).
+    """
+
+    def __init__(self, max_workers, max_pending=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='safeweb')
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers)
+        self.inline_runs = 0
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.inline_runs += 1
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        # Levar o contexto (spans da requisição) para a thread do pool
+        future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_safeweb_executor = None
+
+
+def get_safeweb_executor():
+    """Retorna o pool compartilhado das chamadas Safeweb paralelas (criado no primeiro uso)"""
+    global _safeweb_executor
+    if _safeweb_executor is None:
+        with _api_clients_lock:
+            if _safeweb_executor is None:
+                _safeweb_executor = BoundedExecutor(SAFEWEB_PRECHECK_WORKERS)
+    return _safeweb_executor
+
+
+def run_pre_check(safeweb, cpf, data_nascimento):
+    """
+    Verifica biometria e consulta o CPF na RFB ao mesmo tempo
+
+    Returns:
+        dict com os dois resultados (`biometria`, `consulta`), `parcial` se só
+        um deles funcionou e o tempo de cada etapa
+    """
+    started = time.perf_counter()
+    executor = get_safeweb_executor()
+
+    def timed(fn, *args):
+        stage_started = time.perf_counter()
+        try:
+            return fn(*args), round((time.perf_counter() - stage_started) * 1000, 1)
+        except Exception as e:
+            return {'sucesso': False, 'erro': str(e)}, round((time.perf_counter() - stage_started) * 1000, 1)
+
+    futures = {
+        'biometria': executor.submit(timed, safeweb.verificar_biometria, cpf),
+        'consulta': executor.submit(timed, safeweb.consultar_cpf, cpf, data_nascimento)
+    }
+
+    resultado = {'timings': {}}
+    for etapa, future in futures.items():
+        try:
+            resultado[etapa], resultado['timings'][f'{etapa}_ms'] = future.result(timeout=SAFEWEB_PRECHECK_TIMEOUT)
+        except FutureTimeoutError:
+            resultado[etapa] = {'sucesso': False, 'erro': 'Tempo esgotado na consulta Safeweb'}
+    resultado['timings']['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    sucessos = [resultado[etapa].get('sucesso', False) for etapa in futures]
+    resultado['sucesso'] = all(sucessos)
+    resultado['parcial'] = any(sucessos) and not all(sucessos)
+    return resultado
+
+
+# ==========================================
+# 🧾 CHECKOUT EM UMA REQUISIÇÃO
+# ==========================================
+# Protocolo Safeweb + PIX Safe2Pay na mesma invocação, usando o token e
+# as conexões já aquecidos (uma ida ao API Gateway em vez de duas)
+# ==========================================
+
+# Campos do titular exigidos para gerar o protocolo (mesmos de /api/safeweb/gerar-protocolo)
+CHECKOUT_REQUIRED_FIELDS = ['cpf', 'nome', 'nascimento', 'email', 'telefone',
+                            'cep', 'endereco', 'numero', 'bairro', 'cidade', 'estado']
+
+
+def run_checkout(safeweb, safe2pay, dados):
+    """
+    Checkout em uma requisição: gera o protocolo Safeweb e cria o PIX Safe2Pay
+
+    Args:
+        safeweb: SafewebAPI compartilhada
+        safe2pay: Safe2PayAPI compartilhada
+        dados: Dados do titular (campos de gerar-protocolo), `product_id`, `valor`,
+            `pagador` opcional ({nome_completo, cpf, email, telefone}) e
+            `protocolo` opcional (reaproveita um protocolo já gerado, pulando a 1ª etapa)
+
+    Returns:
+        (dict, int): (resultado com protocolo, dados do PIX e tempos por etapa, status HTTP)
+    """
+    started = time.perf_counter()
+    timings = {}
+    protocolo = dados.get('protocolo')
+
+    if not protocolo:
+        for campo in CHECKOUT_REQUIRED_FIELDS:
+            if not dados.get(campo):
+                return {'sucesso': False, 'erro': f'Campo obrigatório ausente: {campo}', 'etapa': 'validacao'}, 400
+
+        stage_started = time.perf_counter()
+        resultado_protocolo = safeweb.gerar_protocolo(dados)
+        timings['protocolo_ms'] = round((time.perf_counter() - stage_started) * 1000, 1)
+
+        if not resultado_protocolo.get('sucesso'):
+            timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            return {
+                'sucesso': False,
+                'erro': resultado_protocolo.get('erro', 'Erro ao gerar protocolo'),
+                'etapa': 'protocolo',
+                'timings': timings
+            }, 400
+        protocolo = resultado_protocolo['protocolo']
+
+    # Pagador pode ser outra pessoa (modal de pagador); endereço é sempre o do titular
+    pagador = dados.get('pagador') or {}
+    dados_pix = {
+        'protocolo': protocolo,
+        'product_id': dados.get('product_id', 'ecpf-a1'),
+        'valor': dados.get('valor'),
+        'nome_completo': pagador.get('nome_completo') or dados.get('nome'),
+        'cpf': pagador.get('cpf') or dados.get('cpf'),
+        'email': pagador.get('email') or dados.get('email'),
+        'telefone': pagador.get('telefone') or dados.get('telefone'),
+        'cep': dados.get('cep', ''),
+        'endereco': dados.get('endereco', ''),
+        'numero': dados.get('numero', ''),
+        'complemento': dados.get('complemento', ''),
+        'bairro': dados.get('bairro', ''),
+        'cidade': dados.get('cidade', ''),
+        'uf': dados.get('estado', '')
+    }
+
+    stage_started = time.perf_counter()
+    resultado_pix = safe2pay.create_pix_payment(dados_pix)
+    timings['pix_ms'] = round((time.perf_counter() - stage_started) * 1000, 1)
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    if not resultado_pix.get('sucesso'):
+        # Protocolo já gerado volta na resposta: o cliente pode repetir só a etapa do PIX
+        return {
+            'sucesso': False,
+            'erro': resultado_pix.get('erro', 'Erro ao gerar PIX'),
+            'etapa': 'pix',
+            'protocolo': protocolo,
+            'timings': timings
+        }, 400
+
+    return {
+        'sucesso': True,
+        'protocolo': protocolo,
+        'dados': resultado_pix['dados'],
+        'timings': timings
+    }, 200
+
+
+# ==========================================
+# 📥 WEBHOOK SAFE2PAY: FILA SQS + CONSUMIDOR EM LOTE
+# ==========================================
+# A rota /webhook/safe2pay só valida e envia o evento para a fila SQS
+# (WEBHOOK_QUEUE_URL) e responde 200 na hora. A mesma função consome a
+# fila em lotes (event source mapping com ReportBatchItemFailures): os
+# eventos que falham voltam para a fila e, depois de maxReceiveCount
+# tentativas, vão para a DLQ. Sem fila configurada, processa na requisição.
+# ==========================================
+
+WEBHOOK_QUEUE_URL = os.environ.get('WEBHOOK_QUEUE_URL')
+# Tempo mínimo (ms) restante na invocação para começar a próxima mensagem do lote
+SQS_BATCH_TIME_RESERVE_MS = int(os.environ.get('SQS_BATCH_TIME_RESERVE_MS', 10000))
 
-    def gerar_protocolo(self, dados_completos):
-        try:
-            token = self.ensure_valid_token()
+_sqs_client = None
 
-            telefone_limpo = re.sub(r'\D', '', dados_completos.get('telefone', ''))
-            ddd = telefone_limpo[:2]
-            numero = telefone_limpo[2:]
 
-            payload = {
-                "CnpjAR": self.cnpj_ar,
-                "CodigoParceiro": self.codigo_parceiro,
-                "idProduto": self.produto_ecpf_a1,
-                "Nome": dados_completos.get('nome'),
-                "CPF": re.sub(r'\D', '', dados_completos.get('cpf', '')),
-                "DataNascimento": dados_completos.get('nascimento'),
-                "Contato": {
-                    "DDD": ddd,
-                    "Telefone": numero,
-                    "Email": dados_completos.get('email')
-                },
-                "Endereco": {
-                    "Logradouro": dados_completos.get('endereco'),
-                    "Numero": dados_completos.get('numero'),
-                    "Complemento": dados_completos.get('complemento', ''),
-                    "Bairro": dados_completos.get('bairro'),
-                    "UF": dados_completos.get('estado'),
-                    "Cidade": dados_completos.get('cidade'),
-                    "CEP": re.sub(r'\D', '', dados_completos.get('cep', ''))
-                }
-            }
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        _sqs_client = boto3.client('sqs')
+    return _sqs_client
 
-            response = requests.post(
-                f"{self.base_url}/Service/Microservice/Shared/Partner/api/Add/3",
-                json=payload,
-                headers={
-                    'Authorization': token,
-                    'Content-Type': 'application/json'
-                },
-                timeout=30
-            )
 
-            if response.status_code != 200:
-                raise Exception(f'Erro ao gerar protocolo: {response.status_code}')
+class PostApprovalAutomation:
+    """
+    Solicitação Hope disparada pelo webhook assim que o pagamento é aprovado
 
-            protocolo = response.json()
+    Roda uma vez por protocolo (reserva no backend chave-valor) a partir do
+    efeito 'hope' da outbox; o endpoint /api/hope/create-solicitation só
+    aguarda ou reaproveita o resultado. O link de upload fica gravado e vai
+    junto na consulta de status, mesmo que a aba tenha sido fechada.
+    """
 
-            return {
-                'sucesso': True,
-                'protocolo': protocolo,
-                'mensagem': 'Protocolo gerado com sucesso'
-            }
+    PREFIX = 'post-approval:'
+
+    def __init__(self, kv_store, create_solicitation, ttl=7 * 24 * 3600, lease_seconds=120):
+        """
+        Args:
+            kv_store: Backend chave-valor
+            create_solicitation: Função (protocolo) -> resultado da solicitação Hope
+            ttl: Segundos que o link de upload fica gravado
+            lease_seconds: Validade da reserva enquanto a solicitação roda
+        """
+        self.kv = kv_store
+        self.create_solicitation = create_solicitation
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self._latencies = deque(maxlen=500)  # webhook -> Hope concluída (ms)
+        self._lock = threading.Lock()
+        self._stats = {'completed': 0, 'failed': 0, 'reused': 0}
+
+    def execute(self, protocol, transaction_id=None, received_at=None):
+        """
+        Cria a solicitação Hope uma única vez por protocolo
+
+        Returns:
+            Resultado da solicitação (gravado ou recém-criado), ou None se
+            outra execução para o mesmo protocolo ainda está em andamento
+        """
+        key = self.PREFIX + str(protocol)
+        record = self.kv.get(key)
+        if record and record.get('state') == 'done':
+            with self._lock:
+                self._stats['reused'] += 1
+            return record['resultado']
+
+        if not self.kv.add(key, {'state': 'running', 'transactionId': transaction_id}, ttl=self.lease_seconds):
+            return None
 
+        try:
+            resultado = self.create_solicitation(protocol)
         except Exception as e:
+            resultado = {'sucesso': False, 'erro': str(e)}
+
+        if not resultado.get('sucesso'):
+            # Liberar a reserva: a outbox tenta de novo com backoff
+            self.kv.delete(key)
+            with self._lock:
+                self._stats['failed'] += 1
+            return resultado
+
+        self.kv.put(key, {'state': 'done', 'transactionId': transaction_id, 'resultado': resultado}, ttl=self.ttl)
+        with self._lock:
+            self._stats['completed'] += 1
+            if received_at:
+                elapsed_ms = round((time.time() - received_at) * 1000, 1)
+                self._latencies.append(elapsed_ms)
+        if received_at:
+            logger.info(f"⏱️ Webhook → Hope concluída em {elapsed_ms} ms (protocolo {protocol})")
+        return resultado
+
+    def wait_for(self, protocol, wait_timeout, poll_interval=0.25):
+        """Aguarda a outbox concluir a solicitação (endpoint do frontend); None se não concluiu a tempo"""
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            resultado = self.result(protocol)
+            if resultado is not None:
+                return resultado
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def result(self, protocol):
+        """Resultado gravado da solicitação Hope (ou None)"""
+        record = self.kv.get(self.PREFIX + str(protocol))
+        if record and record.get('state') == 'done':
+            return record['resultado']
+        return None
+
+    def upload_url(self, protocol):
+        """Link de upload já gerado para o protocolo (ou None)"""
+        resultado = self.result(protocol)
+        return resultado.get('uploadUrl') if resultado else None
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
             return {
-                'sucesso': False,
-                'erro': str(e)
+                **self._stats,
+                'webhook_to_hope_ms': {
+                    'count': len(latencies),
+                    'p50': latencies[len(latencies) // 2] if latencies else None,
+                    'p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+                    'max': latencies[-1] if latencies else None
+                }
             }
 
-    def liberar_pagamento(self, protocol):
-        """Libera pagamento na Safeweb - UpdateLiberacao"""
-        try:
-            # Autenticar e obter token
-            if not self.token or not self.token_expiry:
-                self.authenticate()
 
-            # URL do endpoint UpdateLiberacao
-            url = f"{self.base_url}/Service/Microservice/Shared/Partner/api/UpdateLiberacao"
+# Solicitação Hope após a aprovação (executada pelo efeito 'hope' da outbox)
+post_approval = PostApprovalAutomation(
+    create_kv_store(os.environ.get('POST_APPROVAL_STORE', 'memory')),
+    lambda protocol: get_safeweb_client().criar_solicitacao_hope(protocol)
+)
 
-            headers = {
-                'Authorization': f'bearer {self.token}',
-                'Content-Type': 'application/json'
-            }
 
-            payload = {
-                'Protocolo': protocol,
-                'CNPJ': self.cnpj_ar
-            }
+# ==========================================
+# 📤 OUTBOX DE EFEITOS SAFEWEB (SQS)
+# ==========================================
+# Liberação e solicitação Hope de um pagamento aprovado viram mensagens
+# na fila OUTBOX_QUEUE_URL, consumidas pela mesma função. O estado de cada
+# efeito (pending/done/dead) fica no backend chave-valor por tipo + chave,
+# o que evita efeitos duplicados. Falhas voltam para a fila com backoff
+# (ChangeMessageVisibility) e, depois de OUTBOX_MAX_ATTEMPTS tentativas,
+# vão para a DLQ. Sem fila configurada, os efeitos rodam na requisição.
+# ==========================================
 
-            print(f"💳 Liberando pagamento na Safeweb para protocolo: {protocol}")
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+OUTBOX_QUEUE_URL = os.environ.get('OUTBOX_QUEUE_URL')
+OUTBOX_DLQ_URL = os.environ.get('OUTBOX_DLQ_URL')
+
+
+class SQSOutbox:
+    """Outbox durável dos efeitos colaterais (liberação Safeweb, solicitação Hope, ...)"""
+
+    PREFIX = 'outbox:'
+
+    def __init__(self, kv_store, run_effect, queue_url=None, dlq_url=None, max_attempts=8, ttl=7 * 24 * 3600,
+                 lease_seconds=900):
+        """
+        Args:
+            kv_store: Backend chave-valor com o estado de cada efeito
+            run_effect: Função (tipo, payload) que executa o efeito (exceção = retentar)
+            queue_url: Fila SQS dos efeitos (None = executar na hora)
+            dlq_url: DLQ da fila (só para a contagem em /api/ops/outbox)
+            max_attempts: Tentativas antes de marcar o efeito como morto
+            ttl: Segundos que o estado concluído/morto fica gravado
+            lease_seconds: Validade do estado 'pending', renovada a cada entrega.
+                Cobre o maior intervalo entre entregas (backoff até 600s ou a
+                visibilidade da fila); se a última tentativa morrer por timeout
+                ou crash (mensagem vai para a DLQ sem passar pelo except), o
+                estado expira e um novo webhook reativa o efeito
+        """
+        self.kv = kv_store
+        self.run_effect = run_effect
+        self.queue_url = queue_url
+        self.dlq_url = dlq_url
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._stats = {'added': 0, 'processed': 0, 'retried': 0, 'dead': 0}
+        self._depth = None
+        self._depth_at = 0.0
+
+    def _key(self, kind, key):
+        return f"{self.PREFIX}{kind}:{key}"
+
+    def add(self, kind, key, payload):
+        """
+        Grava o efeito (uma vez por tipo + chave) e o envia para a fila
+
+        Um efeito morto com a mesma chave é reativado (novo webhook ou ação do
+        usuário), assim como um pendente cujo lease expirou; pendentes em dia e
+        concluídos ficam como estão.
+
+        Returns:
+            True se o efeito foi gravado ou reativado
+        """
+        state_key = self._key(kind, key)
+        record = {'state': 'pending', 'createdAt': time.time()}
+        if not self.kv.add(state_key, record, ttl=self.lease_seconds):
+            current = self.kv.get(state_key)
+            if not current or current.get('state') != 'dead':
+                return False
+            self.kv.put(state_key, record, ttl=self.lease_seconds)
+
+        with self._lock:
+            self._stats['added'] += 1
+
+        if not self.queue_url:
+            try:
+                self.process({'effect': kind, 'key': key, 'payload': payload})
+            except Exception:
+                # Sem fila não há retentativa: liberar a chave para a próxima chamada
+                self.kv.delete(state_key)
+                raise
+            return True
 
-            if response.status_code == 200:
-                result = response.json()
-                if result == True or result == "true":
-                    print(f"✅ Pagamento liberado com sucesso na Safeweb")
-                    return {'sucesso': True}
-                else:
-                    print(f"❌ Safeweb retornou false para liberação de pagamento")
-                    return {'sucesso': False, 'erro': 'Safeweb não aceitou a liberação'}
-            else:
-                error_msg = f"HTTP {response.status_code}: {response.text}"
-                print(f"❌ Erro ao liberar pagamento: {error_msg}")
-                return {
-                    'sucesso': False,
-                    'erro': error_msg
-                }
+        try:
+            get_sqs_client().send_message(
+                QueueUrl=self.queue_url,
+                MessageBody=json.dumps({'effect': kind, 'key': key, 'payload': payload})
+            )
+        except Exception:
+            # Sem a mensagem o efeito nunca rodaria: liberar a chave para a próxima tentativa
+            self.kv.delete(state_key)
+            raise
+        return True
+
+    def process(self, message, record=None):
+        """
+        Executa um efeito recebido da fila
+
+        Args:
+            message: {'effect', 'key', 'payload'}
+            record: Registro SQS (None = execução direta, sem fila)
+
+        Raises:
+            Exception: Efeito falhou e deve voltar para a fila
+        """
+        kind = message['effect']
+        state_key = self._key(kind, message['key'])
+        current = self.kv.get(state_key)
+        if current and current.get('state') == 'done':
+            return
+        if record is not None:
+            # Renovar o lease do 'pending' a cada entrega (ver lease_seconds)
+            self.kv.put(state_key, {**(current or {}), 'state': 'pending'}, ttl=self.lease_seconds)
 
+        try:
+            self.run_effect(kind, message['payload'])
         except Exception as e:
-            print(f"❌ Erro em liberar_pagamento: {str(e)}")
-            return {
-                'sucesso': False,
-                'erro': str(e)
+            if record is None:
+                raise
+            attempts = int((record.get('attributes') or {}).get('ApproximateReceiveCount', 1))
+            if attempts >= self.max_attempts:
+                # A redrive policy leva a mensagem para a DLQ; o estado permite reativar depois
+                self.kv.put(state_key, {'state': 'dead', 'lastError': str(e)[:500]}, ttl=self.ttl)
+                with self._lock:
+                    self._stats['dead'] += 1
+                logger.error(f"💀 Outbox: efeito '{kind}' ({message['key']}) descartado após {attempts} tentativas: {str(e)}")
+            else:
+                with self._lock:
+                    self._stats['retried'] += 1
+                logger.info(f"🔁 Outbox: efeito '{kind}' ({message['key']}) falhou (tentativa {attempts}): {str(e)}")
+                # Backoff exponencial (2, 4, 8... até 600s) no lugar da visibilidade fixa da fila
+                get_sqs_client().change_message_visibility(
+                    QueueUrl=self.queue_url,
+                    ReceiptHandle=record['receiptHandle'],
+                    VisibilityTimeout=min(2 ** attempts, 600)
+                )
+            raise
+
+        self.kv.put(state_key, {'state': 'done', 'doneAt': time.time()}, ttl=self.ttl)
+        with self._lock:
+            self._stats['processed'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'queue_configured': bool(self.queue_url)}
+
+    def queue_depth(self, max_age=30):
+        """
+        Mensagens na fila e na DLQ (GetQueueAttributes; sem dados de clientes)
+
+        A contagem fica em cache por `max_age` segundos no container: consultas
+        repetidas não viram chamadas SQS.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._depth is not None and now - self._depth_at < max_age:
+                return self._depth
+        depth = {}
+        for name, url in (('queue', self.queue_url), ('dlq', self.dlq_url)):
+            if not url:
+                continue
+            attributes = get_sqs_client().get_queue_attributes(
+                QueueUrl=url,
+                AttributeNames=[
+                    'ApproximateNumberOfMessages',
+                    'ApproximateNumberOfMessagesNotVisible',
+                    'ApproximateNumberOfMessagesDelayed'
+                ]
+            )['Attributes']
+            depth[name] = {
+                'visible': int(attributes.get('ApproximateNumberOfMessages', 0)),
+                'in_flight': int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0)),
+                'delayed': int(attributes.get('ApproximateNumberOfMessagesDelayed', 0))
             }
+        with self._lock:
+            self._depth, self._depth_at = depth, now
+        return depth
 
-    def criar_solicitacao_hope(self, protocol):
-        """Cria solicitação Hope para upload de documentos"""
-        try:
-            import concurrent.futures
 
-            # Autenticar uma vez antes de paralelizar
-            if not self.token or not self.token_expiry:
-                self.authenticate()
+def run_outbox_effect(kind, payload):
+    """Executa um efeito da outbox (exceção = retentar com backoff)"""
+    protocol = payload['protocol']
 
-            # Obter configurações
-            hope_url = os.environ.get('SAFEWEB_HOPE_API_URL')
-            attendance_place_id = int(os.environ.get('SAFEWEB_ATTENDANCE_PLACE_ID', '348'))
+    if kind == 'liberacao':
+        resultado = get_safeweb_client().liberar_pagamento(protocol)
+        if not resultado.get('sucesso'):
+            raise Exception(resultado.get('erro') or 'Liberação não concluída')
 
-            if not hope_url:
-                raise Exception("SAFEWEB_HOPE_API_URL não configurado")
+    elif kind == 'hope':
+        resultado = post_approval.execute(protocol, payload.get('transactionId'), payload.get('receivedAt'))
+        if resultado is None:
+            raise Exception('Solicitação Hope em andamento em outra execução')
+        if not resultado.get('sucesso'):
+            raise Exception(resultado.get('erro') or 'Solicitação Hope não concluída')
 
-            print(f"🚀 Executando liberação e criação Hope em paralelo...")
+    else:
+        logger.error(f"❌ Efeito desconhecido na outbox: {kind}")
 
-            # Executar PARALELAMENTE (otimização de performance)
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                # Iniciar ambas as chamadas simultaneamente
-                future_liberacao = executor.submit(self.liberar_pagamento, protocol)
 
-                # Preparar chamada Hope
-                def chamar_hope():
-                    headers = {
-                        'Authorization': f'bearer {self.token}',
-                        'Content-Type': 'application/json'
-                    }
-                    payload = {
-                        'protocol': protocol,
-                        'attendancePlaceId': attendance_place_id,
-                        'aciRemovalCandidate': False
-                    }
-                    print(f"🔄 Chamando Hope API: {hope_url}")
-                    return requests.post(hope_url, headers=headers, json=payload, timeout=30)
+outbox = SQSOutbox(
+    create_kv_store(os.environ.get('OUTBOX_STORE', 'memory')),
+    run_outbox_effect,
+    queue_url=OUTBOX_QUEUE_URL,
+    dlq_url=OUTBOX_DLQ_URL,
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8)),
+    lease_seconds=int(os.environ.get('OUTBOX_LEASE_SECONDS', 900))
+)
 
-                future_hope = executor.submit(chamar_hope)
 
-                # Aguardar ambas (executam em paralelo)
-                liberacao_result = future_liberacao.result()
-                hope_response = future_hope.result()
+def enqueue_post_approval(protocol, transaction_id=None, received_at=None):
+    """Grava na outbox os efeitos Safeweb de um pagamento aprovado (liberação + Hope)"""
+    payload = {'protocol': protocol, 'transactionId': transaction_id, 'receivedAt': received_at}
+    for kind in ('liberacao', 'hope'):
+        try:
+            if outbox.add(kind, protocol, payload):
+                logger.info(f"📤 Outbox: efeito '{kind}' gravado para protocolo {protocol}")
+        except Exception as e:
+            # Sem fila o efeito roda na hora: a falha já foi registrada e fica para a próxima chamada
+            if OUTBOX_QUEUE_URL:
+                raise
+            logger.warning(f"⚠️ Outbox: efeito '{kind}' falhou para protocolo {protocol}: {str(e)}")
 
-            # Verificar resultado da liberação (apenas log, não bloqueia)
-            if not liberacao_result.get('sucesso'):
-                print(f"⚠️ Aviso: Liberação de pagamento falhou, mas continuando...")
-            else:
-                print(f"✅ Pagamento liberado na Safeweb")
 
-            # Processar resposta Hope
-            if hope_response.status_code == 200:
-                result = hope_response.json()
-                upload_url = result.get('url')
-                print(f"✅ Solicitação Hope criada com sucesso")
-                print(f"📎 URL de upload: {upload_url}")
+def extract_safe2pay_notification(data):
+    """Retorna o payload da notificação (formato direto ou NotificationWrapper)"""
+    if not isinstance(data, dict):
+        return {}
+    if 'NotificationWrapper' in data:
+        logger.debug("📦 Webhook formato WRAPPER detectado")
+        return (data['NotificationWrapper'] or {}).get('NotificationPayload') or {}
+    return data
+
+
+def process_safe2pay_notification(body, received_at=None):
+    """Processa um webhook Safe2Pay (exceção = o evento volta para a fila)"""
+    notification_payload = extract_safe2pay_notification(body)
+
+    # Extrair dados do webhook (formato Safe2Pay)
+    id_transacao = notification_payload.get('IdTransaction')
+
+    # TransactionStatus pode vir como objeto ou direto
+    transaction_status = notification_payload.get('TransactionStatus', {})
+    if isinstance(transaction_status, dict):
+        status_id = transaction_status.get('Id')
+        status_code = transaction_status.get('Code')
+        status_name = transaction_status.get('Name')
+    else:
+        # Fallback para formato simples
+        status_id = body.get('Status') or body.get('PaymentStatus')
+        status_code = str(status_id)
+        status_name = 'Unknown'
+
+    reference = notification_payload.get('Reference')
+    payment_date = notification_payload.get('PaymentDate')
+    amount = notification_payload.get('Amount')
+    payment_method = notification_payload.get('PaymentMethod') or {}
+
+    logger.info(
+        f"📊 Webhook Safe2Pay: transação {id_transacao} - {status_name} ({status_id}/{status_code}), "
+        f"reference {reference}, valor {amount}, data {payment_date}, método {payment_method.get('Name', 'N/A')}"
+    )
+
+    # Armazenar status no store compartilhado (para consultas via /api/pix/status)
+    if payment_status_store.record(
+        id_transacao, status_id, status_code, status_name,
+        amount=amount, payment_date=payment_date, reference=reference, received_at=received_at
+    ) is not None:
+        logger.debug(f"💾 Status armazenado para transaction {id_transacao}")
+
+    # Status 3 = Autorizado/Aprovado (segundo documentação Safe2Pay)
+    if status_id == 3 or status_code == '3':
+        logger.info(f"✅ PAGAMENTO APROVADO! Transaction: {id_transacao}, Reference: {reference}, R$ {amount} em {payment_date}")
+
+        # Reference do PIX = protocolo Safeweb: liberação e link de upload vão para a outbox
+        if reference:
+            enqueue_post_approval(reference, id_transacao, received_at or time.time())
+        else:
+            logger.warning(f"⚠️ Webhook aprovado sem Reference: solicitação Hope fica para o frontend")
+    else:
+        logger.info(f"📊 Webhook - Status {status_name} ({status_id}) recebido para transaction {id_transacao}")
 
-                return {
-                    'sucesso': True,
-                    'uploadUrl': upload_url,
-                    'emailEnviado': result.get('emailSend', False)
-                }
-            else:
-                error_msg = f"HTTP {hope_response.status_code}: {hope_response.text}"
-                print(f"❌ Erro na API Hope: {error_msg}")
-                return {
-                    'sucesso': False,
-                    'erro': error_msg
-                }
 
+def process_webhook_batch(event, context=None):
+    """
+    Consumidor SQS (webhooks e outbox): processa o lote e devolve só as mensagens que falharam
+
+    Perto do timeout da Lambda para de iniciar mensagens e devolve as restantes
+    como falhas, em vez de perder o lote inteiro quando a invocação expira.
+    """
+    failures = []
+    records = event['Records']
+    for index, record in enumerate(records):
+        if context is not None and context.get_remaining_time_in_millis() < SQS_BATCH_TIME_RESERVE_MS:
+            logger.warning(f"⏱️ Lote SQS interrompido perto do timeout: {len(records) - index} mensagens devolvidas à fila")
+            failures.extend({'itemIdentifier': r['messageId']} for r in records[index:])
+            break
+        try:
+            message = json.loads(record['body'])
+            if isinstance(message, dict) and 'effect' in message:
+                outbox.process(message, record)
+                continue
+            sent_timestamp = (record.get('attributes') or {}).get('SentTimestamp')
+            received_at = int(sent_timestamp) / 1000 if sent_timestamp else None
+            process_safe2pay_notification(message, received_at)
         except Exception as e:
-            print(f"❌ Erro em criar_solicitacao_hope: {str(e)}")
-            return {
-                'sucesso': False,
-                'erro': str(e)
-            }
+            logger.error(f"❌ Erro ao processar mensagem {record.get('messageId')}: {str(e)}")
+            failures.append({'itemIdentifier': record['messageId']})
 
+    logger.info(f"📥 Lote SQS: {len(records)} mensagens, {len(failures)} falhas")
+    return {'batchItemFailures': failures}
 
-def handler(event, context):
-    """Lambda Handler principal"""
 
-    print(f"Event: {json.dumps(event)}")
+def handler(event, context):
+    """Lambda Handler principal (métricas EMF e trace OTLP da invocação ao final)"""
+    started = time.perf_counter()
+    invocation_metrics.reset()
+    timing = ServerTiming()
+    timing_token = _request_timing.set(timing)
+    request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    trace = RequestTrace(
+        request_headers.get('x-request-id'), request_headers.get('traceparent'),
+        kind=SPAN_KIND_CONSUMER if event.get('Records') else SPAN_KIND_SERVER
+    )
+    http_path = ((event.get('requestContext') or {}).get('http') or {}).get('path')
+    trace.route = 'sqs' if event.get('Records') else metric_route_label(http_path)
+    trace_token = _request_trace.set(trace)
+    aws_request_id = getattr(context, 'aws_request_id', None)
+    logger.info(f"🔗 request_id={trace.request_id} trace_id={trace.trace_id} aws_request_id={aws_request_id}")
+    response = None
+    try:
+        response = dispatch_event(event, context)
+        if not event.get('Records'):
+            response = attach_server_timing(
+                response, timing, request_headers.get('x-debug-timing') == '1', request_id=trace.request_id
+            )
+        return response
+    finally:
+        _request_timing.reset(timing_token)
+        _request_trace.reset(trace_token)
+        if event.get('Records'):
+            route, method = 'sqs', 'BATCH'
+            if response is None:
+                status = 'error'
+            else:
+                status = 'partial_failure' if response.get('batchItemFailures') else 'ok'
+        else:
+            http_context = (event.get('requestContext') or {}).get('http') or {}
+            status = response.get('statusCode', 500) if response else 500
+            route, method = metric_route_label(http_context.get('path')), http_context.get('method')
+        invocation_metrics.emit(route, method, status, time.perf_counter() - started, {
+            'RequestId': trace.request_id,
+            'TraceId': trace.trace_id
+        })
+        failed = status == 'error' or (isinstance(status, int) and status >= 500)
+        trace_exporter.export(trace.finish(f"{method} {route}", {
+            'http.request.method': method if method != 'BATCH' else None,
+            'http.route': route,
+            'http.response.status_code': status if isinstance(status, int) else None,
+            'faas.invocation_id': aws_request_id
+        }, error=failed))
+        flush_logs()
+
+
+def dispatch_event(event, context):
+    """Encaminha o evento: lote SQS ou requisição do API Gateway"""
+
+    # Lote da fila de webhooks (SQS), não uma requisição HTTP
+    records = event.get('Records') or []
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        return process_webhook_batch(event, context)
 
     # Extrair informações do evento API Gateway
     http_method = event.get('requestContext', {}).get('http', {}).get('method')
@@ -841,6 +4108,8 @@ def handler(event, context):
         except:
             body = {}
 
+    log_payload("📨 Evento API Gateway", {**event, 'body': body})
+
     # 🔒 CORS Seguro - Lista de domínios permitidos
     allowed_origins = [
         'https://www.certificadodigital.br.com',
@@ -863,13 +4132,14 @@ def handler(event, context):
         # Se origin não está na lista, usar o primeiro (produção)
         cors_origin = allowed_origins[0]
         if request_origin:
-            print(f"⚠️ CORS: Origin não autorizado bloqueado: {request_origin}")
+            logger.warning(f"⚠️ CORS: Origin não autorizado bloqueado: {request_origin}")
 
     # Headers CORS + Security Headers
     cors_headers = {
         'Access-Control-Allow-Origin': cors_origin,
         'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, Idempotency-Key, X-Debug-Timing, X-Request-ID, traceparent',
+        'Access-Control-Expose-Headers': 'Server-Timing, X-Request-ID, Retry-After',
         'Access-Control-Allow-Credentials': 'true',
         'Content-Type': 'application/json',
         # 🛡️ Security Headers
@@ -881,40 +4151,167 @@ def handler(event, context):
         'Referrer-Policy': 'strict-origin-when-cross-origin'
     }
 
+    idempotency_key = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'idempotency-key'), None)
+    if idempotency_key and http_method == 'POST' and path in IDEMPOTENT_ROUTES:
+        return handle_idempotent_request(event, context, http_method, path, body, cors_headers, idempotency_key)
+
+    return route_request(event, context, http_method, path, body, cors_headers)
+
+
+def handle_idempotent_request(event, context, http_method, path, body, cors_headers, idempotency_key):
+    """Executa a rota uma única vez por Idempotency-Key e repete a resposta gravada"""
+    if len(idempotency_key) > 255:
+        return {
+            'statusCode': 400,
+            'headers': cors_headers,
+            'body': serialize_body({'sucesso': False, 'erro': 'Idempotency-Key inválida'}, ensure_ascii=False)
+        }
+
+    fingerprint = IdempotencyStore.fingerprint(event.get('body') or '')
+    try:
+        outcome, record = idempotency_store.begin(path, idempotency_key, fingerprint)
+    except Exception as e:
+        # Sem o registro não há como garantir execução única: o cliente repete com a mesma chave
+        logger.error(f"❌ Store de idempotência indisponível em {path}: {str(e)}")
+        return {
+            'statusCode': 503,
+            'headers': {**cors_headers, 'Retry-After': '2'},
+            'body': serialize_body({
+                'sucesso': False,
+                'erro': 'Serviço temporariamente indisponível. Tente novamente.'
+            }, ensure_ascii=False)
+        }
+
+    if outcome == 'replay':
+        logger.info(f"🔁 Idempotency-Key repetida em {path}: resposta reaproveitada")
+        return {
+            'statusCode': record['status_code'],
+            'headers': {**cors_headers, **record['headers'], 'Idempotent-Replayed': 'true'},
+            'body': record['body']
+        }
+    if outcome == 'mismatch':
+        return {
+            'statusCode': 422,
+            'headers': cors_headers,
+            'body': serialize_body({'sucesso': False, 'erro': 'Idempotency-Key já usada com outros dados'}, ensure_ascii=False)
+        }
+    if outcome == 'in_progress':
+        return {
+            'statusCode': 409,
+            'headers': {**cors_headers, 'Retry-After': '2'},
+            'body': serialize_body({
+                'sucesso': False,
+                'erro': 'Requisição original ainda em processamento. Tente novamente em instantes.'
+            }, ensure_ascii=False)
+        }
+
+    response = {'statusCode': 500, 'headers': cors_headers, 'body': ''}
+    try:
+        response = route_request(event, context, http_method, path, body, cors_headers)
+        return response
+    finally:
+        # Só os headers próprios da rota são gravados (CORS é recalculado por origem)
+        extra_headers = {k: v for k, v in response.get('headers', {}).items() if k not in cors_headers}
+        try:
+            idempotency_store.complete(path, idempotency_key, fingerprint, response['statusCode'], response['body'], extra_headers)
+        except Exception as e:
+            # Não trocar a resposta da rota por um erro; a reserva expira sozinha
+            logger.error(f"❌ Falha ao gravar resposta idempotente em {path}: {str(e)}")
+
+
+def route_request(event, context, http_method, path, body, cors_headers):
+    """Roteamento das rotas da API"""
     try:
         # Roteamento
         if path == '/api/health':
             return {
                 'statusCode': 200,
                 'headers': cors_headers,
-                'body': json.dumps({
+                'body': serialize_body({
                     'status': 'healthy',
                     'timestamp': datetime.now().isoformat(),
-                    'service': 'ecommerce-api-lambda'
+                    'service': 'ecommerce-api-lambda',
+                    'upstream': upstream_http.stats(),
+                    'transaction_cache': transaction_status_cache.stats(),
+                    'idempotency': idempotency_store.stats(),
+                    'post_approval': post_approval.stats(),
+                    'outbox': outbox.stats(),
+                    'tracing': trace_exporter.stats(),
+                    'logging': {'queued': log_queue.qsize(), 'dropped': log_handler.dropped, 'level': LOG_LEVEL},
+                    'safeweb_cache': safeweb_lookup_cache.stats(),
+                    'rate_limiter': distributed_rate_limiter.stats(),
+                    'safeweb_token': {
+                        **_safeweb_client.token_manager.stats(),
+                        'token_store_hits': _safeweb_client.token_store_hits,
+                        'auth_calls_per_minute': _safeweb_client.auth_meter.per_minute()
+                    } if _safeweb_client else None
+                })
+            }
+
+        elif path == '/api/ops/outbox' and http_method == 'GET':
+            # Profundidade da outbox (contagens apenas, sem dados de clientes)
+            return {
+                'statusCode': 200,
+                'headers': cors_headers,
+                'body': serialize_body({
+                    'sucesso': True,
+                    'outbox': {**outbox.stats(), **outbox.queue_depth()}
                 })
             }
 
         elif path == '/api/pix/create' and http_method == 'POST':
-            safe2pay = Safe2PayAPI()
+            safe2pay = get_safe2pay_client()
             resultado = safe2pay.create_pix_payment(body)
             status_code = 200 if resultado.get('sucesso') else 400
 
             return {
                 'statusCode': status_code,
                 'headers': cors_headers,
-                'body': json.dumps(resultado, ensure_ascii=False)
+                'body': serialize_body(resultado, ensure_ascii=False)
+            }
+
+        elif path.startswith('/api/pix/wait/') and http_method == 'GET':
+            # Long-poll: GET /api/pix/wait/<id>?since=<statusCode>&timeout=<segundos>
+            transaction_id = path.rstrip('/').split('/')[-1]
+            if not transaction_id.isdigit():
+                return {
+                    'statusCode': 400,
+                    'headers': cors_headers,
+                    'body': serialize_body({'sucesso': False, 'erro': 'Transaction ID inválido'})
+                }
+
+            params = event.get('queryStringParameters') or {}
+            try:
+                timeout = float(params.get('timeout', PIX_WAIT_MAX_SECONDS))
+            except ValueError:
+                timeout = PIX_WAIT_MAX_SECONDS
+            timeout = max(0, min(timeout, PIX_WAIT_MAX_SECONDS))
+
+            # Nunca segurar além do tempo restante da invocação (nem do limite de 30s
+            # do API Gateway): reservar a consulta final ao Safe2Pay e 3s de folga
+            if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+                timeout = min(timeout, context.get_remaining_time_in_millis() / 1000 - 3 - PIX_WAIT_UPSTREAM_TIMEOUT)
+
+            safe2pay = get_safe2pay_client()
+            resultado = wait_payment_status(safe2pay, transaction_id, params.get('since', ''), max(0, timeout))
+            status_code = 200 if resultado.get('sucesso') else 400
+
+            return {
+                'statusCode': status_code,
+                'headers': cors_headers,
+                'body': serialize_body(resultado, ensure_ascii=False)
             }
 
         elif path.startswith('/api/pix/status/'):
             transaction_id = path.split('/')[-1]
-            safe2pay = Safe2PayAPI()
+            safe2pay = get_safe2pay_client()
             resultado = safe2pay.check_payment_status(transaction_id)
             status_code = 200 if resultado.get('sucesso') else 400
 
             return {
                 'statusCode': status_code,
                 'headers': cors_headers,
-                'body': json.dumps(resultado, ensure_ascii=False)
+                'body': serialize_body(resultado, ensure_ascii=False)
             }
 
         elif path == '/api/safeweb/verificar-biometria' and http_method == 'POST':
@@ -923,28 +4320,29 @@ def handler(event, context):
                 return {
                     'statusCode': 400,
                     'headers': cors_headers,
-                    'body': json.dumps({'sucesso': False, 'erro': 'CPF é obrigatório'})
+                    'body': serialize_body({'sucesso': False, 'erro': 'CPF é obrigatório'})
                 }
 
-            # 🛡️ Verificar rate limit por CPF (5 tentativas a cada 5 minutos)
-            allowed, remaining, retry_after = check_cpf_rate_limit(cpf, max_attempts=5, window_seconds=300)
+            # 🛡️ Verificar rate limit por CPF (padrão: 5 tentativas a cada 5 minutos)
+            max_attempts, window_seconds = CPF_RATE_LIMITS[path]
+            allowed, remaining, retry_after = check_cpf_rate_limit(cpf, max_attempts, window_seconds)
             if not allowed:
                 return {
                     'statusCode': 429,
                     'headers': {
                         **cors_headers,
                         'Retry-After': str(retry_after),
-                        'X-RateLimit-Limit': '5',
+                        'X-RateLimit-Limit': str(max_attempts),
                         'X-RateLimit-Remaining': '0'
                     },
-                    'body': json.dumps({
+                    'body': serialize_body({
                         'sucesso': False,
                         'erro': f'Muitas tentativas. Tente novamente em {retry_after} segundos.',
                         'retry_after': retry_after
                     })
                 }
 
-            safeweb = SafewebAPI()
+            safeweb = get_safeweb_client()
             resultado = safeweb.verificar_biometria(cpf)
             status_code = 200 if resultado.get('sucesso') else 400
 
@@ -952,10 +4350,51 @@ def handler(event, context):
                 'statusCode': status_code,
                 'headers': {
                     **cors_headers,
-                    'X-RateLimit-Limit': '5',
+                    'X-RateLimit-Limit': str(max_attempts),
+                    'X-RateLimit-Remaining': str(remaining)
+                },
+                'body': serialize_body(resultado, ensure_ascii=False)
+            }
+
+        elif path == '/api/safeweb/pre-check' and http_method == 'POST':
+            cpf = body.get('cpf')
+            data_nascimento = body.get('dataNascimento')
+            if not cpf or not data_nascimento:
+                return {
+                    'statusCode': 400,
+                    'headers': cors_headers,
+                    'body': serialize_body({'sucesso': False, 'erro': 'CPF e data de nascimento são obrigatórios'})
+                }
+
+            # 🛡️ Uma tentativa no rate limit por CPF para as duas consultas
+            max_attempts, window_seconds = CPF_RATE_LIMITS[path]
+            allowed, remaining, retry_after = check_cpf_rate_limit(cpf, max_attempts, window_seconds)
+            if not allowed:
+                return {
+                    'statusCode': 429,
+                    'headers': {
+                        **cors_headers,
+                        'Retry-After': str(retry_after),
+                        'X-RateLimit-Limit': str(max_attempts),
+                        'X-RateLimit-Remaining': '0'
+                    },
+                    'body': serialize_body({
+                        'sucesso': False,
+                        'erro': f'Muitas tentativas. Tente novamente em {retry_after} segundos.',
+                        'retry_after': retry_after
+                    })
+                }
+
+            resultado = run_pre_check(get_safeweb_client(), cpf, data_nascimento)
+
+            return {
+                'statusCode': 200,
+                'headers': {
+                    **cors_headers,
+                    'X-RateLimit-Limit': str(max_attempts),
                     'X-RateLimit-Remaining': str(remaining)
                 },
-                'body': json.dumps(resultado, ensure_ascii=False)
+                'body': serialize_body(resultado, ensure_ascii=False)
             }
 
         elif path == '/api/safeweb/consultar-cpf' and http_method == 'POST':
@@ -965,49 +4404,60 @@ def handler(event, context):
                 return {
                     'statusCode': 400,
                     'headers': cors_headers,
-                    'body': json.dumps({'sucesso': False, 'erro': 'CPF e data de nascimento são obrigatórios'})
+                    'body': serialize_body({'sucesso': False, 'erro': 'CPF e data de nascimento são obrigatórios'})
                 }
 
-            # 🛡️ Verificar rate limit por CPF (5 tentativas a cada 5 minutos)
-            allowed, remaining, retry_after = check_cpf_rate_limit(cpf, max_attempts=5, window_seconds=300)
+            # 🛡️ Verificar rate limit por CPF (padrão: 5 tentativas a cada 5 minutos)
+            max_attempts, window_seconds = CPF_RATE_LIMITS[path]
+            allowed, remaining, retry_after = check_cpf_rate_limit(cpf, max_attempts, window_seconds)
             if not allowed:
                 return {
                     'statusCode': 429,
                     'headers': {
                         **cors_headers,
                         'Retry-After': str(retry_after),
-                        'X-RateLimit-Limit': '5',
+                        'X-RateLimit-Limit': str(max_attempts),
                         'X-RateLimit-Remaining': '0'
                     },
-                    'body': json.dumps({
+                    'body': serialize_body({
                         'sucesso': False,
                         'erro': f'Muitas tentativas. Tente novamente em {retry_after} segundos.',
                         'retry_after': retry_after
                     })
                 }
 
-            safeweb = SafewebAPI()
+            safeweb = get_safeweb_client()
             resultado = safeweb.consultar_cpf(cpf, data_nascimento)
 
             return {
                 'statusCode': 200,
                 'headers': {
                     **cors_headers,
-                    'X-RateLimit-Limit': '5',
+                    'X-RateLimit-Limit': str(max_attempts),
                     'X-RateLimit-Remaining': str(remaining)
                 },
-                'body': json.dumps(resultado, ensure_ascii=False)
+                'body': serialize_body(resultado, ensure_ascii=False)
             }
 
         elif path == '/api/safeweb/gerar-protocolo' and http_method == 'POST':
-            safeweb = SafewebAPI()
+            safeweb = get_safeweb_client()
             resultado = safeweb.gerar_protocolo(body)
             status_code = 200 if resultado.get('sucesso') else 400
 
             return {
                 'statusCode': status_code,
                 'headers': cors_headers,
-                'body': json.dumps(resultado, ensure_ascii=False)
+                'body': serialize_body(resultado, ensure_ascii=False)
+            }
+
+        elif path == '/api/checkout' and http_method == 'POST':
+            resultado, status_code = run_checkout(get_safeweb_client(), get_safe2pay_client(), body)
+            logger.info(f"🧾 Checkout: etapa={resultado.get('etapa', 'concluido')} tempos={resultado.get('timings')}")
+
+            return {
+                'statusCode': status_code,
+                'headers': cors_headers,
+                'body': serialize_body(resultado, ensure_ascii=False)
             }
 
         elif path == '/api/hope/create-solicitation' and http_method == 'POST':
@@ -1017,153 +4467,106 @@ def handler(event, context):
                 return {
                     'statusCode': 400,
                     'headers': cors_headers,
-                    'body': json.dumps({'sucesso': False, 'erro': 'Protocolo é obrigatório'})
+                    'body': serialize_body({'sucesso': False, 'erro': 'Protocolo é obrigatório'})
                 }
 
-            print(f"📋 Criando solicitação Hope para protocolo: {protocol}")
+            logger.info(f"📋 Criando solicitação Hope para protocolo: {protocol}")
 
             try:
-                safeweb = SafewebAPI()
-                resultado = safeweb.criar_solicitacao_hope(protocol)
-                status_code = 200 if resultado.get('sucesso') else 500
+                # Normalmente o webhook de aprovação já gravou os efeitos: a gravação é
+                # idempotente e cobre webhooks perdidos. Aguardar o link sem chamar a Hope aqui
+                resultado = post_approval.result(protocol)
+                if resultado is None:
+                    enqueue_post_approval(protocol)
+                    resultado = post_approval.wait_for(
+                        protocol, wait_timeout=int(os.environ.get('POST_APPROVAL_WAIT_SECONDS', 20))
+                    )
+                if resultado is None:
+                    # Falhas ficam na outbox com retentativa; o link chega pela consulta de status
+                    return {
+                        'statusCode': 503,
+                        'headers': {**cors_headers, 'Retry-After': '5'},
+                        'body': serialize_body({
+                            'sucesso': False,
+                            'erro': 'Solicitação Hope ainda em processamento. Tente novamente.'
+                        }, ensure_ascii=False)
+                    }
 
                 return {
-                    'statusCode': status_code,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps(resultado, ensure_ascii=False)
+                    'body': serialize_body(resultado, ensure_ascii=False)
                 }
             except Exception as e:
-                print(f"❌ Erro ao criar solicitação Hope: {str(e)}")
+                logger.error(f"❌ Erro ao criar solicitação Hope: {str(e)}")
                 return {
                     'statusCode': 500,
                     'headers': cors_headers,
-                    'body': json.dumps({'sucesso': False, 'erro': 'Erro interno no servidor'})
+                    'body': serialize_body({'sucesso': False, 'erro': 'Erro interno no servidor'})
                 }
 
         elif path == '/webhook/safe2pay' and http_method == 'POST':
             # Webhook Safe2Pay - Notificação de pagamento
-            # 🔒 Mascara dados sensíveis para log
-            masked_body = mask_sensitive_data(body)
-            print(f"🔔 Webhook Safe2Pay recebido (RAW): {json.dumps(masked_body)}")
-
-            try:
-                # Verificar se está no formato wrapper ou direto
-                notification_payload = body
-                if 'NotificationWrapper' in body:
-                    print("📦 Webhook formato WRAPPER detectado")
-                    notification_payload = body['NotificationWrapper'].get('NotificationPayload', {})
-                else:
-                    print("📦 Webhook formato DIRETO detectado")
-
-                # Extrair dados do webhook (formato Safe2Pay)
-                id_transacao = notification_payload.get('IdTransaction')
+            log_payload("🔔 Webhook Safe2Pay recebido (RAW)", body)
 
-                # TransactionStatus pode vir como objeto ou direto
-                transaction_status = notification_payload.get('TransactionStatus', {})
-                if isinstance(transaction_status, dict):
-                    status_id = transaction_status.get('Id')
-                    status_code = transaction_status.get('Code')
-                    status_name = transaction_status.get('Name')
-                else:
-                    # Fallback para formato simples
-                    status_id = body.get('Status') or body.get('PaymentStatus')
-                    status_code = str(status_id)
-                    status_name = 'Unknown'
-
-                reference = notification_payload.get('Reference')
-                payment_date = notification_payload.get('PaymentDate')
-                amount = notification_payload.get('Amount')
-                payment_method = notification_payload.get('PaymentMethod', {})
-
-                print(f"📊 Webhook Safe2Pay:")
-                print(f"   - IdTransaction: {id_transacao}")
-                print(f"   - Status: {status_id} ({status_code}) - {status_name}")
-                print(f"   - Reference: {reference}")
-                print(f"   - Amount: {amount}")
-                print(f"   - PaymentDate: {payment_date}")
-                print(f"   - PaymentMethod: {payment_method.get('Name', 'N/A')}")
-
-                # Validar dados mínimos
-                if not id_transacao:
-                    print("❌ IdTransaction não fornecido no webhook")
-                    return {
-                        'statusCode': 400,
-                        'headers': cors_headers,
-                        'body': json.dumps({'sucesso': False, 'erro': 'IdTransaction não fornecido'})
-                    }
-
-                # Armazenar status no cache (para consultas via /api/pix/status)
-                _payment_status_cache[str(id_transacao)] = {
-                    'PaymentStatus': status_id,
-                    'TransactionStatus': {'Id': status_id, 'Code': status_code, 'Name': status_name},
-                    'Amount': amount,
-                    'PaymentDate': payment_date,
-                    'Reference': reference,
-                    'status': status_id  # Para compatibilidade com check_payment_status
+            # Validar dados mínimos
+            id_transacao = extract_safe2pay_notification(body).get('IdTransaction')
+            if not id_transacao:
+                logger.error("❌ IdTransaction não fornecido no webhook")
+                return {
+                    'statusCode': 400,
+                    'headers': cors_headers,
+                    'body': serialize_body({'sucesso': False, 'erro': 'IdTransaction não fornecido'})
                 }
-                print(f"💾 Status armazenado no cache para transaction {id_transacao}")
 
-                # Status 3 = Autorizado/Aprovado (segundo documentação Safe2Pay)
-                if status_id == 3 or status_code == '3':
-                    print(f"✅✅✅ PAGAMENTO APROVADO! Transaction: {id_transacao}, Reference: {reference}")
-                    print(f"💰 Valor: R$ {amount}")
-                    print(f"📅 Data: {payment_date}")
-
-                    # TODO: Implementar ações pós-pagamento
-                    # 1. Salvar no DynamoDB
-                    # 2. Enviar email/SMS para cliente
-                    # 3. Atualizar sistema interno
-                    # 4. Notificar frontend via WebSocket (futuro)
-
-                    return {
-                        'statusCode': 200,
-                        'headers': cors_headers,
-                        'body': json.dumps({
-                            'sucesso': True,
-                            'mensagem': 'Webhook processado com sucesso - Pagamento aprovado',
-                            'transactionId': id_transacao,
-                            'status': status_name
-                        })
-                    }
+            try:
+                if WEBHOOK_QUEUE_URL:
+                    get_sqs_client().send_message(QueueUrl=WEBHOOK_QUEUE_URL, MessageBody=json.dumps(body))
+                    logger.info(f"📥 Webhook enfileirado para transaction {id_transacao}")
                 else:
-                    print(f"📊 Webhook - Status {status_name} ({status_id}) recebido para transaction {id_transacao}")
+                    process_safe2pay_notification(body)
+            except Exception as webhook_error:
+                logger.error(f"❌ Erro ao receber webhook: {str(webhook_error)}")
+                if WEBHOOK_QUEUE_URL:
+                    # Evento não gravado: não confirmar, o Safe2Pay reenvia depois
                     return {
-                        'statusCode': 200,
+                        'statusCode': 503,
                         'headers': cors_headers,
-                        'body': json.dumps({
-                            'sucesso': True,
-                            'mensagem': f'Webhook recebido - Status {status_name}',
-                            'transactionId': id_transacao,
-                            'status': status_name
-                        })
+                        'body': serialize_body({'sucesso': False, 'erro': 'Fila de webhooks indisponível'})
                     }
-
-            except Exception as webhook_error:
-                print(f"❌ Erro ao processar webhook: {str(webhook_error)}")
-                print(f"❌ Traceback: {repr(webhook_error)}")
                 return {
                     'statusCode': 200,  # Retornar 200 para Safe2Pay não reenviar indefinidamente
                     'headers': cors_headers,
-                    'body': json.dumps({
+                    'body': serialize_body({
                         'sucesso': False,
                         'erro': 'Erro ao processar webhook',
                         'detalhes': str(webhook_error)
                     })
                 }
 
+            return {
+                'statusCode': 200,
+                'headers': cors_headers,
+                'body': serialize_body({
+                    'sucesso': True,
+                    'mensagem': 'Webhook recebido',
+                    'transactionId': id_transacao
+                })
+            }
+
         else:
             return {
                 'statusCode': 404,
                 'headers': cors_headers,
-                'body': json.dumps({'sucesso': False, 'erro': 'Endpoint não encontrado'})
+                'body': serialize_body({'sucesso': False, 'erro': 'Endpoint não encontrado'})
             }
 
     except Exception as e:
-        print(f"Erro: {str(e)}")
+        logger.error(f"❌ Erro não tratado em {path}: {str(e)}", exc_info=True)
         return {
             'statusCode': 500,
             'headers': cors_headers,
-            'body': json.dumps({
+            'body': serialize_body({
                 'sucesso': False,
                 'erro': 'Erro interno no servidor',
                 'detalhes': str(e) if os.environ.get('ENVIRONMENT') == 'dev' else None
@@ -5,6 +5,7 @@
  * Realiza a criação de cobranças PIX estáticas via backend
  */
 import { Config } from '../../shared/config/Config.js';
+import { IdempotencyKey } from '../../shared/utils/IdempotencyKey.js';
 
 export class Safe2PayRepository {
     constructor() {
@@ -45,12 +46,14 @@ export class Safe2PayRepository {
                 telefone: payload.telefone ? '***' + payload.telefone.slice(-4) : ''
             });
 
+            const body = JSON.stringify(payload);
             const response = await fetch(`${this.backendURL}/api/pix/create`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    ...IdempotencyKey.headers(IdempotencyKey.create('pix-create'))
                 },
-                body: JSON.stringify(payload)
+                body
             });
 
             if (!response.ok) {
@@ -68,6 +71,7 @@ export class Safe2PayRepository {
                     sucesso: true,
                     transactionId: resultado.dados.transactionId,
                     qrCodeImage: resultado.dados.qrCodeImage,
+                    qrCodeDataUri: resultado.dados.qrCodeDataUri || null,
                     qrCode: resultado.dados.qrCode,
                     pixCopiaECola: resultado.dados.pixCopiaECola || resultado.dados.qrCode,
                     valor: dados.valor,
@@ -120,7 +124,9 @@ export class Safe2PayRepository {
                     statusDescricao: this.getStatusDescricao(resultado.dados.PaymentStatus || resultado.status),
                     transactionId: transactionId,
                     valor: resultado.dados.Amount,
-                    dataPagamento: resultado.dados.PaymentDate
+                    dataPagamento: resultado.dados.PaymentDate,
+                    // Link de upload gerado pelo backend após o webhook de aprovação
+                    uploadUrl: resultado.uploadUrl || null
                 };
             }
 
@@ -135,6 +141,66 @@ export class Safe2PayRepository {
         }
     }
 
+    /**
+     * Aguarda mudança de status via long-poll (o backend segura a requisição
+     * até o webhook registrar um status novo ou o tempo esgotar)
+     * @param {string} transactionId - ID da transação
+     * @param {string|number} statusAtual - Último statusCode conhecido
+     * @param {number} timeoutSegundos - Tempo máximo de espera no servidor
+     * @param {AbortSignal} signal - Permite cancelar a espera
+     * @returns {Promise<Object>} Status do pagamento
+     */
+    async aguardarStatusPagamento(transactionId, statusAtual = '', timeoutSegundos = 25, signal = undefined) {
+        try {
+            const params = new URLSearchParams({
+                since: statusAtual ?? '',
+                timeout: String(timeoutSegundos)
+            });
+
+            const response = await fetch(`${this.backendURL}/api/pix/wait/${transactionId}?${params}`, {
+                method: 'GET',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                signal
+            });
+
+            if (!response.ok) {
+                const errorText = await response.text();
+                throw new Error(`Backend API erro ${response.status}: ${errorText}`);
+            }
+
+            const resultado = await response.json();
+
+            if (resultado.sucesso) {
+                const status = resultado.dados?.PaymentStatus || resultado.status;
+                return {
+                    sucesso: true,
+                    status: status,
+                    statusCode: resultado.statusCode ?? resultado.dados?.PaymentStatus,
+                    statusDescricao: this.getStatusDescricao(resultado.statusCode ?? status),
+                    transactionId: transactionId,
+                    valor: resultado.dados?.Amount,
+                    dataPagamento: resultado.dados?.PaymentDate,
+                    // Link de upload gerado pelo backend após o webhook de aprovação
+                    uploadUrl: resultado.uploadUrl || null
+                };
+            }
+
+            return resultado;
+
+        } catch (error) {
+            if (error.name === 'AbortError') {
+                throw error;
+            }
+            console.error('❌ Safe2PayRepository: Erro ao aguardar status', error);
+            return {
+                sucesso: false,
+                erro: error.message
+            };
+        }
+    }
+
     /**
      * Retorna descrição do status Safe2Pay
      * @param {number} status - Código do status
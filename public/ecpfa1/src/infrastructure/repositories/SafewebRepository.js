@@ -22,6 +22,7 @@
 
 import { ISafewebRepository } from '../../domain/repositories/ISafewebRepository.js';
 import { Config } from '../../shared/config/Config.js';
+import { IdempotencyKey } from '../../shared/utils/IdempotencyKey.js';
 
 export class SafewebRepository extends ISafewebRepository {
     constructor() {
@@ -176,12 +177,14 @@ export class SafewebRepository extends ISafewebRepository {
 
             console.log('📤 SafewebRepository: Enviando protocolo para CPF:', this._maskCPF(payload.cpf));
 
+            const body = JSON.stringify(payload);
             const response = await fetch(`${this.backendURL}/api/safeweb/gerar-protocolo`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    ...IdempotencyKey.headers(IdempotencyKey.create('gerar-protocolo'))
                 },
-                body: JSON.stringify(payload)
+                body
             });
 
             if (!response.ok) {
@@ -65,6 +65,7 @@ export class GerarPagamentoPIXUseCase {
                 pagamento: {
                     transactionId: resultado.transactionId,
                     qrCodeImage: resultado.qrCodeImage,
+                    qrCodeDataUri: resultado.qrCodeDataUri,
                     qrCode: resultado.qrCode,
                     pixCopiaECola: resultado.pixCopiaECola,
                     valor: resultado.valor,
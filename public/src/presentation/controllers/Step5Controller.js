@@ -4,6 +4,7 @@
  * Gerencia geração e monitoramento de pagamento PIX
  */
 import { gtmService } from '../../shared/utils/GTMService.js';
+import { IdempotencyKey } from '../../shared/utils/IdempotencyKey.js';
 
 export class Step5Controller {
     constructor(view, gerarPagamentoPIXUseCase, safe2PayRepository) {
@@ -11,6 +12,7 @@ export class Step5Controller {
         this.gerarPagamentoPIXUseCase = gerarPagamentoPIXUseCase;
         this.safe2PayRepository = safe2PayRepository;
         this.monitoringInterval = null;
+        this.monitoringAbort = null;
         this.pagamentoAtual = null;
         this.checkoutData = null; // Armazenar dados do checkout para Enhanced Conversions
     }
@@ -210,7 +212,7 @@ export class Step5Controller {
                     status?.toLowerCase() === 'autorizado' || status?.toLowerCase() === 'approved' ||
                     status?.toLowerCase() === 'paid' || status?.toLowerCase() === 'pago') {
                     console.log('🎉 Pagamento aprovado!');
-                    this.handlePagamentoAprovado();
+                    this.handlePagamentoAprovado(resultado.uploadUrl);
                 }
                 // Status 9 = Expirado, 4 = Cancelado
                 else if (status === 9 || status === 4) {
@@ -232,6 +234,9 @@ export class Step5Controller {
 
     /**
      * Inicia monitoramento automático do pagamento
+     *
+     * Usa long-poll: cada requisição fica aberta no backend até o webhook
+     * registrar um status novo (ou ~25s), em vez de uma consulta por segundo
      */
     async startMonitoring(transactionId) {
         if (!transactionId) {
@@ -251,26 +256,27 @@ export class Step5Controller {
             statusIndicator.textContent = 'Aguardando processamento do PIX...';
         }
 
-        // OTIMIZAÇÃO: Aguardar 5 segundos antes de começar a consultar
-        // Safe2Pay precisa de tempo para processar a transação antes de disponibilizar para consulta
-        await new Promise(resolve => setTimeout(resolve, 5000));
-
-        let checkCount = 0;
-        const maxChecks = 1800; // 30 minutos (1800 x 1 segundo) - OTIMIZADO
+        const maxSeconds = 1800; // 30 minutos
         const SHOW_TIMEOUT_ALERT_AFTER = 90; // Mostrar alerta após 90 segundos (1m30s)
+        const LONG_POLL_TIMEOUT = 25; // Segundos que o backend segura cada requisição
+        const MIN_POLL_INTERVAL_MS = 3000; // Intervalo mínimo se o backend responder sem mudança
+
+        const abortController = new AbortController();
+        this.monitoringAbort = abortController;
 
-        this.monitoringInterval = setInterval(async () => {
-            checkCount++;
+        // Contador visual (apenas UI, sem requisições)
+        let elapsedSeconds = 0;
+        this.monitoringInterval = setInterval(() => {
+            elapsedSeconds++;
 
-            // Atualizar contador no texto principal (em segundos)
             const paymentCheckText = document.getElementById('payment-check-text');
             if (paymentCheckText) {
-                const segundosTexto = checkCount === 1 ? 'segundo' : 'segundos';
-                paymentCheckText.textContent = `Aguardando pagamento (${checkCount} ${segundosTexto})`;
+                const segundosTexto = elapsedSeconds === 1 ? 'segundo' : 'segundos';
+                paymentCheckText.textContent = `Aguardando pagamento (${elapsedSeconds} ${segundosTexto})`;
             }
 
             // Mostrar alerta de timeout após 1m30s
-            if (checkCount === SHOW_TIMEOUT_ALERT_AFTER) {
+            if (elapsedSeconds === SHOW_TIMEOUT_ALERT_AFTER) {
                 const timeoutAlert = document.getElementById('payment-timeout-alert');
                 if (timeoutAlert) {
                     timeoutAlert.style.display = 'block';
@@ -278,13 +284,35 @@ export class Step5Controller {
                 }
             }
 
+            // Parar após o tempo máximo
+            if (elapsedSeconds >= maxSeconds) {
+                console.log('⏰ Tempo máximo de monitoramento atingido');
+                this.stopMonitoring();
+            }
+        }, 1000);
+
+        console.log('✅ Monitoramento iniciado (long-poll)');
+
+        let lastStatusCode = '';
+        let pollCount = 0;
+
+        while (!abortController.signal.aborted) {
+            pollCount++;
+            const startedAt = Date.now();
+
             try {
-                const resultado = await this.safe2PayRepository.consultarStatusPagamento(transactionId);
+                const resultado = await this.safe2PayRepository.aguardarStatusPagamento(
+                    transactionId, lastStatusCode, LONG_POLL_TIMEOUT, abortController.signal
+                );
 
                 if (resultado.sucesso) {
                     const status = resultado.status;
                     const statusCode = resultado.statusCode;
-                    console.log(`📊 Status (check ${checkCount}): ${resultado.statusDescricao || status} (código ${statusCode})`);
+                    console.log(`📊 Status (long-poll ${pollCount}): ${resultado.statusDescricao || status} (código ${statusCode})`);
+
+                    if (statusCode !== undefined && statusCode !== null) {
+                        lastStatusCode = String(statusCode);
+                    }
 
                     // Converter status para string se for número
                     const statusStr = typeof status === 'string' ? status.toLowerCase() : '';
@@ -294,34 +322,41 @@ export class Step5Controller {
                         statusStr === 'autorizado' || statusStr === 'approved' ||
                         statusStr === 'paid' || statusStr === 'pago') {
                         console.log('🎉 Pagamento aprovado!');
-                        this.handlePagamentoAprovado();
                         this.stopMonitoring();
+                        this.handlePagamentoAprovado(resultado.uploadUrl);
+                        return;
                     }
                     // Status expirado/cancelado
                     else if (status === 9 || status === 4 || statusCode === 9 || statusCode === 4) {
                         console.log('⏰ Pagamento expirado/cancelado');
                         this.stopMonitoring();
+                        return;
                     }
                 }
 
-                // Parar após máximo de tentativas
-                if (checkCount >= maxChecks) {
-                    console.log('⏰ Tempo máximo de monitoramento atingido');
-                    this.stopMonitoring();
-                }
-
             } catch (error) {
+                if (error.name === 'AbortError') {
+                    return;
+                }
                 console.error('❌ Erro ao verificar status:', error.message);
             }
-        }, 1000); // OTIMIZADO: Verificar a cada 1 segundo (antes era 3s)
 
-        console.log('✅ Monitoramento iniciado (verifica a cada 1s - OTIMIZADO)');
+            // Evitar laço apertado se o backend responder rápido sem mudança (erro, servidor ocupado)
+            const elapsedMs = Date.now() - startedAt;
+            if (elapsedMs < MIN_POLL_INTERVAL_MS && !abortController.signal.aborted) {
+                await new Promise(resolve => setTimeout(resolve, MIN_POLL_INTERVAL_MS - elapsedMs));
+            }
+        }
     }
 
     /**
      * Para o monitoramento automático
      */
     stopMonitoring() {
+        if (this.monitoringAbort) {
+            this.monitoringAbort.abort();
+            this.monitoringAbort = null;
+        }
         if (this.monitoringInterval) {
             clearInterval(this.monitoringInterval);
             this.monitoringInterval = null;
@@ -331,8 +366,10 @@ export class Step5Controller {
 
     /**
      * Trata pagamento aprovado
+     * @param {string|null} uploadUrlServidor - Link de upload já gerado pelo backend
+     *   (webhook de aprovação); sem ele, o link é pedido em /api/hope/create-solicitation
      */
-    async handlePagamentoAprovado() {
+    async handlePagamentoAprovado(uploadUrlServidor = null) {
         console.log('✅ Processando pagamento aprovado');
 
         // Obter email e telefone do cliente
@@ -436,15 +473,13 @@ export class Step5Controller {
                 ? `http://${window.location.hostname}:8082`
                 : '';
 
-            const response = await fetch(`${apiUrl}/api/hope/create-solicitation`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ protocol: protocolo })
-            });
-
-            const result = await response.json();
+            let result;
+            if (uploadUrlServidor) {
+                // Backend já criou a solicitação Hope ao receber o webhook
+                result = { sucesso: true, uploadUrl: uploadUrlServidor };
+            } else {
+                result = await this.solicitarUploadUrl(apiUrl, protocolo);
+            }
 
             if (result.sucesso && result.uploadUrl) {
                 console.log('✅ Solicitação Hope criada com sucesso');
@@ -507,6 +542,43 @@ export class Step5Controller {
         }
     }
 
+    /**
+     * Pede o link de upload ao backend, repetindo enquanto a outbox processa
+     * (503 + Retry-After: liberação e Hope seguem com retentativa no servidor)
+     * @param {string} apiUrl - URL base da API
+     * @param {string} protocolo - Protocolo Safeweb
+     * @param {number} maxTentativas - Pedidos antes de desistir
+     * @returns {Promise<Object>}
+     */
+    async solicitarUploadUrl(apiUrl, protocolo, maxTentativas = 6) {
+        const body = JSON.stringify({ protocol: protocolo });
+        // Mesma chave em todas as tentativas: são retentativas da mesma ação
+        const idempotencyKey = IdempotencyKey.create('hope-solicitation');
+        let result = { sucesso: false, erro: 'Solicitação Hope não concluída' };
+
+        for (let tentativa = 1; tentativa <= maxTentativas; tentativa++) {
+            const response = await fetch(`${apiUrl}/api/hope/create-solicitation`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    ...IdempotencyKey.headers(idempotencyKey)
+                },
+                body
+            });
+
+            result = await response.json();
+            if (response.status !== 503) {
+                return result;
+            }
+
+            const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 5;
+            console.log(`⏳ Solicitação Hope em processamento (tentativa ${tentativa}), nova consulta em ${retryAfter}s`);
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        }
+
+        return result;
+    }
+
     /**
      * Retorna dados do pagamento atual
      */
@@ -63,7 +63,10 @@ export class Step5View {
         console.log('💳 Step5View: Exibindo pagamento', pagamentoData);
 
         // Exibir QR Code
-        if (pagamentoData.qrCodeImage) {
+        if (pagamentoData.qrCodeDataUri) {
+            // QR Code gerado pelo backend (PNG inline, sem buscar imagem na Safe2Pay)
+            this.displayCleanQRCode(pagamentoData.qrCodeDataUri);
+        } else if (pagamentoData.qrCodeImage) {
             // Se tem imagem, processar e recortar para remover logos
             await this.processAndDisplayQRCode(pagamentoData);
         } else if (pagamentoData.pixCopiaECola) {
@@ -0,0 +1,42 @@
+/**
+ * 🔁 Utility: IdempotencyKey
+ *
+ * Gera o header Idempotency-Key para POSTs que criam recursos no backend
+ * (protocolo Safeweb, cobrança PIX, solicitação Hope)
+ *
+ * Cada ação do usuário recebe uma chave aleatória nova; apenas as
+ * retentativas automáticas dessa mesma ação reenviam a chave. Assim um
+ * retry por timeout não duplica o protocolo ou a cobrança, mas uma nova
+ * compra com os mesmos dados (ou um novo envio após erro) é processada
+ * de novo em vez de receber a resposta antiga.
+ */
+export class IdempotencyKey {
+    /**
+     * Cria a chave de uma ação do usuário (null se o navegador não tiver crypto)
+     * @param {string} operacao - Nome da operação (ex.: 'pix-create')
+     * @returns {string|null}
+     */
+    static create(operacao) {
+        const crypto = window.crypto;
+        if (crypto?.randomUUID) {
+            return `${operacao}-${crypto.randomUUID()}`;
+        }
+        if (!crypto?.getRandomValues) {
+            return null;
+        }
+
+        const key = Array.from(crypto.getRandomValues(new Uint8Array(16)))
+            .map(b => b.toString(16).padStart(2, '0'))
+            .join('');
+        return `${operacao}-${key}`;
+    }
+
+    /**
+     * Retorna os headers com a chave (vazio se não houver chave)
+     * @param {string|null} key - Chave criada por IdempotencyKey.create
+     * @returns {Object}
+     */
+    static headers(key) {
+        return key ? { 'Idempotency-Key': key } : {};
+    }
+}
@@ -9,10 +9,11 @@ resource "aws_apigatewayv2_api" "api" {
   description   = "API Backend para ${var.project_name}"
 
   cors_configuration {
-    allow_origins = ["*"] # Ajustar para domínio específico em produção
-    allow_methods = ["GET", "POST", "OPTIONS"]
-    allow_headers = ["Content-Type", "Authorization", "X-Requested-With"]
-    max_age       = 300
+    allow_origins  = ["*"] # Ajustar para domínio específico em produção
+    allow_methods  = ["GET", "POST", "OPTIONS"]
+    allow_headers  = ["Content-Type", "Authorization", "X-Requested-With", "Idempotency-Key", "X-Debug-Timing", "X-Request-ID", "traceparent"]
+    expose_headers = ["Server-Timing", "X-Request-ID", "Retry-After"]
+    max_age        = 300
   }
 
   tags = local.common_tags
@@ -42,6 +43,13 @@ resource "aws_apigatewayv2_route" "pix_status" {
   target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
 }
 
+# Rota: GET /api/pix/wait/{id} (long-poll de status)
+resource "aws_apigatewayv2_route" "pix_wait" {
+  api_id    = aws_apigatewayv2_api.api.id
+  route_key = "GET /api/pix/wait/{id}"
+  target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
+}
+
 # Rota: POST /api/safeweb/verificar-biometria
 resource "aws_apigatewayv2_route" "safeweb_biometria" {
   api_id    = aws_apigatewayv2_api.api.id
@@ -56,6 +64,13 @@ resource "aws_apigatewayv2_route" "safeweb_cpf" {
   target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
 }
 
+# Rota: POST /api/safeweb/pre-check (biometria + RFB em paralelo)
+resource "aws_apigatewayv2_route" "safeweb_pre_check" {
+  api_id    = aws_apigatewayv2_api.api.id
+  route_key = "POST /api/safeweb/pre-check"
+  target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
+}
+
 # Rota: POST /api/safeweb/gerar-protocolo
 resource "aws_apigatewayv2_route" "safeweb_protocolo" {
   api_id    = aws_apigatewayv2_api.api.id
@@ -63,6 +78,13 @@ resource "aws_apigatewayv2_route" "safeweb_protocolo" {
   target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
 }
 
+# Rota: POST /api/checkout (protocolo + PIX em uma requisição)
+resource "aws_apigatewayv2_route" "checkout" {
+  api_id    = aws_apigatewayv2_api.api.id
+  route_key = "POST /api/checkout"
+  target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
+}
+
 # Rota: POST /api/hope/create-solicitation
 resource "aws_apigatewayv2_route" "hope_create_solicitation" {
   api_id    = aws_apigatewayv2_api.api.id
@@ -77,6 +99,15 @@ resource "aws_apigatewayv2_route" "health" {
   target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
 }
 
+# Rota: GET /api/ops/outbox (profundidade da fila de efeitos Safeweb)
+# Só para operação: exige requisição assinada (SigV4) com execute-api:Invoke
+resource "aws_apigatewayv2_route" "ops_outbox" {
+  api_id             = aws_apigatewayv2_api.api.id
+  route_key          = "GET /api/ops/outbox"
+  target             = "integrations/${aws_apigatewayv2_integration.lambda.id}"
+  authorization_type = "AWS_IAM"
+}
+
 # Stage de produção
 resource "aws_apigatewayv2_stage" "prod" {
   api_id      = aws_apigatewayv2_api.api.id
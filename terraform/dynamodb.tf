@@ -0,0 +1,53 @@
+# =========================================
+# DYNAMODB - ESTADO COMPARTILHADO ENTRE CONTAINERS
+# =========================================
+
+# Tabela chave-valor genérica (token Safeweb, caches, leases)
+resource "aws_dynamodb_table" "kv" {
+  name         = "${var.project_name}-kv-${var.environment}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+
+  attribute {
+    name = "pk"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = merge(local.common_tags, {
+    Name = "Lambda Shared State"
+  })
+}
+
+# Policy para a Lambda ler/gravar na tabela
+resource "aws_iam_policy" "lambda_dynamodb" {
+  name        = "${local.lambda_name_api}-dynamodb-policy"
+  description = "Permite Lambda acessar a tabela de estado compartilhado"
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem"
+        ]
+        Resource = [
+          aws_dynamodb_table.kv.arn
+        ]
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_dynamodb" {
+  role       = aws_iam_role.lambda_api.name
+  policy_arn = aws_iam_policy.lambda_dynamodb.arn
+}
@@ -96,6 +96,19 @@ resource "aws_lambda_function" "api" {
       SAFEWEB_HOPE_API_URL        = "https://pss.safewebpss.com.br/Service/Microservice/Hope/Shared/api/integration/solicitation"
       SAFEWEB_ATTENDANCE_PLACE_ID = "348"
       ENVIRONMENT                 = var.environment
+      KV_STORE_TABLE              = aws_dynamodb_table.kv.name
+      SAFEWEB_TOKEN_STORE         = "dynamodb"
+      PAYMENT_STATUS_STORE        = "dynamodb"
+      RATE_LIMIT_STORE            = "dynamodb"
+      IDEMPOTENCY_STORE           = "dynamodb"
+      PIX_CHARGE_STORE            = "dynamodb"
+      WEBHOOK_QUEUE_URL           = aws_sqs_queue.webhook.url
+      POST_APPROVAL_STORE         = "dynamodb"
+      OUTBOX_QUEUE_URL            = aws_sqs_queue.outbox.url
+      OUTBOX_DLQ_URL              = aws_sqs_queue.outbox_dlq.url
+      OUTBOX_STORE                = "dynamodb"
+      OUTBOX_MAX_ATTEMPTS         = "8"
+      OUTBOX_LEASE_SECONDS        = "900"
     }
   }
 
@@ -107,7 +120,9 @@ resource "aws_lambda_function" "api" {
   depends_on = [
     aws_cloudwatch_log_group.lambda_api,
     aws_iam_role_policy_attachment.lambda_basic,
-    aws_iam_role_policy_attachment.lambda_secrets
+    aws_iam_role_policy_attachment.lambda_secrets,
+    aws_iam_role_policy_attachment.lambda_dynamodb,
+    aws_iam_role_policy_attachment.lambda_sqs
   ]
 }
 
@@ -0,0 +1,113 @@
+# =========================================
+# SQS - FILA DE WEBHOOKS SAFE2PAY
+# =========================================
+
+# Eventos que falharam maxReceiveCount vezes (inspeção manual / reprocessamento)
+resource "aws_sqs_queue" "webhook_dlq" {
+  name                      = "${var.project_name}-webhooks-dlq-${var.environment}"
+  message_retention_seconds = 1209600 # 14 dias
+
+  tags = local.common_tags
+}
+
+# Webhooks recebidos pela rota /webhook/safe2pay (resposta imediata ao Safe2Pay)
+resource "aws_sqs_queue" "webhook" {
+  name                       = "${var.project_name}-webhooks-${var.environment}"
+  visibility_timeout_seconds = 180    # 6x o timeout da Lambda
+  message_retention_seconds  = 345600 # 4 dias
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.webhook_dlq.arn
+    maxReceiveCount     = 5
+  })
+
+  tags = merge(local.common_tags, {
+    Name = "Safe2Pay Webhooks"
+  })
+}
+
+# =========================================
+# SQS - OUTBOX DE EFEITOS SAFEWEB
+# =========================================
+
+# Efeitos que falharam OUTBOX_MAX_ATTEMPTS vezes (reativados por novo webhook ou ação do usuário)
+resource "aws_sqs_queue" "outbox_dlq" {
+  name                      = "${var.project_name}-outbox-dlq-${var.environment}"
+  message_retention_seconds = 1209600 # 14 dias
+
+  tags = local.common_tags
+}
+
+# Liberação e solicitação Hope de pagamentos aprovados (backoff via ChangeMessageVisibility)
+resource "aws_sqs_queue" "outbox" {
+  name                       = "${var.project_name}-outbox-${var.environment}"
+  visibility_timeout_seconds = 180    # 6x o timeout da Lambda
+  message_retention_seconds  = 345600 # 4 dias
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.outbox_dlq.arn
+    maxReceiveCount     = 8 # = OUTBOX_MAX_ATTEMPTS
+  })
+
+  tags = merge(local.common_tags, {
+    Name = "Safeweb Outbox"
+  })
+}
+
+# Policy para a Lambda enfileirar e consumir os webhooks e a outbox
+resource "aws_iam_policy" "lambda_sqs" {
+  name        = "${local.lambda_name_api}-sqs-policy"
+  description = "Permite Lambda enviar e consumir as filas de webhooks e da outbox"
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage",
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
+          "sqs:GetQueueAttributes"
+        ]
+        Resource = [
+          aws_sqs_queue.webhook.arn,
+          aws_sqs_queue.outbox.arn
+        ]
+      },
+      {
+        Effect   = "Allow"
+        Action   = ["sqs:GetQueueAttributes"]
+        Resource = [aws_sqs_queue.outbox_dlq.arn]
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_sqs" {
+  role       = aws_iam_role.lambda_api.name
+  policy_arn = aws_iam_policy.lambda_sqs.arn
+}
+
+# Consumidor em lote: a mesma Lambda processa a fila (falhas parciais voltam para a fila)
+resource "aws_lambda_event_source_mapping" "webhook_queue" {
+  event_source_arn                   = aws_sqs_queue.webhook.arn
+  function_name                      = aws_lambda_function.api.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 1
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  depends_on = [aws_iam_role_policy_attachment.lambda_sqs]
+}
+
+# Um efeito por invocação: cada um faz chamadas Safeweb/Hope lentas, e em lote
+# uma única chamada demorada estouraria o timeout das demais
+resource "aws_lambda_event_source_mapping" "outbox_queue" {
+  event_source_arn        = aws_sqs_queue.outbox.arn
+  function_name           = aws_lambda_function.api.arn
+  batch_size              = 1
+  function_response_types = ["ReportBatchItemFailures"]
+
+  depends_on = [aws_iam_role_policy_attachment.lambda_sqs]
+}